@@ -113,21 +113,23 @@ class XBeeAIN(XBeeDevice):
             assert self.channels[channel - 1] != Differential, \
                 "Cannot change mode, paired channel is configured for Differential operation"                                  
                 
+        # settings are collected and sent as one transaction
+        commands = []
         if mode == CurrentLoop:
-            self.XBeeCommandSet(ain_control_lines[channel][out], 4)
-            self.XBeeCommandSet(ain_control_lines[channel][sw], 4)
+            commands.append((ain_control_lines[channel][out], 4))
+            commands.append((ain_control_lines[channel][sw], 4))
         elif mode == TenV:
-            self.XBeeCommandSet(ain_control_lines[channel][out], 5)
-            self.XBeeCommandSet(ain_control_lines[channel][sw], 4)
+            commands.append((ain_control_lines[channel][out], 5))
+            commands.append((ain_control_lines[channel][sw], 4))
         elif mode == Differential:
-            self.XBeeCommandSet(ain_control_lines[channel][out], 4)
-            self.XBeeCommandSet(ain_control_lines[channel][sw], 5)
-            self.XBeeCommandSet(ain_control_lines[channel+1][out], 4)
+            commands.append((ain_control_lines[channel][out], 4))
+            commands.append((ain_control_lines[channel][sw], 5))
+            commands.append((ain_control_lines[channel+1][out], 4))
         else:
             raise ValueError, "Unrecognized mode"
 
         if self.channels[channel] == Differential and mode != Differential:
-            self.XBeeCommandSet(ain_control_lines[channel + 1][out], 5)
+            commands.append((ain_control_lines[channel + 1][out], 5))
             self.channels[channel + 1] = TenV
         
         self.channels[channel] = mode
@@ -135,9 +137,8 @@ class XBeeAIN(XBeeDevice):
         if mode == Differential:
             self.channels[channel + 1] = Differential
 
-        self.XBeeCommandSet(ain_input_lines[channel], 2)
-        self.XBeeCommandSet("ac", "")
-        self.XBeeCommandSet("wr", "")
+        commands.append((ain_input_lines[channel], 2))
+        self.XBeeCommandSetMany(commands, apply = True, write = True)
 
     def raw_sample(self, channel, io_sample=None):
         """raw_sample(channel) => A/D reading
@@ -185,9 +186,6 @@ class XBeeAIN(XBeeDevice):
         Toggles power output on Terminal 6"""
 
         if state:
-            self.XBeeCommandSet("p3", 5)
+            self.XBeeCommandSetMany([("p3", 5)], apply = True, write = True)
         else:
-            self.XBeeCommandSet("p3", 4)
-
-        self.XBeeCommandSet("ac", "")
-        self.XBeeCommandSet("wr", "")
+            self.XBeeCommandSetMany([("p3", 4)], apply = True, write = True)
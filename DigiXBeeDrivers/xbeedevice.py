@@ -31,6 +31,30 @@ class XBeeDevice:
         print "XBeeCommandSet FAILED: %s %s" % (command, args)
         return 1
 
+    def XBeeCommandSetMany(self, commands, apply = True, write = False):
+        """Set a list of (command, args) pairs as one transaction, then apply
+        them and optionally write them to flash."""
+        if not hasattr(zigbee, "ddo_set_many"):
+            # no transaction support, set the commands one at a time
+            for command, args in commands:
+                if self.XBeeCommandSet(command, args) == 1:
+                    return 1
+            if apply and self.XBeeCommandSet("ac", "") == 1:
+                return 1
+            if write and self.XBeeCommandSet("wr", "") == 1:
+                return 1
+            return 0
+        # Attempt the transaction a couple times if it fails for some reason.
+        for i in range(0, amount_of_tries):
+            try:
+                zigbee.ddo_set_many(self.addr, commands, apply, write)
+            except:
+                continue
+            else:
+                return 0
+        print "XBeeCommandSetMany FAILED: %s" % (commands,)
+        return 1
+
     def XBeeCommandGet(self, command):
         result = None
         # Attempt the command a couple times if it fails for some reason.
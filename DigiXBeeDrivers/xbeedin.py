@@ -75,20 +75,19 @@ class XBeeDIN(XBeeDevice):
         assert channel >= 0, "Unrecognized channel"      
 
         if mode == Input:
-            self.XBeeCommandSet(control_lines[channel][out], 4)
-            self.XBeeCommandSet(control_lines[channel][inp], 3)
+            commands = [(control_lines[channel][out], 4),
+                        (control_lines[channel][inp], 3)]
         else:
             if highlow == 1:
-                self.XBeeCommandSet(control_lines[channel][out], 4)
+                commands = [(control_lines[channel][out], 4)]
             else:
-                self.XBeeCommandSet(control_lines[channel][out], 5)
+                commands = [(control_lines[channel][out], 5)]
 
-            self.XBeeCommandSet(control_lines[channel][inp], 4)
+            commands.append((control_lines[channel][inp], 4))
         
         self.channels[channel] = mode
         
-        self.XBeeCommandSet("ac", "")
-        self.XBeeCommandSet("wr", "")
+        self.XBeeCommandSetMany(commands, apply = True, write = True)
         
     def sample(self, channel, io_sample=None):
         """sample(channel) Returns digital sample data for specified channel"""
@@ -105,9 +104,6 @@ class XBeeDIN(XBeeDevice):
         """power(state) Toggles power output on Terminal 6"""
 
         if state:
-            self.XBeeCommandSet("p3", 5)
+            self.XBeeCommandSetMany([("p3", 5)], apply = True, write = True)
         else:
-            self.XBeeCommandSet("p3", 4)
-
-        self.XBeeCommandSet("ac", "")
-        self.XBeeCommandSet("wr", "")
+            self.XBeeCommandSetMany([("p3", 4)], apply = True, write = True)
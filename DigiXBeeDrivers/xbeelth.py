@@ -49,11 +49,7 @@ class XBeeLTHN(XBeeDevice):
             raise ValueError, "Adapter is not a %s" % (GetXBeeProductName(XBeeSensorLTHAdapter))
 
         # The XBee needs to have analog IO 1, 2, and 3 (pins 19, 18, 17) set to 'ADC'
-        self.XBeeCommandSet("d1", 2)
-        self.XBeeCommandSet("d2", 2)
-        self.XBeeCommandSet("d3", 2)
-        self.XBeeCommandSet("wr", "")
-        self.XBeeCommandSet("ac", "")
+        self.XBeeCommandSetMany([("d1", 2), ("d2", 2), ("d3", 2)], apply = True, write = True)
 
     def raw_sample(self, io_sample=None):
         """raw_sample(channel) => A/D reading
@@ -131,12 +131,182 @@ WatchPortASensorName      = "Watchport/A Drop-in Networking Sensor - Acceleromet
 
 import zigbee
 import struct
+import os
+import threading
+
+# Product identification cache
+#
+# Probing a device takes several DDO round trips over the air, so the
+# result of GetXBeeDeviceType is remembered on disk by extended address,
+# together with the VR and HV values read when it was probed.
+# Entries served from the cache are revalidated once per run in a
+# background thread; a device whose VR or HV changed is probed again.
+# The cache is kept next to this module, whatever the working directory is.
+
+PRODUCT_ID_CACHE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "xbeeprodid.cache")
+
+_cache_lock = threading.Lock()
+_cache = None                  # {address: (device_type, product_type, VR, HV)}
+_revalidate_queue = []
+_revalidated = {}
+_revalidate_thread = None
+
+def _load_cache():
+	global _cache
+	if _cache is not None:
+		return
+	_cache = {}
+	try:
+		cache_file = open(PRODUCT_ID_CACHE_FILE, "r")
+	except IOError:
+		return
+	try:
+		for line in cache_file:
+			fields = line.split()
+			if len(fields) != 5:
+				continue
+			try:
+				values = []
+				for field in fields[1:]:
+					if field == "-":
+						values.append(None)
+					else:
+						values.append(int(field, 16))
+			except ValueError:
+				continue
+			_cache[fields[0]] = tuple(values)
+	finally:
+		cache_file.close()
+
+def _save_cache():
+	temp_name = PRODUCT_ID_CACHE_FILE + ".tmp"
+	try:
+		cache_file = open(temp_name, "w")
+		try:
+			for address, entry in _cache.items():
+				fields = [address]
+				for value in entry:
+					if value is None:
+						fields.append("-")
+					else:
+						fields.append("%04X" % value)
+				cache_file.write(" ".join(fields) + "\n")
+		finally:
+			cache_file.close()
+		try:
+			os.rename(temp_name, PRODUCT_ID_CACHE_FILE)
+		except OSError:
+			# rename does not replace an existing file on every platform
+			os.remove(PRODUCT_ID_CACHE_FILE)
+			os.rename(temp_name, PRODUCT_ID_CACHE_FILE)
+	except (IOError, OSError):
+		pass # the cache is only an optimization
+
+def _read_versions(address):
+	try:
+		version = struct.unpack('=H', zigbee.ddo_get_param(address, 'VR'))[0]
+		hardware = struct.unpack('=H', zigbee.ddo_get_param(address, 'HV'))[0]
+	except:
+		return None, None
+	return version, hardware
+
+def _probe_and_store(address):
+	key = address.lower()
+	device_type, product_type = ProbeXBeeDeviceType(address)
+	if device_type == XBeeUnspecified:
+		version, hardware = None, None
+	else:
+		version, hardware = _read_versions(address)
+	_cache_lock.acquire()
+	try:
+		_load_cache()
+		if device_type == XBeeUnspecified:
+			# don't remember failures, probe again next time
+			if key in _cache:
+				del _cache[key]
+				_save_cache()
+		else:
+			_cache[key] = (device_type, product_type, version, hardware)
+			_save_cache()
+		_revalidated[key] = True
+	finally:
+		_cache_lock.release()
+	return device_type, product_type
+
+def _revalidate_cache():
+	global _revalidate_thread
+	while True:
+		_cache_lock.acquire()
+		try:
+			if not _revalidate_queue:
+				_revalidate_thread = None
+				return
+			address = _revalidate_queue.pop(0)
+			entry = _cache.get(address)
+		finally:
+			_cache_lock.release()
+		if entry is None:
+			continue
+		version, hardware = _read_versions(address)
+		if version is None:
+			continue # unreachable for now, keep the entry
+		if (version, hardware) != entry[2:]:
+			_probe_and_store(address)
+
+def _schedule_revalidation(key):
+	"Caller must hold _cache_lock"
+	global _revalidate_thread
+	if key in _revalidated:
+		return
+	_revalidated[key] = True
+	_revalidate_queue.append(key)
+	if _revalidate_thread is None:
+		_revalidate_thread = threading.Thread(target = _revalidate_cache, name = "xbeeprodid revalidation")
+		_revalidate_thread.setDaemon(True)
+		_revalidate_thread.start()
 
 # GetXBeeDeviceType
 #
-# Probes device, and returns a device type and product type.
+# Returns a device type and product type, from the product identification
+# cache when the device is known, otherwise by probing the device.
 #
 def GetXBeeDeviceType(address):
+	if not address:
+		return ProbeXBeeDeviceType(address)
+	key = address.lower()
+	_cache_lock.acquire()
+	try:
+		_load_cache()
+		entry = _cache.get(key)
+		if entry is not None:
+			_schedule_revalidation(key)
+			return entry[0], entry[1]
+	finally:
+		_cache_lock.release()
+	return _probe_and_store(address)
+
+# ForgetXBeeDeviceType
+#
+# Removes a device (or every device when address is None) from the
+# product identification cache.
+#
+def ForgetXBeeDeviceType(address=None):
+	_cache_lock.acquire()
+	try:
+		_load_cache()
+		if address is None:
+			_cache.clear()
+		elif address.lower() in _cache:
+			del _cache[address.lower()]
+		_save_cache()
+	finally:
+		_cache_lock.release()
+
+# ProbeXBeeDeviceType
+#
+# Probes device, and returns a device type and product type.
+#
+def ProbeXBeeDeviceType(address):
   
 	# Attempt the "DD" command a couple times if it fails for some reason.
   for i in xrange(0, 5):
@@ -53,15 +53,13 @@ class XBeeSPN(XBeeDevice):
       available on the mesh.  This object creates particial configuration,
       sampling, and power relay management.
       
-      When created, 5 commands are executed:
+      When created, 3 settings are sent as one transaction:
         D1 = 2
         D2 = 2
         D3 = 2
-        AC = None
-        WR = None
       
-      This sets the 3 dio lines for analog sampling and applies the changes
-      and writes to flash.
+      This sets the 3 dio lines for analog sampling, then applies the changes
+      and writes to flash with a single WR.
       
       If these commands should fail a ValueError exception is raised.
   """
@@ -76,16 +74,8 @@ class XBeeSPN(XBeeDevice):
     if self.product_type != XBeeSmartPlugAdapter:
         raise ValueError, "Adapter is not a %s"%(GetXBeeProductName(XBeeSmartPlugAdapter))
     
-    if self.XBeeCommandSet("d1", 2) == 1:
-        raise ValueError("Failed to set d1 = 2 on the adapter!")
-    if self.XBeeCommandSet("d2", 2) == 1:
-        raise ValueError("Failed to set d2 = 2 on the adapter!")    
-    if self.XBeeCommandSet("d3", 2) == 1:
-        raise ValueError("Failed to set d3 = 2 on the adapter!")
-    if self.XBeeCommandSet("ac", "") == 1:
-        raise ValueError("Failed to apply changes to the adapter!")
-    if self.XBeeCommandSet("wr", "") == 1:
-        raise ValueError("Failed to write to flash on the adapter!")
+    if self.XBeeCommandSetMany([("d1", 2), ("d2", 2), ("d3", 2)], apply = True, write = True) == 1:
+        raise ValueError("Failed to set d1 = d2 = d3 = 2 on the adapter!")
         
   def raw_sample(self, io_sample=None):
     """  Provides a untransulated sample in dictionary form.    
@@ -123,10 +113,7 @@ class XBeeSPN(XBeeDevice):
          turns on the power relay, False turns off the power relay.  """
          
     if state:
-      self.XBeeCommandSet('d4', 5)
+      self.XBeeCommandSetMany([('d4', 5)], apply = True, write = True)
     else:
-      self.XBeeCommandSet('d4', 4)
-            
-    self.XBeeCommandSet("ac", "")
-    self.XBeeCommandSet("wr", "")
+      self.XBeeCommandSetMany([('d4', 4)], apply = True, write = True)
       
@@ -49,10 +49,7 @@ class XBeeWRN(XBeeDevice):
             raise ValueError, "Adapter is not a %s" % (GetXBeeProductName(XBeeWallRouter))
 
         # The XBee needs to have analog IO 1 and 2 (pins 19, 18) set to 'ADC'
-        self.XBeeCommandSet("d1", 2)
-        self.XBeeCommandSet("d2", 2)
-        self.XBeeCommandSet("wr", "")
-        self.XBeeCommandSet("ac", "")
+        self.XBeeCommandSetMany([("d1", 2), ("d2", 2)], apply = True, write = True)
 
     def raw_sample(self, io_sample=None):
         """raw_sample(channel) => A/D reading
@@ -1,12 +1,25 @@
 import xbee
 
-node_list = []
+try:
+  discover = xbee.wait_for_discovery
+except AttributeError:
+  # ConnectPort firmware: getnodelist blocks for a fresh discovery
+  discover = xbee.getnodelist
+
+try:
+  # nodes saved by the simulator, no need to crawl the mesh again
+  node_list = list(xbee.load_stored_nodes())
+except AttributeError:
+  # ConnectPort firmware has no node store
+  node_list = []
 count = 1
 output_file = "table.py"
 
 for i in xrange(0, 5):
+  if node_list:
+    break
   
-  new_nodes = xbee.getnodelist()  
+  new_nodes = discover()  
   for node in new_nodes:
     found = False
     for old_node in node_list:
@@ -23,13 +36,13 @@ fh.write("table = {\r\n")
 
 for node in node_list:
   if node == node_list[-1]:    
-    if node.label.strip() != "":
+    if (node.label or "").strip() != "":
       fh.write("\t \"%s\": \"%s\"\r\n" %(node.addr_extended, node.label))      
     else:
       fh.write("\t \"%s\": \"%s\"\r\n" %(node.addr_extended, "Node_%d"%count))
       count+=1
   else:
-    if node.label.strip() != "":
+    if (node.label or "").strip() != "":
       fh.write("\t \"%s\": \"%s\",\r\n" %(node.addr_extended, node.label))      
     else:
       fh.write("\t \"%s\": \"%s\",\r\n" %(node.addr_extended, "Node_%d"%count))
@@ -1,4 +1,13 @@
-from xbee import getnodelist
+try:
+  from xbee import wait_for_discovery as getnodelist
+except ImportError:
+  # ConnectPort firmware: getnodelist blocks for a fresh discovery
+  from xbee import getnodelist
+try:
+  from xbee import load_stored_nodes
+except ImportError:
+  # ConnectPort firmware has no node store
+  load_stored_nodes = lambda: ()
 import sys
 import xbee_info
 
@@ -21,9 +30,16 @@ for i in xrange(1, len(sys.argv), 2):
   else:
     raise Exception("Unknown argument: %s" %sys.argv[i])
 
-print "Performing discovery"
+node_list = load_stored_nodes()
+if node_list:
+  # nodes saved by the simulator, no need to crawl the mesh again
+  print "Reading the node store"
+  discover_count = 1
+else:
+  print "Performing discovery"
 for i in xrange(0, discover_count):
-  node_list = getnodelist()
+  if i > 0 or not node_list:
+    node_list = getnodelist()
   for node in node_list:
     for comp_node in stored_nodes:
       if node.addr_extended == comp_node[0]:
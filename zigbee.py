@@ -30,7 +30,7 @@
 
 # TODO List:
 #    Add socket options (mostly counters needed).
-#    Check message size before sending (could split into multiple messages).
+#    Check message size before sending on sockets without XBS_SO_EP_FRAGMENT.
 #    Add more error checking and match ConnectPort errors
 #    Support for blocking calls for sendto
 #    Add new parameters to getnodelist, ddo_get_param, ddo_set_param
@@ -41,7 +41,20 @@ import time
 import socket
 import select
 import logging
-from threading import RLock
+import threading
+import heapq
+from threading import RLock, Condition
+try:
+    import sqlite3
+except ImportError:
+    sqlite3 = None # no node store
+try:
+    import selectors
+except ImportError:
+    try:
+        import selectors34 as selectors # backport for Python 2
+    except ImportError:
+        selectors = None # no XBeeSelector
 
 # set up logger
 logger = logging.getLogger("cp4pc.xbee")
@@ -51,7 +64,11 @@ MESH_TRACEBACK = False
 "Set this to true to enable printing of all ZigBee traffic"
 
 # set parameters
-__all__ = ["ddo_get_param", "ddo_set_param", "getnodelist", "get_node_list", "register_joining_device"]
+__all__ = ["ddo_get_param", "ddo_set_param", "ddo_set_many", "ddo_fleet", "ddo_get_param_async", "ddo_set_param_async", "ddo_command_async",
+           "getnodelist", "get_node_list", "discover_nodes", "wait_for_discovery", "add_discovery_listener",
+           "remove_discovery_listener", "get_stale_nodes", "load_stored_nodes", "register_joining_device",
+           "ddo_cache_statistics", "lqi_crawl_statistics", "conversation_statistics", "get_topology",
+           "address_cache_statistics", "fragment_statistics", "frame_id_statistics", "writer_statistics"]
 
 # Globals
 "Set this to function that accepts string to get passed MESH_TRACEBACK data"
@@ -62,6 +79,98 @@ _global_lock = RLock()
 # A lock used to manage the com-port management threads:
 _com_mgmt_lock = RLock()
 
+RX_BUFFER_MAX = 0x10000
+"Maximum number of unparsed bytes kept from the serial port"
+API_FRAME_MAX = 0x400
+"Largest frame length field accepted from the XBee, anything longer is line noise"
+READER_TIMEOUT = 0.5
+"Serial read timeout of the reader thread, bounds how long it takes to notice close_serial"
+HOUSEKEEPING_INTERVAL = 0.1
+"Minimum time in seconds between two runs of XBee._housekeeping"
+DDO_MAX_PER_DESTINATION = 4
+"Default number of DDO requests allowed in flight to a single node"
+DDO_CACHE_TTL = {"HV": None, "VR": 3600, "SH": None, "SL": None, "DD": 3600, "EE": 300, "NI": 300, "NP": 300}
+"Seconds a parameter read stays in the DDO cache (None = until invalidated), unlisted parameters are not cached"
+DDO_CACHE_SIZE = 1024
+"Maximum number of entries in the DDO cache"
+DDO_CACHE_FLUSH_COMMANDS = ("AC", "FR", "NR", "RE")
+"DDO commands that may change any parameter of the node they are sent to"
+DDO_FLEET_WINDOW = 32
+"Default number of requests a ddo_fleet operation keeps in flight"
+DISCOVERY_ZB_TIME = 60
+"Longest time in seconds a ZigBee discovery sweep may take (it ends when the neighbor table crawl completes)"
+DISCOVERY_STALE_SWEEPS = 1
+"Number of discovery sweeps a node may go unseen before it is removed from the node table"
+DISCOVERY_JOIN = "join"
+"Discovery event: a node was added to the node table"
+DISCOVERY_UPDATE = "update"
+"Discovery event: the address, type or label of a known node changed"
+DISCOVERY_STALE = "stale"
+"Discovery event: a node was not seen and has been removed from the node table"
+DISCOVERY_SILENT = "silent"
+"Discovery event: nothing was received from a node for longer than its liveness threshold"
+DISCOVERY_ALIVE = "alive"
+"Discovery event: a silent node was heard from again"
+LIVENESS_THRESHOLD = {"coordinator": 600, "router": 600, "end": 3600, "unknown": 1800}
+"Seconds a node may stay silent before it is reported stale, by node type (sleeping end devices report less often)"
+LIVENESS_CHECK_INTERVAL = 5
+"Seconds between liveness checks of the node table"
+TIMER_WHEEL_RESOLUTION = 0.1
+"Time in seconds covered by one slot of the first level of a Timer_Wheel"
+TIMER_WHEEL_SLOTS = 64
+"Number of slots in every level of a Timer_Wheel"
+TIMER_WHEEL_LEVELS = 3
+"Number of levels of a Timer_Wheel"
+NODE_STORE_FILE = "xbee_nodes.db"
+"Default sqlite database the node table is saved to (setting 'node_store')"
+NODE_STORE_FLUSH_INTERVAL = 10
+"Time in seconds between two writes of the node table changes to the node store"
+TOPOLOGY_LQI_CHANGE = 16
+"Smallest change of a link's LQI reported as a topology change"
+LQI_CRAWL_IN_FLIGHT = 8
+"Default number of neighbor table requests the LQI crawler keeps in flight"
+LQI_CRAWL_ROUTER_INTERVAL = 0.05
+"Minimum time in seconds between two neighbor table requests to the same router"
+LQI_CRAWL_TIMEOUT = 3
+"Time in seconds the LQI crawler waits for a neighbor table response"
+LQI_CRAWL_RETRIES = 2
+"Number of times the LQI crawler repeats a request whose response was lost"
+FRAGMENT_HEADER = ">BBB"
+"Header of every fragment: message ID, fragment index, fragment count"
+FRAGMENT_HEADER_SIZE = struct.calcsize(FRAGMENT_HEADER)
+FRAGMENT_DEFAULT_PAYLOAD = 72
+"Fragment size used when NP cannot be read from the XBee (802.15.4 firmware)"
+FRAGMENT_APS_OVERHEAD = 4
+"Bytes APS encryption (XBS_OPT_TX_APSSEC) takes from the payload NP reports"
+FRAGMENT_WINDOW = 4
+"Default number of fragments waiting for their Tx Status (socket option XBS_SO_EP_FRAGMENT_WINDOW)"
+FRAGMENT_TX_TIMEOUT = 10
+"Time in seconds after which a fragment whose Tx Status never came counts as failed"
+FRAGMENT_RETRIES = 2
+"Number of times a failed fragment is sent again before its message is given up"
+FRAGMENT_QUEUE_MAX = 512
+"Number of fragments waiting to be sent before sendto blocks (non-blocking sockets raise)"
+FRAGMENT_REASSEMBLY_TIMEOUT = 10
+"Time in seconds a partial message is kept without receiving a new fragment"
+FRAGMENT_SOURCE_MAX = 4
+"Number of partial messages kept per source, the oldest is dropped first"
+FRAGMENT_BUFFER_MAX = 0x10000
+"Bytes of partial messages kept per endpoint, the oldest are dropped first"
+FRAME_ID_WINDOW = 255
+"Number of XBee frame IDs that may wait for a response before XBee.send waits for one to be released"
+FRAME_ID_TIMEOUT = 30
+"Time in seconds after which a frame ID that got no response is reaped (longer than the longest ND timeout)"
+FRAME_ID_RESPONSES = {0x00: 0x89, 0x01: 0x89, 0x08: 0x88, 0x09: 0x88, 0x10: 0x8B, 0x11: 0x8B, 0x17: 0x97, 0x24: 0xA4}
+"API ID of the response that releases a frame ID, key = API ID of the transmitted frame"
+TX_QUEUE_MAX = 0x1000
+"Bytes of frames queued for the writer thread before senders wait for it"
+TX_CTS_POLL = 0.005
+"Time in seconds the writer thread waits before checking again whether the XBee raised CTS"
+TX_STATUS_TIMEOUT = 10
+"Time in seconds a Tx_Future waits for its Tx Status before it fails"
+TX_IN_FLIGHT_MAX = 64
+"Number of Tx_Futures waiting for their Tx Status before send_zb_async blocks (non-blocking sockets raise)"
+
 def __register_with_socket_module(object_name):
     "Register object with socket module (add to __all__)"
     try:
@@ -99,13 +208,60 @@ def address_string_to_short(address_string):
     "Convert an address string to a short (network) address"
     return int("0x" + address_string[1:-2], 16)
 
+def _payload_length(payload):
+    "Length of a payload given as a string/buffer or as a sequence of them"
+    if isinstance(payload, (list, tuple)):
+        return sum(map(len, payload))
+    return len(payload)
+
+def _payload_string(payload):
+    "Return a payload given as a buffer or as a sequence of buffers as one string"
+    if isinstance(payload, str):
+        return payload
+    if not isinstance(payload, (list, tuple)):
+        payload = (payload,)
+    parts = []
+    for part in payload:
+        if isinstance(part, memoryview):
+            parts.append(part.tobytes())
+        else:
+            parts.append(str(part))
+    return "".join(parts)
+
+def _copy_payload(buffer, offset, payload):
+    "Copy a payload (see _payload_string) into the bytearray buffer at offset"
+    if not isinstance(payload, (list, tuple)):
+        payload = (payload,)
+    for part in payload:
+        end = offset + len(part)
+        buffer[offset:end] = part
+        offset = end
+
+def _copy_into(buffer, payload, length):
+    "Copy the first length bytes of a received payload to the start of a writable buffer"
+    try:
+        view = memoryview(buffer)
+    except TypeError:
+        # old style buffers (array.array) are only filled from a string
+        struct.pack_into("%ds" % length, buffer, 0, payload[:length])
+        return
+    view[:length] = memoryview(payload)[:length]
+
+def _reserve_buffer(buffer, size):
+    "Grow the bytearray buffer to at least size bytes"
+    if len(buffer) < size:
+        buffer.extend(bytearray(size - len(buffer)))
+
 
 class API_Data:
     """Base class for storing data in an API message
-    Also stores a static frame ID for different messages to use."""
+    Also stores a static frame ID for messages exported outside XBee.send,
+    which takes frame IDs from the XBee's Frame_ID_Allocator instead."""
 
     xbee_frame_id = 1
     "Frame ID for transmitting to the XBee node"
+    allocate_frame_id = None
+    "Function returning the frame ID to export with, set by XBee.send"
     rx_id = 0
     "Receive API message type ID"
     tx_id = 0
@@ -116,9 +272,10 @@ class API_Data:
         self.data = ""
         self.frame_id = 0
 
-    @staticmethod
-    def next_frame():
+    def next_frame(self):
         "Returns the next frame ID for sending a message"
+        if self.allocate_frame_id is not None:
+            return self.allocate_frame_id()
         API_Data.xbee_frame_id += 1
         if API_Data.xbee_frame_id >= 256:
             API_Data.xbee_frame_id = 1
@@ -132,6 +289,14 @@ class API_Data:
         "Returns the whole buffer as a string"
         return self.data
 
+    def export_into(self, buffer, offset = 0):
+        """Export the cmd_data into the bytearray buffer at offset (the buffer is
+        grown when too short), returns the number of bytes written"""
+        cmd_data = self.export()
+        _reserve_buffer(buffer, offset + len(cmd_data))
+        buffer[offset:offset + len(cmd_data)] = cmd_data
+        return len(cmd_data)
+
 
 class IEEE_802_15_4_64_Data(API_Data):
     "Extracts an 802.15.4 frame from the XBee Rx message and outputs a XBee transmit frame."
@@ -168,15 +333,23 @@ class IEEE_802_15_4_64_Data(API_Data):
         
     def export(self):
         "Export a XBee message as a 0x00 XBee frame cmd_data"
+        buffer = bytearray()
+        self.export_into(buffer)
+        return str(buffer)
+
+    def export_into(self, buffer, offset = 0):
+        "Export a XBee message as a 0x00 XBee frame cmd_data into buffer, see API_Data.export_into"
         self.frame_id = self.next_frame()
-        cmd_data = chr(self.frame_id) #frame id
-        cmd_data += struct.pack(">Q", address_string_to_MAC(self.destination_address[0])) # destination_address_64
+        options = 0 # default to no options
         if len(self.destination_address) > 4:
-            cmd_data += chr(self.destination_address[4])
-        else:
-            cmd_data += chr(0) # default to no options
-        cmd_data += self.payload
-        return cmd_data
+            options = self.destination_address[4]
+        length = 10 + _payload_length(self.payload)
+        _reserve_buffer(buffer, offset + length)
+        struct.pack_into(">BQB", buffer, offset, self.frame_id, # frame id
+                                                address_string_to_MAC(self.destination_address[0]), # destination_address_64
+                                                options)
+        _copy_payload(buffer, offset + 10, self.payload)
+        return length
 
 
 class IEEE_802_15_4_16_Data(API_Data):
@@ -214,15 +387,23 @@ class IEEE_802_15_4_16_Data(API_Data):
         
     def export(self):
         "Export a XBee message as a 0x01 XBee frame cmd_data"
+        buffer = bytearray()
+        self.export_into(buffer)
+        return str(buffer)
+
+    def export_into(self, buffer, offset = 0):
+        "Export a XBee message as a 0x01 XBee frame cmd_data into buffer, see API_Data.export_into"
         self.frame_id = self.next_frame()
-        cmd_data = chr(self.frame_id) #frame id
-        cmd_data += struct.pack(">H", address_string_to_short(self.destination_address[0])) # destination_address_16
+        options = 0 # default to no options
         if len(self.destination_address) > 4:
-            cmd_data += chr(self.destination_address[4])
-        else:
-            cmd_data += chr(0) # default to no options
-        cmd_data += self.payload
-        return cmd_data
+            options = self.destination_address[4]
+        length = 4 + _payload_length(self.payload)
+        _reserve_buffer(buffer, offset + length)
+        struct.pack_into(">BHB", buffer, offset, self.frame_id, # frame id
+                                                address_string_to_short(self.destination_address[0]), # destination_address_16
+                                                options)
+        _copy_payload(buffer, offset + 4, self.payload)
+        return length
 
 
 class ZB_Data(API_Data):
@@ -240,6 +421,10 @@ class ZB_Data(API_Data):
         self.source_address = source_address
         self.destination_address = destination_address
         self.payload = payload
+        self.source_short = None
+        "16-bit address the frame was received from"
+        self.destination_short = None
+        "Known 16-bit address of a 64-bit destination (None: let the XBee discover it)"
 
     def extract(self, cmd_data):
         "Extract a XBee message from a 0x91 XBee frame cmd_data"
@@ -250,6 +435,7 @@ class ZB_Data(API_Data):
         source_address_64, source_address_16, source_endpoint, destination_endpoint, \
             cluster_id, profile_id, options = struct.unpack(">QHBBHHB", cmd_data[:17])
         self.payload = cmd_data[17:]
+        self.source_short = source_address_16
         if source_address_64 == 0xFFFFFFFFFFFFFFFF:
             # only short address information available
             address_string = short_to_address_string(source_address_16)
@@ -265,26 +451,39 @@ class ZB_Data(API_Data):
         
     def export(self):
         "Export a XBee message as a 0x11 XBee frame cmd_data"
+        buffer = bytearray()
+        self.export_into(buffer)
+        return str(buffer)
+
+    def export_into(self, buffer, offset = 0):
+        "Export a XBee message as a 0x11 XBee frame cmd_data into buffer, see API_Data.export_into"
         self.frame_id = self.next_frame()
-        cmd_data = chr(self.frame_id) #frame id
         if len(self.destination_address[0]) == 7: # [XXXX]! short address
-            cmd_data += struct.pack(">Q", 0xFFFFFFFFFFFFFFFF)
-            cmd_data += struct.pack(">H", address_string_to_short(self.destination_address[0]))
+            destination_address_64 = 0xFFFFFFFFFFFFFFFF
+            destination_address_16 = address_string_to_short(self.destination_address[0])
         else: # long address
-            cmd_data += struct.pack(">Q", address_string_to_MAC(self.destination_address[0])) # destination_address_64
-            # TTDO: should set to last know short address to improve performance
-            cmd_data += chr(0xFF) + chr(0xFE) # destination_address_16
-        cmd_data += struct.pack(">BBHHB", self.source_address[1], # source_endpoint
-                                          self.destination_address[1],# destination_endpoint
-                                          self.destination_address[3], # cluster_id
-                                          self.destination_address[2], # profile_id
-                                          self.BROADCAST_RADIUS) # broadcast radius
+            destination_address_64 = address_string_to_MAC(self.destination_address[0])
+            if self.destination_short is not None:
+                # last known short address, saves the XBee a network address discovery
+                destination_address_16 = self.destination_short
+            else:
+                destination_address_16 = 0xFFFE
+        options = 0 # default to no options
         if len(self.destination_address) > 4:
-            cmd_data += chr(self.destination_address[4])
-        else:
-            cmd_data += chr(0) # default to no options
-        cmd_data += self.payload
-        return cmd_data
+            options = self.destination_address[4]
+        length = 19 + _payload_length(self.payload)
+        _reserve_buffer(buffer, offset + length)
+        struct.pack_into(">BQHBBHHBB", buffer, offset, self.frame_id, # frame id
+                                                      destination_address_64,
+                                                      destination_address_16,
+                                                      self.source_address[1], # source_endpoint
+                                                      self.destination_address[1], # destination_endpoint
+                                                      self.destination_address[3], # cluster_id
+                                                      self.destination_address[2], # profile_id
+                                                      self.BROADCAST_RADIUS, # broadcast radius
+                                                      options)
+        _copy_payload(buffer, offset + 19, self.payload)
+        return length
     
 
 class Local_AT_Data(API_Data):
@@ -323,13 +522,24 @@ class Local_AT_Data(API_Data):
         return cmd_data
 
 
+class Local_AT_Queue_Data(Local_AT_Data):
+    """Exports to an AT Command - Queue Parameter Value frame.
+    The new value is only applied by a later AC (or any 0x08 AT Command frame).
+    The XBee answers with a regular AT Response frame."""
+    tx_id = 0x09
+    "Transmit API message type ID"
+
+
 class Remote_AT_Data(API_Data):
     "Extracts from a Remote AT Response frame and exports to a Remote AT Command frame."
     rx_id = 0x97
     "Receive API message type ID"
     tx_id = 0x17
     "Transmit API message type ID"
-    def __init__(self, remote_address = None, AT_cmd = "", value = ""):
+    # command options
+    APPLY_CHANGES = 0x02
+    "Apply the change immediately, without this option the value is queued until AC"
+    def __init__(self, remote_address = None, AT_cmd = "", value = "", options = APPLY_CHANGES):
         API_Data.__init__(self)
         "Initializes the AT frame with no data."
         self.remote_address = remote_address
@@ -340,6 +550,8 @@ class Remote_AT_Data(API_Data):
         "Status of a received message"
         self.value = value
         "Value received or to be set for the AT command"
+        self.options = options
+        "Remote command options"
 
     def extract(self, cmd_data):
         "Extract a remote AT response message from a 0x97 xbee frame cmd_data"
@@ -359,7 +571,7 @@ class Remote_AT_Data(API_Data):
         cmd_data = chr(self.frame_id)
         cmd_data += struct.pack(">Q", address_string_to_MAC(self.remote_address)) # destination_address_64
         cmd_data += chr(0xFF) + chr(0xFE) # destination_address_16
-        cmd_data += chr(0x02) # Command Options (Always set immediately)        
+        cmd_data += chr(self.options) # Command Options
         cmd_data += self.AT_cmd
         cmd_data += self.value
         return cmd_data
@@ -578,11 +790,8 @@ class API_Message:
 
     def calc_checksum(self):
         "Calculates the checksum, based on cmd_data"
-        checksum = self.API_ID
-        for byte in self.cmd_data:
-            checksum += ord(byte)
-            checksum &= 0xFF
-        return 0xFF - checksum
+        checksum = self.API_ID + sum(bytearray(self.cmd_data))
+        return 0xFF - (checksum & 0xFF)
     
     def set_length(self):
         "Calculates the length and sets it, based on cmd_data"
@@ -597,33 +806,41 @@ class API_Message:
         "Verifies that the checksum is correct"
         return self.checksum == self.calc_checksum()
         
-    def extract(self, buffer):
-        """Extracts the message from a string
+    def extract(self, buffer, offset = 0):
+        """Extracts the message from a string or bytearray, starting at offset
+        The frame is read in place; only the command data is copied out.
         returns number of bytes used on success
         -1 when the buffer is not big enough(string not long enough)"""
-        if len(buffer) < 5:
+        if len(buffer) - offset < 5:
             return -1
-        
-        # pull out length (MSB)
-        length = ord(buffer[1]) * 255 + ord(buffer[2])
-        
-        if len(buffer) < length + 4:
+
+        # pull out length (MSB first) and API ID
+        length, API_ID = struct.unpack_from(">HB", buffer, offset + 1)
+
+        if len(buffer) - offset < length + 4:
             return -1
 
         # we have a full XBee message, lets extract it.
         self.length = length
-        self.API_ID = ord(buffer[3])
-        self.cmd_data = buffer[4:length+3]
-        if self.API_ID in self.API_IDs.keys():
+        self.API_ID = API_ID
+        self.cmd_data = str(buffer[offset + 4:offset + length + 3])
+        self.checksum, = struct.unpack_from(">B", buffer, offset + length + 3)
+        if not self.is_valid():
+            # don't bother decoding corrupted frames
+            self.api_data = API_Data()
+        elif self.API_ID in self.API_IDs:
             self.api_data = self.API_IDs[self.API_ID]()
+            self.api_data.extract(self.cmd_data)
         else:
             self.api_data = API_Data()
-        self.api_data.extract(self.cmd_data)
-        self.checksum = ord(buffer[length + 3])
+            self.api_data.extract(self.cmd_data)
 
         return len(self)
 
-        
+    def frame_string(self):
+        "Returns the received frame as a string, without re-exporting the API data"
+        return chr(0x7E) + struct.pack(">HB", self.length, self.API_ID) + self.cmd_data + chr(self.checksum)
+
     def export(self, recalculate_checksum = 1):
         """Exports the message to a string, will recalculate checksum by default.
         Will also re-calculate the length field and lookup API_ID from message type."""
@@ -631,7 +848,112 @@ class API_Message:
         self.cmd_data = self.api_data.export() # must be done before calculating checksum
         self.checksum = self.calc_checksum() # calculate the new checksum and set it
         self.set_length() # set the new length
-        return chr(0x7E) + chr(self.length / 255) + chr(self.length & 0xFF) + chr(self.API_ID) + self.cmd_data + chr(self.checksum)
+        return chr(0x7E) + chr(self.length >> 8) + chr(self.length & 0xFF) + chr(self.API_ID) + self.cmd_data + chr(self.checksum)
+
+    def export_into(self, buffer):
+        """Exports the message into the bytearray buffer (grown when too short)
+        without building the cmd_data string, which is left unchanged.
+        Returns the length of the frame."""
+        self.set_API_ID() # must be done before calculating checksum
+        cmd_length = self.api_data.export_into(buffer, 4)
+        self.length = cmd_length + 1
+        self.checksum = 0xFF - ((self.API_ID + sum(buffer[4:4 + cmd_length])) & 0xFF)
+        _reserve_buffer(buffer, cmd_length + 5)
+        struct.pack_into(">BHB", buffer, 0, 0x7E, self.length, self.API_ID)
+        struct.pack_into(">B", buffer, cmd_length + 4, self.checksum)
+        return cmd_length + 5
+
+
+class API_Frame_Parser:
+    """Incremental parser for the stream of API frames coming from the XBee.
+
+    Received bytes are appended to a bytearray and frames are located with a
+    read cursor, so consuming a frame or skipping line noise never copies the
+    rest of the buffer.  Consumed bytes are compacted away in place once they
+    make up at least half of the buffer."""
+
+    def __init__(self, max_buffer = RX_BUFFER_MAX):
+        self.buffer = bytearray()
+        "Bytes received from the serial port"
+        self.offset = 0
+        "Read cursor, index of the first unparsed byte in the buffer"
+        self.max_buffer = max_buffer
+        "Hard cap on the number of unparsed bytes held in the buffer"
+        self.frames = 0
+        "Number of valid frames parsed"
+        self.checksum_errors = 0
+        "Number of candidate frames dropped because of a bad checksum"
+        self.discarded_bytes = 0
+        "Number of bytes skipped while searching for a frame delimiter"
+        self.overflows = 0
+        "Number of times unparsed data was dropped to respect max_buffer"
+
+    def __len__(self):
+        "Number of unparsed bytes in the buffer"
+        return len(self.buffer) - self.offset
+
+    def clear(self):
+        "Drop all buffered data"
+        self.buffer = bytearray()
+        self.offset = 0
+
+    def feed(self, data):
+        "Append data received from the serial port"
+        if data:
+            self.buffer.extend(data)
+        excess = len(self) - self.max_buffer
+        if excess > 0:
+            # drop the oldest data, the XBee is sending faster than we parse
+            self.offset += excess
+            self.discarded_bytes += excess
+            self.overflows += 1
+            logger.warning("XBee receive buffer overflow, dropped %d bytes" % excess)
+        self.compact()
+
+    def compact(self):
+        "Remove consumed bytes from the front of the buffer"
+        if self.offset == len(self.buffer):
+            del self.buffer[:]
+            self.offset = 0
+        elif self.offset * 2 >= len(self.buffer):
+            del self.buffer[:self.offset]
+            self.offset = 0
+
+    def next_message(self):
+        """Returns the next API_Message with a valid checksum
+        or None when there is no complete frame in the buffer"""
+        buffer = self.buffer
+        while 1:
+            # skip up to first candidate API frame
+            s_idx = buffer.find('\x7e', self.offset)
+            if s_idx == -1:
+                self.discarded_bytes += len(buffer) - self.offset
+                self.offset = len(buffer)
+                break
+            self.discarded_bytes += s_idx - self.offset
+            self.offset = s_idx
+            message = API_Message()
+            status = message.extract(buffer, s_idx)
+            if status < 0:
+                # not enough buffer for the message
+                if len(buffer) - s_idx > 2 and struct.unpack_from(">H", buffer, s_idx + 1)[0] > API_FRAME_MAX:
+                    # length can never be satisfied, this is not a real frame
+                    self.offset += 1
+                    self.discarded_bytes += 1
+                    continue
+                break
+            if message.is_valid():
+                self.offset += status
+                self.frames += 1
+                return message
+            # Advance past the delimiter; useful in the case where ~~ appears in stream
+            # unexpectedly. It's been seeon on OSX a few times; likely due to faulty
+            # flow control. The message parser must advance in order to allow it to
+            # continue.
+            self.checksum_errors += 1
+            self.offset += 1
+        self.compact()
+        return None
 
 
 class ZDO_Frame:
@@ -680,14 +1002,18 @@ class Conversation:
     def tick_sec(self):
         if (time.time() - self.start_time > self.timeout):
             # we timed out on the response
-            self.active = False
-            if self.timeout_callback is not None:
-                self.timeout_callback(self)
-            else:
-                #TTDO: this is now an uncommon case; should we just print an error or still rely
-                #on a raise (and catch in tick_sec)?
-                #raise Exception("Conversation Timeout: Address = %s" % str(self.frame.address))
-                pass
+            self.expire()
+
+    def expire(self):
+        "End the conversation without a response"
+        self.active = False
+        if self.timeout_callback is not None:
+            self.timeout_callback(self)
+        else:
+            #TTDO: this is now an uncommon case; should we just print an error or still rely
+            #on a raise (and catch in tick_sec)?
+            #raise Exception("Conversation Timeout: Address = %s" % str(self.frame.address))
+            pass
 
 
 class ZDO_Conversation(Conversation):
@@ -700,6 +1026,144 @@ class ZDO_Conversation(Conversation):
         return matched
 
 
+class Timer_Wheel:
+    """Hierarchical timer wheel.
+    Every slot of the first level covers resolution seconds, every slot of a
+    higher level covers a whole turn of the level below and is spread over
+    that level when its turn comes.  Adding, cancelling and expiring a timer
+    cost O(1) whatever the number of timers."""
+    
+    def __init__(self, resolution = TIMER_WHEEL_RESOLUTION, slots = TIMER_WHEEL_SLOTS, levels = TIMER_WHEEL_LEVELS):
+        self.resolution = resolution
+        self.slots = slots
+        self.levels = levels
+        self.wheels = [[{} for slot in xrange(slots)] for level in xrange(levels)]
+        "Slots of every level, key = timer key, value = (tick, item)"
+        self.overflow = {}
+        "Timers beyond the range of the top level, key = timer key, value = (tick, item)"
+        self.timers = {}
+        "Location of every timer, key = timer key, value = slot dictionary"
+        self.current = int(time.time() / resolution)
+        "Last tick processed"
+
+    def __len__(self):
+        return len(self.timers)
+
+    def add(self, key, deadline, item):
+        "Schedule item to expire at deadline, replacing the timer with the same key"
+        self.cancel(key)
+        tick = max(int(deadline / self.resolution) + 1, self.current + 1)
+        self._place(key, tick, item)
+
+    def cancel(self, key):
+        "Remove a timer, returns False if there was none"
+        slot = self.timers.pop(key, None)
+        if slot is None:
+            return False
+        del slot[key]
+        return True
+
+    def expire(self, now = None):
+        "Advance the wheel to now, returns a list of (key, item) of the timers that expired"
+        if now is None:
+            now = time.time()
+        target = int(now / self.resolution)
+        expired = []
+        while self.current < target:
+            if not self.timers:
+                self.current = target
+                break
+            self.current += 1
+            # spread the higher level slots whose turn starts now, top level first
+            size = self.slots
+            level = 1
+            while level <= self.levels and self.current % size == 0:
+                level += 1
+                size *= self.slots
+            for level in xrange(level - 1, 0, -1):
+                if level == self.levels:
+                    slot = self.overflow
+                    self.overflow = {}
+                else:
+                    index = (self.current // self.slots ** level) % self.slots
+                    slot = self.wheels[level][index]
+                    self.wheels[level][index] = {}
+                for key, (tick, item) in slot.items():
+                    self._place(key, tick, item)
+            index = self.current % self.slots
+            slot = self.wheels[0][index]
+            self.wheels[0][index] = {}
+            for key, (tick, item) in slot.items():
+                del self.timers[key]
+                expired.append((key, item))
+        return expired
+
+    def _place(self, key, tick, item):
+        # use the lowest level whose current turn includes the tick
+        for level in xrange(self.levels):
+            size = self.slots ** (level + 1)
+            if tick // size == self.current // size:
+                slot = self.wheels[level][(tick // self.slots ** level) % self.slots]
+                break
+        else:
+            slot = self.overflow
+        slot[key] = (tick, item)
+        self.timers[key] = slot
+
+
+class Conversation_Manager:
+    """Outstanding conversations of a ZDO/ZCL client.
+    Responses are matched by (address, transaction sequence number) with a
+    single dictionary lookup, a Timer_Wheel drives the timeouts."""
+    
+    def __init__(self):
+        self.conversations = {}
+        "key = (lower case address, transaction sequence number), value = Conversation"
+        self.timers = Timer_Wheel()
+        self.matched = 0
+        "Number of conversations that received their response"
+        self.expired = 0
+        "Number of conversations that timed out"
+
+    def __len__(self):
+        return len(self.conversations)
+
+    def add(self, conversation):
+        "Track a conversation until its response is matched or it times out"
+        key = (conversation.address[0].lower(), conversation.frame.transaction_sequence_number)
+        old_conversation = self.conversations.get(key)
+        if old_conversation is not None:
+            # the sequence number wrapped around, the old response will not be recognized
+            old_conversation.active = False
+        self.conversations[key] = conversation
+        self.timers.add(key, conversation.start_time + conversation.timeout, conversation)
+
+    def match(self, address, transaction_sequence_number):
+        "Remove and return the conversation a response belongs to, None if there is none"
+        key = (address.lower(), transaction_sequence_number)
+        conversation = self.conversations.pop(key, None)
+        if conversation is not None:
+            self.timers.cancel(key)
+            conversation.active = False #terminate one-shot conversation if a match occurs
+            self.matched += 1
+        return conversation
+
+    def tick(self, now = None):
+        "Time out conversations whose response never came"
+        for key, conversation in self.timers.expire(now):
+            del self.conversations[key]
+            self.expired += 1
+            try:
+                conversation.expire()
+            except Exception, e:
+                logger.debug("Error: Conversation_Manager timeout callback: %s" % str(e))
+
+    def statistics(self):
+        "Returns a dictionary with the conversation counters"
+        return {"outstanding": len(self.conversations), "matched": self.matched,
+                "expired": self.expired}
+
+
 class ZDO_Device_annce_cluster_server:
     cluster_id = 0x0013
     #command format:
@@ -732,14 +1196,14 @@ class ZDO_Mgmt_Lqi_cluster_client:
     cluster_id = 0x0031
     
     def __init__(self, xbee = None):
-        self.conversations = []
+        self.conversations = Conversation_Manager()
         self.xbee = xbee
         self.sequence_number = 0
     
     def send_frame(self, frame):
         self.xbee.send_zb(0, frame.address, frame.export())
     
-    def send_command(self, dest_address, start_index, callback = None):
+    def send_command(self, dest_address, start_index, callback = None, timeout_callback = None, timeout = None):
         if callback == None:
             callback = self.default_callback
         frame = ZDO_Frame()
@@ -747,7 +1211,11 @@ class ZDO_Mgmt_Lqi_cluster_client:
         frame.payload = chr(start_index)
         frame.address = (dest_address, 0, 0, self.cluster_id)
         self.send_frame(frame)
-        self.conversations.append(ZDO_Conversation(frame, callback))
+        self.conversations.add(ZDO_Conversation(frame, callback, timeout_callback, timeout))
+
+    def tick(self):
+        "Time out conversations whose response never came"
+        self.conversations.tick()
                                   
     def next_sequence_number(self):
         "Get the next transaction sequence number to use for sending a message."
@@ -757,16 +1225,8 @@ class ZDO_Mgmt_Lqi_cluster_client:
     
     def handle_message(self, frame):
         #print "Received LQI message from %s" % str(source_address)
-        #purge any dead conversations
-        for temp_conversation in self.conversations[:]:
-            if temp_conversation.active == False:
-                self.conversations.remove(temp_conversation)
-        #check all conversations for matches with the frame; if no conversations match raise exception 
-        conversation = None
-        for temp_conversation in self.conversations:
-            if temp_conversation.match_frame(frame):
-                conversation = temp_conversation
-                break
+        #find the conversation of the frame; if no conversations match raise exception 
+        conversation = self.conversations.match(frame.address[0], frame.transaction_sequence_number)
         
         if conversation is not None:
             if conversation.callback is not None:
@@ -806,6 +1266,158 @@ class LQI_aggregator:
         pass
 
 
+class LQI_Crawler:
+    """Breadth-first crawl of the neighbor tables of a mesh.
+    Routers are crawled in the order they are found and only once per crawl.
+    At most max_in_flight requests are outstanding, requests to the same router
+    are spaced by router_interval and requests that time out are retried.
+    Must be used with _global_lock held."""
+    
+    def __init__(self, client_lqi_cluster, callback = None, completion_callback = None):
+        self.client_lqi_cluster = client_lqi_cluster
+        self.callback = callback
+        "Called with (addr_extended, neighbor_table_list) for every router crawled"
+        self.completion_callback = completion_callback
+        "Called with the crawler when there is nothing left to crawl"
+        self.max_in_flight = LQI_CRAWL_IN_FLIGHT
+        self.router_interval = LQI_CRAWL_ROUTER_INTERVAL
+        self.timeout = LQI_CRAWL_TIMEOUT
+        self.retries = LQI_CRAWL_RETRIES
+        self.queue = []
+        "Requests waiting to be sent, [addr_extended, start_index, attempt]"
+        self.in_flight = {}
+        "Outstanding requests, key = lower case address, value = start_index"
+        self.records = {}
+        "Neighbor table pages received so far, key = lower case address"
+        self.seen = {}
+        "Routers queued or crawled during this crawl, key = lower case address"
+        self.next_send = {}
+        "Earliest time of the next request to a router, key = lower case address"
+        self.crawled = 0
+        self.failed = 0
+        self.retried = 0
+        self.start_time = None
+        self.end_time = None
+
+    def start(self, roots = ()):
+        "Start a new crawl from the roots, every router may be crawled again"
+        self.seen = {}
+        self.crawled = 0
+        self.failed = 0
+        self.retried = 0
+        self.start_time = time.time()
+        self.end_time = None
+        for addr_extended in roots:
+            self.add(addr_extended)
+        self.pump()
+
+    def stop(self):
+        "Drop all queued and outstanding requests"
+        self.queue = []
+        self.in_flight = {}
+        self.records = {}
+        if self.running():
+            self.end_time = time.time()
+
+    def running(self):
+        return self.start_time is not None and self.end_time is None
+
+    def add(self, addr_extended):
+        "Queue a router, returns False if it was queued or crawled before during this crawl"
+        key = addr_extended.lower()
+        if key in self.seen:
+            return False
+        self.seen[key] = True
+        if not self.running():
+            # picking up a router found between crawls
+            self.start_time = time.time()
+            self.end_time = None
+        self.records[key] = []
+        self.queue.append([addr_extended, 0, 0])
+        self.pump()
+        return True
+
+    def pump(self):
+        "Send queued requests while the in-flight limit and router pacing allow"
+        now = time.time()
+        index = 0
+        while index < len(self.queue) and len(self.in_flight) < self.max_in_flight:
+            addr_extended, start_index, attempt = self.queue[index]
+            key = addr_extended.lower()
+            if key in self.in_flight or self.next_send.get(key, 0) > now:
+                index += 1
+                continue
+            del self.queue[index]
+            self._send(addr_extended, start_index, attempt)
+        if not self.queue and not self.in_flight and self.running():
+            self.end_time = now
+            self.next_send = {}
+            if self.completion_callback is not None:
+                self.completion_callback(self)
+
+    def statistics(self):
+        "Returns a dictionary with the crawl progress"
+        if self.start_time is None:
+            elapsed = 0
+        else:
+            elapsed = (self.end_time or time.time()) - self.start_time
+        return {"crawled": self.crawled, "failed": self.failed, "retried": self.retried,
+                "in_flight": len(self.in_flight), "queued": len(self.queue),
+                "running": self.running(), "elapsed": elapsed}
+
+    def _send(self, addr_extended, start_index, attempt):
+        key = addr_extended.lower()
+        self.in_flight[key] = start_index
+        self.next_send[key] = time.time() + self.router_interval
+        def response(conversation, frame, lqi_record):
+            self._response(addr_extended, start_index, lqi_record)
+        def timeout(conversation):
+            self._timeout(addr_extended, start_index, attempt)
+        try:
+            self.client_lqi_cluster.send_command(addr_extended, start_index, response, timeout, self.timeout)
+        except Exception, e:
+            logger.debug("Error: LQI_Crawler: %s" % str(e))
+            del self.in_flight[key]
+            self._give_up(addr_extended)
+
+    def _response(self, addr_extended, start_index, lqi_record):
+        key = addr_extended.lower()
+        if self.in_flight.get(key) != start_index:
+            return # the crawl was stopped
+        del self.in_flight[key]
+        if lqi_record.status != 0:
+            self._give_up(addr_extended)
+        else:
+            self.records[key].extend(lqi_record.neighbor_table_list)
+            end_index = lqi_record.start_index + len(lqi_record.neighbor_table_list)
+            if lqi_record.neighbor_table_list and end_index < lqi_record.neighbor_table_entries:
+                # request the next page before moving on to other routers
+                self.queue.insert(0, [addr_extended, end_index, 0])
+            else:
+                self.crawled += 1
+                if self.callback is not None:
+                    self.callback(addr_extended, self.records.pop(key))
+                else:
+                    del self.records[key]
+        self.pump()
+
+    def _timeout(self, addr_extended, start_index, attempt):
+        key = addr_extended.lower()
+        if self.in_flight.get(key) != start_index:
+            return
+        del self.in_flight[key]
+        if attempt < self.retries:
+            self.retried += 1
+            self.queue.insert(0, [addr_extended, start_index, attempt + 1])
+        else:
+            self._give_up(addr_extended)
+        self.pump()
+
+    def _give_up(self, addr_extended):
+        self.failed += 1
+        self.records.pop(addr_extended.lower(), None)
+
+
 class NeighborTableDescriptorRecord:
     def __init__(self,
                  pan_extended = None,
@@ -931,6 +1543,1284 @@ class Device_Annce:
             raise Exception("Error: Device_Annce.extract() - %s" % e)
 
 
+class Topology_Link:
+    "Neighbor table entry of a router: the link from the router to one neighbor"
+    
+    def __init__(self, source, target, record):
+        self.source = source
+        "Lower case extended address of the router reporting the link"
+        self.target = target
+        "Lower case extended address of the neighbor"
+        self.lqi = record.lqi
+        self.depth = record.depth
+        "Depth of the neighbor in the tree"
+        self.relationship = record.relationship
+        "Relationship of the neighbor to the router, see Topology_Graph.PARENT etc."
+        self.device_type = record.device_type
+        "Device type of the neighbor (0 coordinator, 1 router, 2 end device, 3 unknown)"
+
+    def __str__(self):
+        return "<link %s -> %s lqi=%d relationship=%d>" % (self.source, self.target, self.lqi, self.relationship)
+
+
+class Topology_Graph:
+    """Mesh topology built from neighbor tables (LQI responses) and device announces.
+    Every crawled router replaces its own links, the changes are collected so
+    that the difference between two crawls comes without rebuilding the graph.
+    Updates are made with _global_lock held, queries take it themselves."""
+    
+    PARENT = 0
+    CHILD = 1
+    SIBLING = 2
+    NONE = 3
+    PREVIOUS_CHILD = 4
+    device_types = ["coordinator", "router", "end", "unknown"]
+    
+    def __init__(self):
+        self.nodes = {}
+        "key = lower case extended address, value = {'addr_short', 'device_type', 'depth'}"
+        self.links = {}
+        "Links reported by every router, key = router address, value = {neighbor address: Topology_Link}"
+        self.reverse = {}
+        "Routers reporting each neighbor, key = neighbor address, value = {router address: Topology_Link}"
+        self.crawl = 0
+        "Number of the current crawl"
+        self.crawled = {}
+        "Crawl each router's links were last updated in, key = router address"
+        self.changes = []
+        "Changes since begin_crawl, list of (change, link) with change 'add', 'remove' or 'change'"
+        self.last_changes = []
+        "Changes of the last completed crawl"
+        self.hop_cache = None
+
+    def begin_crawl(self):
+        "Start collecting the changes of a new crawl"
+        self.crawl += 1
+        self.changes = []
+
+    def end_crawl(self):
+        "Returns the changes of the crawl, links of routers that did not answer are kept"
+        self.last_changes = self.changes
+        self.changes = []
+        return self.last_changes
+
+    def add_node(self, addr_extended, addr_short, device_type):
+        "Add a node that is known without a neighbor table entry (such as the local XBee)"
+        node = self._node(addr_extended.lower())
+        node["addr_short"] = addr_short
+        node["device_type"] = device_type
+
+    def update_neighbors(self, router, record_list):
+        "Replace the links of a router with its current neighbor table"
+        router = router.lower()
+        self._node(router)
+        self.crawled[router] = self.crawl
+        old_links = self.links.get(router, {})
+        new_links = {}
+        for record in record_list:
+            target = record.addr_extended.lower()
+            link = Topology_Link(router, target, record)
+            new_links[target] = link
+            node = self._node(target)
+            node["addr_short"] = record.addr_short
+            node["device_type"] = record.device_type
+            node["depth"] = record.depth
+            old_link = old_links.get(target)
+            if old_link is None:
+                self.changes.append(("add", link))
+            elif old_link.relationship != link.relationship or\
+                abs(old_link.lqi - link.lqi) >= TOPOLOGY_LQI_CHANGE:
+                self.changes.append(("change", link))
+            self.reverse.setdefault(target, {})[router] = link
+        for target, old_link in old_links.items():
+            if target not in new_links:
+                self.changes.append(("remove", old_link))
+                self._unlink_reverse(old_link)
+        self.links[router] = new_links
+        self.hop_cache = None
+
+    def announce(self, addr_extended, addr_short):
+        """A device (re)joined: forget the routers that had it as a child,
+        its new parent reports it during the next crawl."""
+        addr_extended = addr_extended.lower()
+        self._node(addr_extended)["addr_short"] = addr_short
+        for router, link in self.reverse.get(addr_extended, {}).items():
+            if link.relationship == self.CHILD:
+                del self.links[router][addr_extended]
+                self._unlink_reverse(link)
+                self.changes.append(("remove", link))
+        self.hop_cache = None
+
+    def remove_node(self, addr_extended):
+        "Remove a node and every link to and from it"
+        addr_extended = addr_extended.lower()
+        for link in self.links.pop(addr_extended, {}).values():
+            self._unlink_reverse(link)
+            self.changes.append(("remove", link))
+        for router, link in self.reverse.pop(addr_extended, {}).items():
+            del self.links[router][addr_extended]
+            self.changes.append(("remove", link))
+        self.nodes.pop(addr_extended, None)
+        self.crawled.pop(addr_extended, None)
+        self.hop_cache = None
+
+    def parent(self, addr_extended):
+        "Returns the address of the node's parent, None if unknown"
+        addr_extended = addr_extended.lower()
+        _global_lock.acquire(True)
+        try:
+            for router, link in self.reverse.get(addr_extended, {}).items():
+                if link.relationship == self.CHILD:
+                    return router
+            for target, link in self.links.get(addr_extended, {}).items():
+                if link.relationship == self.PARENT:
+                    return target
+            return None
+        finally:
+            _global_lock.release()
+
+    def children(self, addr_extended):
+        "Returns the addresses of the node's children"
+        addr_extended = addr_extended.lower()
+        _global_lock.acquire(True)
+        try:
+            return self._children(addr_extended)
+        finally:
+            _global_lock.release()
+
+    def weakest_links(self, count = 10):
+        "Returns the count links with the lowest LQI"
+        _global_lock.acquire(True)
+        try:
+            links = []
+            for router_links in self.links.values():
+                links.extend(router_links.values())
+            return heapq.nsmallest(count, links, key = lambda link: link.lqi)
+        finally:
+            _global_lock.release()
+
+    def busiest_routers(self, count = 10):
+        "Returns up to count (address, number of children) of the routers with the most children"
+        _global_lock.acquire(True)
+        try:
+            routers = [(addr_extended, len(self._children(addr_extended))) for addr_extended in self.links]
+            return heapq.nlargest(count, routers, key = lambda router: router[1])
+        finally:
+            _global_lock.release()
+
+    def depth(self, addr_extended):
+        "Returns the tree depth the node's neighbors report for it, None if unknown"
+        _global_lock.acquire(True)
+        try:
+            return self.nodes.get(addr_extended.lower(), {}).get("depth")
+        finally:
+            _global_lock.release()
+
+    def hops(self, addr_extended):
+        "Returns the number of links between the coordinator and the node, None if not connected"
+        _global_lock.acquire(True)
+        try:
+            if self.hop_cache is None:
+                self.hop_cache = self._hop_counts()
+            return self.hop_cache.get(addr_extended.lower())
+        finally:
+            _global_lock.release()
+
+    def to_dict(self):
+        "Returns the graph as a dictionary of node and link lists"
+        _global_lock.acquire(True)
+        try:
+            nodes = []
+            for addr_extended, node in self.nodes.items():
+                nodes.append({"addr_extended": addr_extended,
+                              "addr_short": node["addr_short"],
+                              "type": self.device_types[min(node["device_type"], 3)],
+                              "depth": node["depth"]})
+            links = []
+            for router_links in self.links.values():
+                for link in router_links.values():
+                    links.append({"source": link.source, "target": link.target,
+                                  "lqi": link.lqi, "relationship": link.relationship})
+            return {"nodes": nodes, "links": links}
+        finally:
+            _global_lock.release()
+
+    def to_json(self):
+        "Returns the graph as a JSON document"
+        import json
+        return json.dumps(self.to_dict())
+
+    def to_dot(self):
+        "Returns the graph in Graphviz DOT format, edges labeled with their LQI"
+        graph = self.to_dict()
+        lines = ["digraph mesh {"]
+        for node in graph["nodes"]:
+            lines.append('    "%s" [label="%s\\n%s"];' % (node["addr_extended"], node["addr_extended"], node["type"]))
+        for link in graph["links"]:
+            style = ""
+            if link["relationship"] not in (self.PARENT, self.CHILD):
+                style = ", style=dashed"
+            lines.append('    "%s" -> "%s" [label="%d"%s];' % (link["source"], link["target"], link["lqi"], style))
+        lines.append("}")
+        return "\n".join(lines)
+
+    def _node(self, addr_extended):
+        node = self.nodes.get(addr_extended)
+        if node is None:
+            node = {"addr_short": None, "device_type": 3, "depth": None}
+            self.nodes[addr_extended] = node
+        return node
+
+    def _unlink_reverse(self, link):
+        routers = self.reverse.get(link.target)
+        if routers is not None and routers.get(link.source) is link:
+            del routers[link.source]
+            if not routers:
+                del self.reverse[link.target]
+
+    def _children(self, addr_extended):
+        children = {}
+        for target, link in self.links.get(addr_extended, {}).items():
+            if link.relationship == self.CHILD:
+                children[target] = True
+        for router, link in self.reverse.get(addr_extended, {}).items():
+            if link.relationship == self.PARENT:
+                children[router] = True
+        return children.keys()
+
+    def _hop_counts(self):
+        # breadth-first search over the links, in both directions, from the coordinator
+        roots = [addr_extended for addr_extended, node in self.nodes.items() if node["device_type"] == 0]
+        hops = {}
+        for root in roots:
+            hops[root] = 0
+        frontier = roots
+        while frontier:
+            next_frontier = []
+            for addr_extended in frontier:
+                neighbors = self.links.get(addr_extended, {}).keys() + self.reverse.get(addr_extended, {}).keys()
+                for neighbor in neighbors:
+                    if neighbor not in hops:
+                        hops[neighbor] = hops[addr_extended] + 1
+                        next_frontier.append(neighbor)
+            frontier = next_frontier
+        return hops
+
+
+class Address_Cache:
+    """16-bit network addresses of nodes, learned from received frames, device
+    announces, neighbor tables and discovery, keyed by lower case extended address."""
+    
+    def __init__(self):
+        self.entries = {}
+        "key = lower case extended address, value = 16-bit address"
+        self.owners = {}
+        "key = 16-bit address, value = lower case extended address"
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def learn(self, addr_extended, addr_short):
+        "Remember the 16-bit address (number or address string) of a node"
+        if isinstance(addr_short, str):
+            addr_short = address_string_to_short(addr_short)
+        if addr_short >= 0xFFFE:
+            return # not a network address
+        key = addr_extended.lower()
+        old_short = self.entries.get(key)
+        if old_short == addr_short:
+            return
+        if old_short is not None:
+            # the node changed its address
+            self.invalidate(key)
+        old_owner = self.owners.get(addr_short)
+        if old_owner is not None:
+            # the address was given to another node
+            self.invalidate(old_owner)
+        self.entries[key] = addr_short
+        self.owners[addr_short] = key
+
+    def lookup(self, addr_extended):
+        "Returns the 16-bit address of a node, None if unknown"
+        addr_short = self.entries.get(addr_extended.lower())
+        if addr_short is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return addr_short
+
+    def invalidate(self, addr_extended):
+        "Forget the 16-bit address of a node"
+        key = addr_extended.lower()
+        addr_short = self.entries.pop(key, None)
+        if addr_short is not None:
+            self.invalidations += 1
+            if self.owners.get(addr_short) == key:
+                del self.owners[addr_short]
+
+    def clear(self):
+        self.entries = {}
+        self.owners = {}
+
+    def statistics(self):
+        "Returns a dictionary with the cache counters"
+        return {"entries": len(self.entries), "hits": self.hits, "misses": self.misses,
+                "invalidations": self.invalidations}
+
+
+class Frame_ID_Allocator:
+    """Frame IDs of the messages sent to one XBee that still wait for a response.
+    IDs are released when their response arrives and reaped once they time out,
+    a frame ID is only handed out again when nothing waits on it any more."""
+
+    def __init__(self, window = FRAME_ID_WINDOW, timeout = FRAME_ID_TIMEOUT):
+        self.window = window
+        "Number of frame IDs that may wait for a response (at most 255)"
+        self.timeout = timeout
+        "Seconds after which an unanswered frame ID is reaped"
+        self.outstanding = {}
+        "key = frame ID, value = time the frame ID is reaped"
+        self.responses = {}
+        "API ID of the response expected for an outstanding frame ID, key = frame ID"
+        self.held = {}
+        "Frame IDs kept outstanding until they are reaped, whatever responses arrive"
+        self.last_id = 0
+        self.allocated = 0
+        self.released = 0
+        self.reaped = 0
+        self.collisions = 0
+        "Frame IDs handed out again while their response was still outstanding"
+        self.unmatched = 0
+        "Responses whose frame ID was not outstanding (late or duplicate responses)"
+        self.waits = 0
+        "Number of times a sender waited for the window to open"
+
+    def available(self):
+        "True when another frame ID can be handed out without a collision"
+        return len(self.outstanding) < min(self.window, 0xFF)
+
+    def allocate(self, now = None, response_id = None):
+        """Returns the next frame ID without an outstanding response.
+        Only a response with API ID response_id (any response when None) releases it.
+        With the window full the ID closest to being reaped is recycled."""
+        if now is None:
+            now = time.time()
+        if not self.available():
+            # held frame IDs still get responses, recycle them last
+            candidates = [frame_id for frame_id in self.outstanding if frame_id not in self.held] or self.outstanding.keys()
+            oldest = min(candidates, key = self.outstanding.get)
+            self._forget(oldest)
+            self.collisions += 1
+        frame_id = self.last_id
+        while 1:
+            frame_id = frame_id % 0xFF + 1
+            if frame_id not in self.outstanding:
+                break
+        self.last_id = frame_id
+        self.outstanding[frame_id] = now + self.timeout
+        if response_id is not None:
+            self.responses[frame_id] = response_id
+        self.allocated += 1
+        return frame_id
+
+    def release(self, frame_id, response_id = None):
+        """Mark the response to frame_id as received, returns False if it was not outstanding.
+        A response of another API ID than the one expected (such as the answer to a
+        frame whose ID was not handed out here) leaves the frame ID outstanding."""
+        if frame_id in self.held:
+            return False
+        expected = self.responses.get(frame_id)
+        if frame_id not in self.outstanding or\
+            (response_id is not None and expected is not None and expected != response_id):
+            self.unmatched += 1
+            return False
+        self._forget(frame_id)
+        self.released += 1
+        return True
+
+    def hold(self, frame_id, until):
+        "Keep frame_id outstanding until the time until, responses still arriving on it do not release it"
+        self.outstanding[frame_id] = until
+        self.held[frame_id] = True
+
+    def _forget(self, frame_id):
+        del self.outstanding[frame_id]
+        self.responses.pop(frame_id, None)
+        self.held.pop(frame_id, None)
+
+    def reap(self, now = None):
+        "Forget the frame IDs whose response did not come in time, returns how many were reaped"
+        if now is None:
+            now = time.time()
+        expired = [frame_id for frame_id, deadline in self.outstanding.items() if deadline <= now]
+        for frame_id in expired:
+            self._forget(frame_id)
+        self.reaped += len(expired)
+        return len(expired)
+
+    def clear(self):
+        self.outstanding = {}
+        self.responses = {}
+        self.held = {}
+
+    def statistics(self):
+        "Returns a dictionary with the allocator counters"
+        return {"in_flight": len(self.outstanding), "window": self.window, "allocated": self.allocated,
+                "released": self.released, "reaped": self.reaped, "collisions": self.collisions,
+                "unmatched": self.unmatched, "waits": self.waits}
+
+
+class Frame_Writer:
+    """Writes the frames sent to an XBee from a thread of its own (see XBee.start_writer).
+    Frames are queued as exported bytes and written with as few write calls as
+    possible.  Senders only wait while TX_QUEUE_MAX bytes are queued, which
+    happens when the XBee holds CTS low for a while."""
+
+    def __init__(self, xbee):
+        self.xbee = xbee
+        self.thread = None
+        "Thread writing to the serial port, None when frames are written by the senders"
+        self.serial_port = None
+        "Serial port the writer thread writes to"
+        self.condition = threading.Condition(threading.Lock())
+        "Protects the queue, never held together with _global_lock by the writer thread"
+        self.pending = bytearray()
+        "Exported frames waiting to be written"
+        self.pending_frames = 0
+        self.first_queued = 0
+        "Time the oldest pending frame was queued"
+        self.blocked = 0
+        "Number of senders waiting for room in the queue"
+        self.writes = 0
+        self.frames = 0
+        self.bytes = 0
+        self.errors = 0
+        self.dropped = 0
+        "Frames lost to write errors"
+        self.cts_waits = 0
+        self.backpressure = 0
+        "Number of times a sender waited for room in the queue"
+        self.max_depth = 0
+        "Largest number of bytes queued"
+        self.latency_total = 0
+        self.latency_max = 0
+        "Longest time in seconds between queuing a frame and the end of its write"
+        self.write_time_max = 0
+        "Longest time in seconds a single write call took"
+
+    def active(self):
+        "True while the writer thread owns the serial port"
+        thread = self.thread
+        return thread is not None and thread.isAlive()
+
+    def start(self, serial_port):
+        if self.active():
+            if self.serial_port is serial_port:
+                return
+            self.stop() # still bound to a port that was closed or replaced
+        self.serial_port = serial_port
+        self.thread = threading.Thread(target = self._run, args = (serial_port,))
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def stop(self):
+        "Let the writer thread exit, queued frames are dropped"
+        self.condition.acquire()
+        try:
+            self.thread = None
+            self.pending = bytearray()
+            self.pending_frames = 0
+            self.condition.notifyAll()
+        finally:
+            self.condition.release()
+
+    def wait_for_room(self):
+        """Wait while the queue is full (except on the reader thread).  Returns True
+        when the frame should be queued, False when it must be written directly
+        (no writer thread).  Caller must hold _global_lock, which is released while waiting."""
+        if not self.active():
+            return False
+        if len(self.pending) >= TX_QUEUE_MAX and threading.currentThread() is not self.xbee.reader:
+            # the reader thread never waits, it has to keep delivering frames
+            self.backpressure += 1
+            self.blocked += 1
+            try:
+                while len(self.pending) >= TX_QUEUE_MAX and self.active():
+                    # the writer notifies rx_condition after each write while senders wait
+                    self.xbee.rx_condition.wait(READER_TIMEOUT)
+            finally:
+                self.blocked -= 1
+        return self.active()
+
+    def queue(self, data):
+        "Queue the bytes of an exported frame"
+        self.condition.acquire()
+        try:
+            if not self.pending:
+                self.first_queued = time.time()
+            self.pending += data
+            self.pending_frames += 1
+            if len(self.pending) > self.max_depth:
+                self.max_depth = len(self.pending)
+            self.condition.notify()
+        finally:
+            self.condition.release()
+
+    def _cts_low(self, serial_port):
+        "True when hardware flow control is on and the XBee cannot take more data"
+        if not getattr(serial_port, "rtscts", False):
+            return False
+        try:
+            return not serial_port.getCTS()
+        except Exception:
+            return False
+
+    def _run(self, serial_port):
+        "Body of the writer thread, runs until the serial port is closed or replaced"
+        me = threading.currentThread()
+        while self.thread is me and self.xbee.serial is serial_port:
+            self.condition.acquire()
+            try:
+                while self.thread is me and self.xbee.serial is serial_port and \
+                      (not self.pending or self._cts_low(serial_port)):
+                    if self.pending:
+                        # keep collecting frames until the XBee raises CTS
+                        self.cts_waits += 1
+                        self.condition.wait(TX_CTS_POLL)
+                    else:
+                        self.condition.wait(READER_TIMEOUT)
+                if self.thread is not me or self.xbee.serial is not serial_port:
+                    break
+                data, self.pending = self.pending, bytearray()
+                frames, self.pending_frames = self.pending_frames, 0
+                first_queued = self.first_queued
+            finally:
+                self.condition.release()
+            start = time.time()
+            try:
+                serial_port.write(data)
+            except Exception, e:
+                if self.thread is me:
+                    logger.warning("XBee writer thread dropped %d frames: %s" % (frames, str(e)))
+                self.errors += 1
+                self.dropped += frames
+            else:
+                now = time.time()
+                self.writes += 1
+                self.frames += frames
+                self.bytes += len(data)
+                self.write_time_max = max(self.write_time_max, now - start)
+                latency = now - first_queued
+                self.latency_total += latency * frames
+                self.latency_max = max(self.latency_max, latency)
+            if self.blocked:
+                _global_lock.acquire(True)
+                try:
+                    self.xbee.rx_condition.notifyAll()
+                finally:
+                    _global_lock.release()
+
+    def statistics(self):
+        "Returns a dictionary with the queue depth and write counters"
+        latency_average = 0
+        if self.frames:
+            latency_average = self.latency_total / self.frames
+        return {"active": self.active(), "depth": len(self.pending), "depth_frames": self.pending_frames,
+                "max_depth": self.max_depth, "writes": self.writes, "frames": self.frames,
+                "bytes": self.bytes, "errors": self.errors, "dropped": self.dropped,
+                "cts_waits": self.cts_waits, "backpressure": self.backpressure,
+                "latency_average": latency_average, "latency_max": self.latency_max,
+                "write_time_max": self.write_time_max}
+
+
+class Fragmented_Message:
+    "A message queued in a Fragment_Sender"
+    
+    def __init__(self, message_id, source_endpoint, destination_address, window, future, remaining):
+        self.message_id = message_id
+        self.source_endpoint = source_endpoint
+        self.destination_address = destination_address
+        self.window = window
+        "Number of fragments that may wait for their Tx Status"
+        self.failed = False
+        "Set when a fragment failed more than FRAGMENT_RETRIES times"
+        self.future = future
+        "Tx_Future resolved once every fragment was delivered or the message failed"
+        self.remaining = remaining
+        "Number of fragments not confirmed by a Tx Status yet"
+
+
+class Fragment_Sender:
+    """Sends messages larger than one frame as numbered fragments (see FRAGMENT_HEADER),
+    keeping up to the message's window of fragments waiting for their Tx Status.
+    Failed fragments are sent again up to FRAGMENT_RETRIES times.
+    Used with _global_lock held."""
+    
+    def __init__(self, xbee):
+        self.xbee = xbee
+        self.queue = []
+        "Fragments waiting to be sent, [message, index, payload, tries]"
+        self.in_flight = {}
+        "Fragments waiting for their Tx Status, key = XBee frame ID, value = (fragment, deadline)"
+        self.next_message_id = 0
+        self.messages = 0
+        self.fragments = 0
+        self.retries = 0
+        self.failures = 0
+
+    def send(self, source_endpoint, destination_address, payload, fragment_size, window = FRAGMENT_WINDOW):
+        """Queue payload as fragments of at most fragment_size bytes (header included).
+        Returns a Tx_Future resolved once every fragment was delivered or the message failed."""
+        data_size = fragment_size - FRAGMENT_HEADER_SIZE
+        count = max(1, (len(payload) + data_size - 1) // data_size)
+        if count > 0xFF:
+            raise Exception("error: message too long, %d bytes (at most %d)" % (len(payload), 0xFF * data_size))
+        self.next_message_id = (self.next_message_id + 1) & 0xFF
+        future = Tx_Future(self.xbee, destination_address, None)
+        message = Fragmented_Message(self.next_message_id, source_endpoint, destination_address, max(1, window),
+                                     future, count)
+        view = memoryview(payload)
+        for index in xrange(count):
+            header = struct.pack(FRAGMENT_HEADER, message.message_id, index, count)
+            self.queue.append([message, index, [header, view[index * data_size:(index + 1) * data_size]], 0])
+        self.messages += 1
+        self.pump()
+        return future
+
+    def pump(self, now = None):
+        "Send queued fragments while the window allows, fail fragments whose Tx Status never came"
+        if now is None:
+            now = time.time()
+        for frame_id, (fragment, deadline) in self.in_flight.items():
+            if deadline <= now:
+                del self.in_flight[frame_id]
+                self.xbee.tx_callbacks.pop(frame_id, None)
+                self._failed(fragment, None)
+        while self.queue and len(self.in_flight) < self.queue[0][0].window:
+            fragment = self.queue.pop(0)
+            message = fragment[0]
+            frame_id = self.xbee.send_zb(message.source_endpoint, message.destination_address,
+                                         fragment[2], self._tx_status)
+            self.fragments += 1
+            if frame_id is None: # local messages have no Tx Status
+                self._delivered(fragment, None)
+            else:
+                self.in_flight[frame_id] = (fragment, now + FRAGMENT_TX_TIMEOUT)
+
+    def _tx_status(self, status_data):
+        entry = self.in_flight.pop(status_data.frame_id, None)
+        if entry is None:
+            return
+        if status_data.delivery_status != ZigBee_Tx_Status_Data.SUCCESS:
+            self._failed(entry[0], status_data)
+        else:
+            self._delivered(entry[0], status_data)
+        self.pump()
+
+    def _delivered(self, fragment, status_data):
+        message = fragment[0]
+        if message.failed:
+            return
+        future = message.future
+        if status_data is not None and isinstance(status_data, ZigBee_Tx_Status_Data):
+            future.transmit_retry_count += status_data.transmit_retry_count
+            future.discovery_status = status_data.discovery_status
+            future.remote_network_address = status_data.remote_network_address
+        message.remaining -= 1
+        if not message.remaining:
+            future.delivery_status = ZigBee_Tx_Status_Data.SUCCESS
+            future._complete(None)
+
+    def _failed(self, fragment, status_data):
+        "A fragment was not delivered (status_data is None when its Tx Status never came)"
+        message, index, payload, tries = fragment
+        if message.failed:
+            return
+        if tries < FRAGMENT_RETRIES:
+            self.retries += 1
+            self.queue.insert(0, [message, index, payload, tries + 1])
+        else:
+            # the receiver cannot put the message together any more
+            message.failed = True
+            self.failures += 1
+            self.queue = [other for other in self.queue if other[0] is not message]
+            logger.warning("fragmented message to %s failed" % str(message.destination_address[0]))
+            if status_data is None:
+                message.future._complete(Exception("fragmented message to %s failed: no Tx Status" % str(message.destination_address[0])))
+            else:
+                message.future.delivery_status = status_data.delivery_status
+                message.future._complete(None)
+
+    def statistics(self):
+        "Returns a dictionary with the sender counters"
+        return {"messages": self.messages, "fragments": self.fragments, "retries": self.retries,
+                "failures": self.failures, "queued": len(self.queue), "in_flight": len(self.in_flight)}
+
+
+class Fragment_Reassembler:
+    """Puts the fragments sent by a Fragment_Sender back together for one endpoint.
+    Partial messages are dropped FRAGMENT_REASSEMBLY_TIMEOUT seconds after their
+    last fragment, and the oldest are dropped when a source has more than
+    FRAGMENT_SOURCE_MAX partial messages or all of them hold more than
+    FRAGMENT_BUFFER_MAX bytes.  Used with _global_lock held."""
+    
+    def __init__(self):
+        self.partial = {}
+        "key = (source address, source endpoint, message ID), value = [deadline, count, {index: data}, size]"
+        self.size = 0
+        "Bytes held by the partial messages"
+        self.completed = 0
+        self.expired = 0
+        self.dropped = 0
+
+    def add(self, payload, address, now = None):
+        "Add a received fragment, returns the payload of the message it completes (None otherwise)"
+        if now is None:
+            now = time.time()
+        if len(payload) < FRAGMENT_HEADER_SIZE:
+            self.dropped += 1
+            return None
+        message_id, index, count = struct.unpack_from(FRAGMENT_HEADER, payload)
+        data = payload[FRAGMENT_HEADER_SIZE:]
+        if index >= count:
+            self.dropped += 1
+            return None
+        if count == 1:
+            self.completed += 1
+            return data
+        source = (address[0].lower(), address[1])
+        key = source + (message_id,)
+        entry = self.partial.get(key)
+        if entry is not None and entry[1] != count:
+            # the message ID was reused, the old message is incomplete
+            self._remove(key)
+            self.dropped += 1
+            entry = None
+        if entry is None:
+            entry = self.partial[key] = [0, count, {}, 0]
+        entry[0] = now + FRAGMENT_REASSEMBLY_TIMEOUT
+        if index not in entry[2]: # repeated fragments are ignored
+            entry[2][index] = data
+            entry[3] += len(data)
+            self.size += len(data)
+        if len(entry[2]) == count:
+            self._remove(key)
+            self.completed += 1
+            return "".join([entry[2][i] for i in xrange(count)])
+        # keep within the limits, dropping the oldest partial messages
+        while len([other for other in self.partial if other[:2] == source]) > FRAGMENT_SOURCE_MAX:
+            self._drop_oldest(source)
+        while self.size > FRAGMENT_BUFFER_MAX:
+            self._drop_oldest()
+        return None
+
+    def expire(self, now):
+        "Drop the partial messages whose fragments stopped coming"
+        for key, entry in self.partial.items():
+            if entry[0] <= now:
+                self._remove(key)
+                self.expired += 1
+
+    def _drop_oldest(self, source = None):
+        keys = [key for key in self.partial if source is None or key[:2] == source]
+        self._remove(min(keys, key = lambda key: self.partial[key][0]))
+        self.dropped += 1
+
+    def _remove(self, key):
+        entry = self.partial.pop(key)
+        self.size -= entry[3]
+
+
+class DDO_Cache:
+    """Least recently used cache of DDO parameter values read from the local
+    and remote XBees, keyed by (destination, parameter).  Each parameter has
+    its own time to live, see DDO_CACHE_TTL."""
+
+    def __init__(self, ttl = None, max_entries = DDO_CACHE_SIZE):
+        if ttl is None:
+            ttl = DDO_CACHE_TTL.copy()
+        self.ttl = ttl
+        "Time to live per upper case parameter name, only these parameters are cached"
+        self.max_entries = max_entries
+        self.entries = {}
+        "key = (destination, parameter), value = [value, time stored, last use]"
+        self.use_count = 0
+        "Incremented on every use, orders the entries for LRU eviction"
+        self.writes = 0
+        "Incremented by every invalidate and clear, GETs remember it when they are submitted"
+        self.written = {}
+        "Value of writes at the last invalidate, key = (destination, parameter) or destination"
+        self.cleared = 0
+        "Value of writes at the last clear"
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def cacheable(self, id):
+        "True if values of parameter id are kept in the cache"
+        return id.upper() in self.ttl
+
+    def get(self, destination, id, max_age = None):
+        """Returns the cached value or None when missing or older than max_age
+        seconds (the parameter's time to live when max_age is None)"""
+        id = id.upper()
+        entry = self.entries.get((destination, id))
+        if max_age is None:
+            max_age = self.ttl.get(id)
+        if entry is None or (max_age is not None and time.time() - entry[1] > max_age):
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.use_count += 1
+        entry[2] = self.use_count
+        return entry[0]
+
+    def put(self, destination, id, value, since = None):
+        """Store a value read from a node.  since is the value of writes when the
+        GET was submitted, the value is dropped if the parameter was written
+        (or the cache cleared) after that."""
+        id = id.upper()
+        if id not in self.ttl:
+            return
+        key = (destination, id)
+        if since is not None and max(self.cleared, self.written.get(key, 0),
+                                     self.written.get(destination, 0)) > since:
+            return
+        if key not in self.entries and len(self.entries) >= self.max_entries:
+            # evict the least recently used entry
+            oldest = min(self.entries.items(), key = lambda item: item[1][2])[0]
+            del self.entries[oldest]
+            self.evictions += 1
+        self.use_count += 1
+        self.entries[key] = [value, time.time(), self.use_count]
+
+    def invalidate(self, destination, id = None):
+        "Forget parameter id of a destination, or all of its parameters when id is None"
+        self.writes += 1
+        if id is not None:
+            self.entries.pop((destination, id.upper()), None)
+            self.written[(destination, id.upper())] = self.writes
+        else:
+            self.written[destination] = self.writes
+            for key in self.entries.keys():
+                if key[0] == destination:
+                    del self.entries[key]
+
+    def clear(self):
+        "Forget every cached value"
+        self.entries = {}
+        self.writes += 1
+        self.cleared = self.writes
+        self.written = {}
+
+    def statistics(self):
+        "Returns a dictionary with the cache counters"
+        return {"entries": len(self.entries), "hits": self.hits,
+                "misses": self.misses, "evictions": self.evictions}
+
+
+class DDO_Future:
+    """Pending result of an asynchronous DDO request (see XBee.ddo_get_param_async).
+    Resolved when the AT response carrying the request's frame ID arrives,
+    or with a timeout exception once the request's timeout has passed."""
+    GET = "get"
+    SET = "set"
+    COMMAND = "command"
+
+    def __init__(self, xbee, kind, addr_extended, id, message, timeout, force_com = False):
+        self.xbee = xbee
+        "XBee the request was sent through"
+        self.kind = kind
+        "GET, SET or COMMAND"
+        self.addr_extended = addr_extended
+        "Destination of the request, None for the local XBee"
+        if addr_extended is None:
+            self.destination = None
+        else:
+            self.destination = address_string_to_MAC(addr_extended)
+        "Destination as a 64-bit integer, used to limit requests per node"
+        self.id = id
+        "Two character AT command"
+        self.message = message
+        "API message carrying the AT command"
+        self.timeout = timeout
+        "Seconds to wait for the response once the request is sent"
+        self.force_com = force_com
+        self.frame_id = 0
+        "XBee frame ID, set when the request is sent"
+        self.deadline = None
+        "Time the request expires, set when the request is submitted (queued requests expire too)"
+        self.cache_writes = None
+        "DDO_Cache.writes when a GET was submitted, see DDO_Cache.put"
+        self.status = None
+        "AT response status, None until a response has been received"
+        self.value = None
+        self.exception = None
+        self.finished = False
+        self.callbacks = []
+
+    def timeout_message(self):
+        "Error text for a request that was not answered in time"
+        if self.kind == self.GET:
+            text = "ddo_get_param: timeout fetching DDO parameter (%s@%s)."
+        elif self.kind == self.SET:
+            text = "ddo_set_param: timeout setting DDO parameter (%s@%s)."
+        else:
+            text = "ddo_command: timeout performing DDO command (%s@%s)."
+        return text % (str(self.id), str(self.addr_extended))
+
+    def done(self):
+        "True once the request has a result or an exception"
+        return self.finished
+
+    def add_done_callback(self, callback):
+        """Call callback(future) once the request has finished.
+        Callbacks run on the thread resolving the request, with _global_lock held."""
+        _global_lock.acquire(True)
+        try:
+            if not self.finished:
+                self.callbacks.append(callback)
+                return
+        finally:
+            _global_lock.release()
+        callback(self)
+
+    def result(self, timeout = None):
+        """Wait for the request to finish and return its value.
+        Raises the exception of a failed or timed out request."""
+        _global_lock.acquire(True)
+        try:
+            if timeout is not None:
+                deadline = time.time() + timeout
+            while not self.finished:
+                wait_time = READER_TIMEOUT
+                if timeout is not None:
+                    wait_time = min(wait_time, deadline - time.time())
+                    if wait_time <= 0:
+                        raise Exception("DDO_Future.result: timeout waiting for %s@%s" % (str(self.id), str(self.addr_extended)))
+                self.xbee._wait_for_frames(wait_time, self.force_com)
+            if self.exception is not None:
+                raise self.exception
+            return self.value
+        finally:
+            _global_lock.release()
+
+    def _complete(self, message, exception):
+        "Store the outcome of the request and run the callbacks"
+        if message is not None:
+            at_data = message.api_data
+            self.status = at_data.status
+            if self.kind == self.GET:
+                self.value = at_data.value
+            elif at_data.status != 0:
+                if self.kind == self.SET:
+                    exception = Exception("ddo_set_param: error setting DDO parameter (%s@%s)." % (str(self.id), str(self.addr_extended)))
+                else:
+                    exception = Exception("ddo_command: error performing DDO command (%s@%s)." % (str(self.id), str(self.addr_extended)))
+            elif self.kind == self.SET:
+                self.value = True
+            elif len(at_data.value):
+                self.value = at_data.value
+        self.exception = exception
+        self.finished = True
+        callbacks, self.callbacks = self.callbacks, []
+        for callback in callbacks:
+            try:
+                callback(self)
+            except Exception, e:
+                logger.warning("exception in DDO callback: %s" % str(e))
+
+
+class Tx_Future:
+    """Pending delivery result of a message sent with XBee.send_zb_async.
+    Resolved when the Tx Status carrying the message's frame ID arrives,
+    or with a timeout exception once the future's timeout has passed.
+    XBee.send_fragmented resolves it once every fragment was delivered
+    (transmit_retry_count then adds up the retries of all fragments)."""
+
+    def __init__(self, xbee, destination_address, timeout):
+        self.xbee = xbee
+        "XBee the message was sent through"
+        self.destination_address = destination_address
+        self.timeout = timeout
+        "Seconds to wait for the Tx Status once the message is sent"
+        self.frame_id = None
+        "XBee frame ID, None for local messages (they have no Tx Status)"
+        self.deadline = None
+        "Time the future expires, set when the message is sent"
+        self.delivery_status = None
+        "Delivery status from the Tx Status (ZigBee_Tx_Status_Data.SUCCESS), None until it arrived"
+        self.transmit_retry_count = 0
+        "Number of retries the XBee needed (ZigBee firmware only)"
+        self.discovery_status = None
+        "Address or route discovery overhead of the transmission (ZigBee firmware only)"
+        self.remote_network_address = None
+        "16-bit address the message was delivered to (ZigBee firmware only)"
+        self.exception = None
+        self.finished = False
+        self.callbacks = []
+
+    def done(self):
+        "True once the Tx Status arrived or the future timed out"
+        return self.finished
+
+    def delivered(self):
+        "True once the XBee reported the message as delivered"
+        return self.finished and self.delivery_status == ZigBee_Tx_Status_Data.SUCCESS
+
+    def add_done_callback(self, callback):
+        """Call callback(future) once the future has finished.
+        Callbacks run on the thread resolving the future, with _global_lock held."""
+        _global_lock.acquire(True)
+        try:
+            if not self.finished:
+                self.callbacks.append(callback)
+                return
+        finally:
+            _global_lock.release()
+        callback(self)
+
+    def result(self, timeout = None):
+        """Wait for the Tx Status and return its delivery status.
+        Raises the exception of a message whose Tx Status never came."""
+        _global_lock.acquire(True)
+        try:
+            if timeout is not None:
+                deadline = time.time() + timeout
+            while not self.finished:
+                wait_time = READER_TIMEOUT
+                if timeout is not None:
+                    wait_time = min(wait_time, deadline - time.time())
+                    if wait_time <= 0:
+                        raise Exception("Tx_Future.result: timeout waiting for the Tx Status of frame %s" % str(self.frame_id))
+                self.xbee._wait_for_frames(wait_time)
+            if self.exception is not None:
+                raise self.exception
+            return self.delivery_status
+        finally:
+            _global_lock.release()
+
+    def _tx_status(self, status_data):
+        "tx_callback of the message, stores the Tx Status"
+        if self.xbee.tx_futures.get(status_data.frame_id) is self:
+            del self.xbee.tx_futures[status_data.frame_id]
+        self.delivery_status = status_data.delivery_status
+        if isinstance(status_data, ZigBee_Tx_Status_Data):
+            self.transmit_retry_count = status_data.transmit_retry_count
+            self.discovery_status = status_data.discovery_status
+            self.remote_network_address = status_data.remote_network_address
+        self._complete(None)
+
+    def _complete(self, exception):
+        "Store the outcome of the transmission and run the callbacks"
+        self.exception = exception
+        self.finished = True
+        callbacks, self.callbacks = self.callbacks, []
+        for callback in callbacks:
+            try:
+                callback(self)
+            except Exception, e:
+                logger.warning("exception in Tx callback: %s" % str(e))
+
+
+class Node_Table:
+    """Registry of the nodes known to an XBee.
+    Nodes are indexed by extended and short address.  The node sequence is
+    replaced rather than modified, so snapshot() can hand it out without copying.
+    Modifications are made with _global_lock held."""
+    
+    UNKNOWN_SHORT = "[fffe]!"
+    
+    def __init__(self):
+        self.nodes = ()
+        "Tuple of nodes in discovery order"
+        self.by_extended = {}
+        "Index of nodes, key = lower case extended address, value = Node"
+        self.by_short = {}
+        "Index of nodes, key = lower case short address, value = Node"
+
+    def __len__(self):
+        return len(self.nodes)
+
+    def snapshot(self):
+        "Return the current nodes as a tuple"
+        return self.nodes
+
+    def get(self, addr_extended):
+        "Return the node with the extended address, None if unknown"
+        return self.by_extended.get(addr_extended.lower())
+
+    def get_short(self, addr_short):
+        "Return the node with the short address, None if unknown"
+        return self.by_short.get(addr_short.lower())
+
+    def add(self, node):
+        "Add a node, replacing a node with the same extended address"
+        key = node.addr_extended.lower()
+        old_node = self.by_extended.get(key)
+        if old_node is not None:
+            self._unindex_short(old_node)
+            nodes = list(self.nodes)
+            nodes[nodes.index(old_node)] = node
+            self.nodes = tuple(nodes)
+        else:
+            self.nodes = self.nodes + (node,)
+        self.by_extended[key] = node
+        self._index_short(node)
+
+    def set_short_address(self, node, addr_short):
+        "Change the short address of a node and its index entry together"
+        if node.addr_short == addr_short:
+            return
+        self._unindex_short(node)
+        node.addr_short = addr_short
+        self._index_short(node)
+
+    def remove(self, node):
+        "Remove a node from the table"
+        key = node.addr_extended.lower()
+        if self.by_extended.get(key) is not node:
+            return
+        del self.by_extended[key]
+        self._unindex_short(node)
+        self.nodes = tuple([other for other in self.nodes if other is not node])
+
+    def truncate(self, count):
+        "Remove all but the first count nodes"
+        for node in self.nodes[count:]:
+            self._unindex_short(node)
+            del self.by_extended[node.addr_extended.lower()]
+        self.nodes = self.nodes[:count]
+
+    def clear(self):
+        self.nodes = ()
+        self.by_extended = {}
+        self.by_short = {}
+
+    def _index_short(self, node):
+        if node.addr_short and node.addr_short.lower() != self.UNKNOWN_SHORT:
+            # short addresses are reassigned after conflicts, the newest owner wins
+            self.by_short[node.addr_short.lower()] = node
+
+    def _unindex_short(self, node):
+        if node.addr_short and self.by_short.get(node.addr_short.lower()) is node:
+            del self.by_short[node.addr_short.lower()]
+
+
+class Node_Store:
+    """sqlite database of the nodes known to an XBee, so the node table
+    survives restarts.  Changes are collected and written back in batches
+    by flush()."""
+    
+    def __init__(self, filename = NODE_STORE_FILE):
+        self.filename = filename
+        self.connection = None
+        self.info = {}
+        "Values only kept in the store, key = lower case address, value = {'product_type', 'last_seen', 'lqi'}"
+        self.dirty = {}
+        "Nodes to write on the next flush, key = lower case address"
+        self.removed = {}
+        "Nodes to delete on the next flush, key = lower case address"
+        self.next_flush = 0
+        "Time of the next flush done by XBee._housekeeping"
+        self.writing = None
+        "Thread writing the rows of a background flush"
+
+    def open(self):
+        "Open the database (creating it if needed), returns False if sqlite3 is not available"
+        if sqlite3 is None:
+            return False
+        self.connection = sqlite3.connect(self.filename, check_same_thread = False)
+        self.connection.execute("CREATE TABLE IF NOT EXISTS nodes (addr_extended TEXT PRIMARY KEY, "
+                                "addr_short TEXT, addr_parent TEXT, type TEXT, label TEXT, "
+                                "product_type INTEGER, last_seen REAL, lqi INTEGER)")
+        self.connection.commit()
+        return True
+
+    def close(self):
+        if self.writing is not None:
+            self.writing.join()
+            self.writing = None
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+
+    def load(self):
+        "Returns the stored nodes as a list of Node"
+        nodes = []
+        cursor = self.connection.execute("SELECT addr_extended, addr_short, addr_parent, type, label, "
+                                         "product_type, last_seen, lqi FROM nodes")
+        for addr_extended, addr_short, addr_parent, type, label, product_type, last_seen, lqi in cursor:
+            if label is not None:
+                label = str(label)
+            if addr_short is None:
+                addr_short = Node_Table.UNKNOWN_SHORT
+            if addr_parent is not None:
+                addr_parent = str(addr_parent)
+            if type is not None:
+                type = str(type)
+            node = Node(type, str(addr_extended), str(addr_short), addr_parent, label = label)
+            node.last_seen = last_seen
+            nodes.append(node)
+            self.info[addr_extended.lower()] = {"product_type": product_type, "last_seen": last_seen, "lqi": lqi}
+        return nodes
+
+    def update(self, addr_extended, **info):
+        "Write the node on the next flush, info may update product_type, last_seen and lqi"
+        key = addr_extended.lower()
+        if info:
+            self.info.setdefault(key, {}).update(info)
+        self.dirty[key] = True
+        self.removed.pop(key, None)
+
+    def remove(self, addr_extended):
+        "Delete the node on the next flush"
+        key = addr_extended.lower()
+        self.removed[key] = True
+        self.dirty.pop(key, None)
+        self.info.pop(key, None)
+
+    def flush(self, node_table, background = False):
+        """Write the changes to the database in one transaction.
+        With background set the rows are collected now (with _global_lock held)
+        and written by a thread of its own, so the disk write does not hold up
+        frame delivery; while such a write runs the changes wait for the next flush."""
+        if self.connection is None or (not self.dirty and not self.removed):
+            return
+        if self.writing is not None and self.writing.isAlive():
+            if background:
+                return
+            self.writing.join()
+        rows = []
+        for key in self.dirty:
+            node = node_table.get(key)
+            if node is None:
+                continue
+            addr_parent = node.addr_parent
+            if isinstance(addr_parent, int):
+                addr_parent = short_to_address_string(addr_parent)
+            info = self.info.get(key, {})
+            rows.append((key, node.addr_short, addr_parent, node.type, node.label,
+                         info.get("product_type"), info.get("last_seen"), info.get("lqi")))
+        removed = [(key,) for key in self.removed]
+        self.dirty = {}
+        self.removed = {}
+        if background:
+            self.writing = threading.Thread(target = self._write, args = (rows, removed))
+            self.writing.setDaemon(True)
+            self.writing.start()
+        else:
+            self._write(rows, removed)
+
+    def _write(self, rows, removed):
+        try:
+            self.connection.executemany("INSERT OR REPLACE INTO nodes VALUES (?, ?, ?, ?, ?, ?, ?, ?)", rows)
+            self.connection.executemany("DELETE FROM nodes WHERE addr_extended = ?", removed)
+            self.connection.commit()
+        except sqlite3.Error, e:
+            logger.warning("unable to write the node store %s: %s" % (self.filename, e))
+
+
 class XBee:
     "Handles the connection to an XBee module"
     DIGI_PROFILE_ID = 0xC105
@@ -938,24 +2828,101 @@ class XBee:
     device_types = ["coordinator", "router", "end"]
     
     def __init__(self, serial = None):
-        # mutual exclusion lock:
-        global _global_lock
-        _global_lock = RLock()
         "Creates the connection to the XBee using the serial port."
         self.serial = serial
         "Serial port that connects to the xbee"
         self.rx_messages = {}
         "Messages received from the XBee. Key = endpoint_id, value = (payload, full_source_address)"
-        self.rx_buffer = ""
-        "Receive buffer for the serial port"
-        self.node_list = []
-        "Node list for the get_node_list function"
+        self.endpoint_wakeups = {}
+        "Readiness fds of XBee sockets, set while messages are queued, key = endpoint_id, value = Select_Wakeup"
+        self.endpoint_conditions = {}
+        "Conditions (on _global_lock) blocked receivers wait on, key = endpoint_id"
+        self.rx_parser = API_Frame_Parser()
+        "Receive buffer and frame parser for the serial port"
+        self.tx_buffer = bytearray(API_FRAME_MAX)
+        "Frames are built in place here before being written to the serial port (used with _global_lock held)"
+        self.drain_messages = True
+        "Process every complete frame per read_messages call (False: one frame per call)"
+        self.at_responses = {}
+        "AT responses held back while draining, key = XBee frame ID, value = list of messages"
+        self.rx_drained = 0
+        "Number of frames processed by the last dispatch pass"
+        self.rx_drained_max = 0
+        "Largest number of frames processed by a single dispatch pass"
+        self.rx_condition = Condition(_global_lock)
+        "Notified (with _global_lock held) whenever received frames have been processed"
+        self.reader = None
+        "Thread reading the serial port, see start_reader"
+        self.writer = Frame_Writer(self)
+        "Writes the sent frames from a thread of its own, see start_writer"
+        self.next_housekeeping = 0
+        "Time of the next _housekeeping run"
+        self.at_waiters = {}
+        "DDO requests waiting on a response, key = XBee frame ID, value = DDO_Future"
+        self.ddo_in_flight = {}
+        "Number of DDO requests in flight, key = destination (None for the local XBee)"
+        self.ddo_queued = {}
+        "DDO requests waiting for a free slot, key = destination, value = list of DDO_Future"
+        self.ddo_max_per_destination = DDO_MAX_PER_DESTINATION
+        "Maximum number of DDO requests in flight to one destination"
+        self.ddo_cache = DDO_Cache()
+        "Values of static parameters read with ddo_get_param"
+        self.node_table = Node_Table()
+        "Nodes known to the XBee (local node first), indexed by address"
+        self.address_cache = Address_Cache()
+        "Learned 16-bit addresses used when sending to 64-bit destinations"
+        self.frame_ids = Frame_ID_Allocator()
+        "Frame IDs of sent messages still waiting for a response"
+        self.tx_destinations = {}
+        "Destination of frames sent with a learned 16-bit address, key = XBee frame ID"
+        self.discovery_listeners = []
+        "Callbacks called with (event, node) when discovery changes the node table"
+        self.discovery_sweep = 0
+        "Number of the last discovery sweep started"
+        self.discovery_completed = 0
+        "Number of the last discovery sweep finished"
+        self.discovery_deadline = None
+        "Time the running discovery sweep ends, None when no sweep is running"
+        self.discovery_frame_id = None
+        "Frame ID of the running ND command (802.15.4)"
+        self.discovery_last_seen = {}
+        "Last sweep each node was seen in, key = lower case extended address"
+        self.discovery_stale_sweeps = DISCOVERY_STALE_SWEEPS
+        "Number of sweeps a node may go unseen before it is removed"
+        self.discovery_found = {}
+        "Nodes found by the running sweep, key = lower case extended address"
+        self.discovery_callbacks = []
+        "Called with every node found by the running sweep"
+        self.discovery_expected = None
+        "The running sweep ends once this many nodes were found (None: no limit)"
+        self.discovery_quiet_time = None
+        "The running sweep ends after this many seconds without a new node (None: no limit)"
+        self.discovery_last_found = 0
+        "Time the running sweep started or last found a new node"
+        self.liveness_thresholds = dict(LIVENESS_THRESHOLD)
+        "Seconds a node may stay silent before it is reported stale, key = node type"
+        self.next_liveness_check = 0
         self.tx_status = {}
         "Tx Status message buffer, key = XBee frame ID, value = (transaction_id, endpoint_id)"
+        self.tx_callbacks = {}
+        "Functions called with the Tx Status data when it arrives, key = XBee frame ID"
+        self.tx_futures = {}
+        "Tx_Futures waiting for their Tx Status, key = XBee frame ID"
+        self.fragment_sender = Fragment_Sender(self)
+        "Sends the messages of sockets with XBS_SO_EP_FRAGMENT set"
+        self.fragment_endpoints = {}
+        "Endpoints of sockets with XBS_SO_EP_FRAGMENT set, key = endpoint_id, value = Fragment_Reassembler"
         # This needs to be here to allow us to support broadcasts at the top of ZigBee_Node.tick()
         self.rx_messages[0xFF] = []
         
         self.lqi_cluster = ZDO_Mgmt_Lqi_cluster_client(self)
+        self.lqi_crawler = LQI_Crawler(self.lqi_cluster, self._LQI_callback, self._crawl_complete)
+        self.topology = Topology_Graph()
+        "Mesh topology learned from neighbor tables and device announces"
+        self.node_store = None
+        "Node_Store the node table is saved to, see open_node_store"
+        self.stored_nodes = []
+        "Nodes loaded from the node store, added to the node table with the local node"
         self.device_annce_cluster = ZDO_Device_annce_cluster_server(self.device_announce_handler)
         self.hw_version = None
         self.sw_version = None
@@ -964,11 +2931,31 @@ class XBee:
         global com_port_opened
         try:
             _global_lock.acquire(True) # make sure other operations aren't happening
+            self.reader = None # reader thread exits once it sees the port is gone
+            self.writer.stop()
             if self.serial:
                 self.serial.close()
             self.serial = None
-            self.rx_buffer = ""
-            self.node_list = []
+            self.rx_parser.clear()
+            self.at_responses = {}
+            self.ddo_cache.clear() # a different XBee may be connected next time
+            self.address_cache.clear()
+            self.frame_ids.clear()
+            self.tx_destinations = {}
+            self.tx_status = {}
+            self.tx_callbacks = {}
+            tx_futures, self.tx_futures = self.tx_futures, {}
+            for future in tx_futures.values():
+                future._complete(Exception("Tx_Future: serial port closed before the Tx Status of frame %d arrived" % future.frame_id))
+            if self.node_store is not None:
+                self.node_store.flush(self.node_table)
+                self.node_store.close()
+                self.node_store = None
+            self.node_table.clear()
+            self.discovery_last_seen = {}
+            self.lqi_crawler.stop()
+            self._finish_discovery(stale = False)
+            self.topology = Topology_Graph()
             #NOTE: leaving any messages that had been completely received
             com_port_opened = False  
         finally:
@@ -983,79 +2970,225 @@ class XBee:
     
     def is_802_15_4(self):
         return self.is_series_1() and ((self.sw_version & 0xF000) == 0x1000)
-    
-    def register_endpoint(self, endpoint_id):
-        "Registers an endpoint to save messages for"
-        if endpoint_id not in self.rx_messages:
-            self.rx_messages[endpoint_id] = []
-
-    def unregister_endpoint(self, endpoint_id):
-        "Un-registers an endpoint, so that the messages are no long saved"
-        if endpoint_id in self.rx_messages:
-            del self.rx_messages[endpoint_id]
 
-    def recv(self, endpoint_id):
-        "Reads the messages from the XBee.  Returns from address and payload as a string"
+    def start_reader(self):
+        """Start a thread that blocks on the serial port and processes frames
+        as soon as they arrive.  Waiting sockets and AT requests are woken
+        through rx_condition instead of polling the serial port themselves."""
         _global_lock.acquire(True)
         try:
-            if self.serial is None or not self.serial.isOpen():
-                return None, None
-                #TODO: raise exception?
-            # checks for any new messages
-            self.read_messages()
-            # check to see if there are any messages waiting
-            if len(self.rx_messages[endpoint_id]):
-                # there was a message
-                recv_tuple = self.rx_messages[endpoint_id].pop(0)
-                return recv_tuple[0], recv_tuple[1] #payload, address
+            if self.reader_active() or self.serial is None:
+                return
+            # wake up periodically to notice when the port is closed or replaced
+            self.serial.timeout = READER_TIMEOUT
+            self.reader = threading.Thread(target = self._reader_loop, args = (self.serial,))
+            self.reader.setDaemon(True)
+            self.reader.start()
         finally:
             _global_lock.release()
-        return None, None
 
-    def send(self, message):
-        "Send an API message"
+    def start_writer(self):
+        """Start a thread that writes the sent frames to the serial port, so
+        senders only queue them instead of waiting for a write call (and for
+        CTS) with _global_lock held."""
         _global_lock.acquire(True)
         try:
-            # dev_idea: could keep track of frame_id and the responses.
-            if self.serial is not None and self.serial.isOpen():
-                self.serial.write(message.export())
-                debug_str = ""
-                if message.API_ID == 0x11:  #TODO: temporary filter
-                    debug_str = "TX: API ID = %s\n" % hex(message.API_ID)
-                    #frame ID
-                    debug_str += "[" + ", ".join(["%02X" %(ord(x)) for x in message.cmd_data[0:1]]) + "]:"
-                    #64-bit address        
-                    debug_str += "[" + ", ".join(["%02X" %(ord(x)) for x in message.cmd_data[1:9]]) + "]:"
-                    #16-bit address        
-                    debug_str += "[" + ", ".join(["%02X" %(ord(x)) for x in message.cmd_data[9:11]]) + "]:"
-                    #source endpoint      
-                    debug_str += "[" + ", ".join(["%02X" %(ord(x)) for x in message.cmd_data[11:12]]) + "]:"
-                    #destination endpoint      
-                    debug_str += "[" + ", ".join(["%02X" %(ord(x)) for x in message.cmd_data[12:13]]) + "]:"
-                    #cluster     
-                    debug_str += "[" + ", ".join(["%02X" %(ord(x)) for x in message.cmd_data[13:15]]) + "]:"
-                    #profile     
-                    debug_str += "[" + ", ".join(["%02X" %(ord(x)) for x in message.cmd_data[15:17]]) + "]:"
-                    #broadcast radius   
-                    debug_str += "[" + ", ".join(["%02X" %(ord(x)) for x in message.cmd_data[17:18]]) + "]:"
-                    #options   
-                    debug_str += "[" + ", ".join(["%02X" %(ord(x)) for x in message.cmd_data[18:19]]) + "]:"
-                    #payload     
-                    debug_str += "[" + ", ".join(["%02X" %(ord(x)) for x in message.cmd_data[19:]]) + "]"
-                    if MESH_TRACEBACK and debug_callback is not None:
-                        debug_callback(debug_str)
-                else:
-                    debug_str = "TX: API ID = %s\n" % hex(message.API_ID)
-                    debug_str += str([hex(ord(x)) for x in message.cmd_data])    
-                logger.debug(debug_str)
+            if self.serial is not None:
+                self.writer.start(self.serial)
         finally:
             _global_lock.release()
-        
-    def send_zb(self, source_endpoint, destination_address, payload):
-        "Sends message to the XBee."
-        if destination_address[0] == "":
-            # this is a local message, loop back to received messages
-            # mask out profile and cluster ID
+
+    def reader_active(self):
+        """True when the reader thread owns the serial port.
+        Always False on the reader thread itself, so callbacks it runs fall
+        back to polling instead of waiting on themselves."""
+        reader = self.reader
+        return reader is not None and reader.isAlive() and reader is not threading.currentThread()
+
+    def _reader_loop(self, serial_port):
+        "Body of the reader thread, runs until the serial port is closed or replaced"
+        while self.serial is serial_port and threading.currentThread() is self.reader:
+            try:
+                data = serial_port.read(1) # blocks for up to READER_TIMEOUT
+                if data:
+                    waiting = serial_port.inWaiting()
+                    if waiting:
+                        data += serial_port.read(waiting)
+            except Exception, e:
+                if self.serial is serial_port:
+                    logger.warning("XBee reader thread stopped: %s" % str(e))
+                break
+            _global_lock.acquire(True)
+            try:
+                if data:
+                    self.rx_parser.feed(data)
+                    self._dispatch_messages(True)
+                self._housekeeping()
+            finally:
+                _global_lock.release()
+    
+    def register_endpoint(self, endpoint_id):
+        "Registers an endpoint to save messages for"
+        if endpoint_id not in self.rx_messages:
+            self.rx_messages[endpoint_id] = []
+
+    def unregister_endpoint(self, endpoint_id):
+        "Un-registers an endpoint, so that the messages are no long saved"
+        _global_lock.acquire(True)
+        try:
+            if endpoint_id in self.rx_messages:
+                del self.rx_messages[endpoint_id]
+            self.fragment_endpoints.pop(endpoint_id, None)
+            condition = self.endpoint_conditions.pop(endpoint_id, None)
+            if condition is not None:
+                # blocked receivers give up
+                condition.notifyAll()
+        finally:
+            _global_lock.release()
+
+    def recv(self, endpoint_id, timeout = 0, buflen = None, into = None):
+        """Reads the messages from the XBee.  Returns from address and payload as a string,
+        (None, None) if no message arrived within timeout seconds (None: wait forever).
+        A payload longer than buflen is cut, the rest stays queued for the next call.
+        With into (a writable buffer) the payload is copied straight into it and
+        the number of bytes copied is returned instead of the payload.
+        While waiting the caller sleeps on the endpoint's condition and is woken by the
+        reader thread; without the reader thread the serial port is polled."""
+        deadline = None
+        if timeout:
+            deadline = time.time() + timeout
+        _global_lock.acquire(True)
+        try:
+            while 1:
+                # also while the serial port is down, so closing the socket wakes its receivers
+                message_list = self.rx_messages.get(endpoint_id)
+                if message_list is None:
+                    return None, None # endpoint closed
+                if self.serial is not None and self.serial.isOpen():
+                    # checks for any new messages
+                    self.read_messages()
+                    # check to see if there are any messages waiting
+                    message_list = self.rx_messages.get(endpoint_id)
+                    if message_list is None:
+                        return None, None # endpoint closed
+                    if len(message_list):
+                        # there was a message
+                        payload, address = message_list[0]
+                        length = len(payload)
+                        if buflen is not None and length > buflen:
+                            message_list[0] = (payload[buflen:], address)
+                            length = buflen
+                        else:
+                            del message_list[0]
+                            if not message_list and endpoint_id in self.endpoint_wakeups:
+                                self.endpoint_wakeups[endpoint_id].clear()
+                        if into is not None:
+                            _copy_into(into, payload, length)
+                            return length, address
+                        if length < len(payload):
+                            return payload[:length], address
+                        return payload, address
+                if timeout == 0:
+                    return None, None
+                remaining = None
+                if deadline is not None:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        return None, None
+                if self.reader_active():
+                    condition = self.endpoint_conditions.get(endpoint_id)
+                    if condition is None:
+                        condition = self.endpoint_conditions[endpoint_id] = Condition(_global_lock)
+                    # releases _global_lock until _wake_receivers notifies the endpoint
+                    condition.wait(remaining)
+                else:
+                    # nobody delivers frames while we wait
+                    if remaining is None or remaining > SELECT_SLEEP_TIME:
+                        remaining = SELECT_SLEEP_TIME
+                    _global_lock.release()
+                    try:
+                        time.sleep(remaining)
+                    finally:
+                        _global_lock.acquire(True)
+        finally:
+            _global_lock.release()
+
+    def send(self, message):
+        "Send an API message"
+        _global_lock.acquire(True)
+        try:
+            if self.serial is not None and self.serial.isOpen():
+                # may release _global_lock, so wait before building the frame in tx_buffer
+                queued = self.writer.wait_for_room()
+                if self.serial is None:
+                    return # closed while waiting
+                # frames expecting a response take a frame ID nothing else waits on
+                response_id = FRAME_ID_RESPONSES.get(message.api_data.tx_id)
+                message.api_data.allocate_frame_id = lambda: self._allocate_frame_id(response_id)
+                try:
+                    length = message.export_into(self.tx_buffer)
+                finally:
+                    del message.api_data.allocate_frame_id
+                if queued:
+                    self.writer.queue(memoryview(self.tx_buffer)[:length])
+                else:
+                    self.serial.write(memoryview(self.tx_buffer)[:length])
+                if logger.isEnabledFor(logging.DEBUG) or (MESH_TRACEBACK and debug_callback is not None):
+                    # the frame was built in place, cmd_data is only needed for the debug output
+                    message.cmd_data = str(self.tx_buffer[4:length - 1])
+                    debug_str = ""
+                    if message.API_ID == 0x11:  #TODO: temporary filter
+                        debug_str = "TX: API ID = %s\n" % hex(message.API_ID)
+                        #frame ID
+                        debug_str += "[" + ", ".join(["%02X" %(ord(x)) for x in message.cmd_data[0:1]]) + "]:"
+                        #64-bit address        
+                        debug_str += "[" + ", ".join(["%02X" %(ord(x)) for x in message.cmd_data[1:9]]) + "]:"
+                        #16-bit address        
+                        debug_str += "[" + ", ".join(["%02X" %(ord(x)) for x in message.cmd_data[9:11]]) + "]:"
+                        #source endpoint      
+                        debug_str += "[" + ", ".join(["%02X" %(ord(x)) for x in message.cmd_data[11:12]]) + "]:"
+                        #destination endpoint      
+                        debug_str += "[" + ", ".join(["%02X" %(ord(x)) for x in message.cmd_data[12:13]]) + "]:"
+                        #cluster     
+                        debug_str += "[" + ", ".join(["%02X" %(ord(x)) for x in message.cmd_data[13:15]]) + "]:"
+                        #profile     
+                        debug_str += "[" + ", ".join(["%02X" %(ord(x)) for x in message.cmd_data[15:17]]) + "]:"
+                        #broadcast radius   
+                        debug_str += "[" + ", ".join(["%02X" %(ord(x)) for x in message.cmd_data[17:18]]) + "]:"
+                        #options   
+                        debug_str += "[" + ", ".join(["%02X" %(ord(x)) for x in message.cmd_data[18:19]]) + "]:"
+                        #payload     
+                        debug_str += "[" + ", ".join(["%02X" %(ord(x)) for x in message.cmd_data[19:]]) + "]"
+                        if MESH_TRACEBACK and debug_callback is not None:
+                            debug_callback(debug_str)
+                    else:
+                        debug_str = "TX: API ID = %s\n" % hex(message.API_ID)
+                        debug_str += str([hex(ord(x)) for x in message.cmd_data])    
+                    logger.debug(debug_str)
+        finally:
+            _global_lock.release()
+        
+    def _allocate_frame_id(self, response_id = None):
+        """Returns a free frame ID released by a response with API ID response_id.
+        With the window full, waits (up to the frame ID timeout) for a response
+        to release one while the reader thread is running.  Caller must hold _global_lock."""
+        frame_ids = self.frame_ids
+        if not frame_ids.available() and self.reader_active():
+            frame_ids.waits += 1
+            # housekeeping reaps unanswered frame IDs, give it a chance to run
+            deadline = time.time() + frame_ids.timeout + 2 * READER_TIMEOUT
+            while not frame_ids.available() and self.reader_active() and time.time() < deadline:
+                # releases _global_lock so the reader thread can deliver responses
+                self.rx_condition.wait(READER_TIMEOUT)
+        return frame_ids.allocate(response_id = response_id)
+
+    def send_zb(self, source_endpoint, destination_address, payload, tx_callback = None):
+        """Sends message to the XBee.  Returns the XBee frame ID, None for local messages.
+        tx_callback(status_data) is called with the Tx Status data when it arrives;
+        callers passing it must hold _global_lock."""
+        if destination_address[0] == "":
+            # this is a local message, loop back to received messages
+            # mask out profile and cluster ID
             local_endpoint = destination_address[1]
             if local_endpoint in self.rx_messages:
                 tx_status_tuple = None
@@ -1073,17 +3206,27 @@ class XBee:
                     # flag packet acknowledged, if not disabled
                     options |= destination_address[4] ^ socket.XBS_OPT_RX_ACK 
                 full_source_address = ("", source_endpoint, destination_address[2], destination_address[3], options)
-                recv_tuple = (payload, full_source_address)
+                recv_tuple = (_payload_string(payload), full_source_address)
                 # add data to the message queue
                 if tx_status_tuple is not None:
                     self.rx_messages[source_endpoint].append(tx_status_tuple)                            
-                self.rx_messages[local_endpoint].append(recv_tuple)
+                self._queue_message(local_endpoint, recv_tuple)
+                self._wake_receivers()
 
         else:
             # send message out the XBee
             message = API_Message()
+            addr_extended = None
+            destination_short = None
+            if len(destination_address[0]) > 8 and\
+                address_string_to_MAC(destination_address[0]) != 0xFFFF: # not broadcast
+                addr_extended = destination_address[0]
+                destination_short = self.address_cache.lookup(addr_extended)
             if self.is_802_15_4():
                 # create an 802.15.4 message
+                if destination_short is not None:
+                    # use the shorter frame with the learned 16-bit address
+                    destination_address = (short_to_address_string(destination_short),) + tuple(destination_address[1:])
                 if len(destination_address[0]) <= 8: #'[xxxx]!' or '[xx:xx]!'
                     # this is a 16-bit address
                     message.API_ID = IEEE_802_15_4_16_Data.tx_id
@@ -1096,11 +3239,22 @@ class XBee:
                 #assume this radio uses the ZB packets
                 message.API_ID = ZB_Data.tx_id
                 zb_data = ZB_Data()
+                zb_data.destination_short = destination_short
             zb_data.source_address = ("", source_endpoint, 0, 0)
             zb_data.destination_address = destination_address
             zb_data.payload = payload
             message.api_data = zb_data
             self.send(message)
+            if addr_extended is not None:
+                # the Tx Status confirms or invalidates the 16-bit address
+                self.tx_destinations[zb_data.frame_id] = addr_extended
+            else:
+                # frame IDs wrap around, forget an unanswered earlier frame
+                self.tx_destinations.pop(zb_data.frame_id, None)
+            if tx_callback is not None:
+                self.tx_callbacks[zb_data.frame_id] = tx_callback
+            else:
+                self.tx_callbacks.pop(zb_data.frame_id, None)
         
             #Handle 6th address parameter to receive transmit status.
             if len(destination_address) >= 6 and destination_address[5] != -1:
@@ -1108,9 +3262,43 @@ class XBee:
                 transaction_id = destination_address[5]
                 frame_id = message.api_data.frame_id 
                 self.tx_status[frame_id] = (transaction_id, source_endpoint)
+            else:
+                self.tx_status.pop(zb_data.frame_id, None)
+            return zb_data.frame_id
+
+    def send_zb_async(self, source_endpoint, destination_address, payload, timeout = TX_STATUS_TIMEOUT, blocking = True):
+        """Sends message to the XBee, returns a Tx_Future resolved by the message's Tx Status.
+        At most TX_IN_FLIGHT_MAX futures wait for their Tx Status; further sends wait
+        for one of them to finish, or raise when not blocking."""
+        _global_lock.acquire(True)
+        try:
+            while len(self.tx_futures) >= TX_IN_FLIGHT_MAX:
+                if not blocking:
+                    raise Exception("error: too many messages waiting for their Tx Status")
+                self._wait_for_frames(READER_TIMEOUT)
+            future = Tx_Future(self, destination_address, timeout)
+            frame_id = self.send_zb(source_endpoint, destination_address, payload, future._tx_status)
+            if frame_id is None:
+                # local messages are delivered right away
+                future.delivery_status = ZigBee_Tx_Status_Data.SUCCESS
+                future._complete(None)
+                return future
+            future.frame_id = frame_id
+            future.deadline = time.time() + timeout
+            previous = self.tx_futures.get(frame_id)
+            if previous is not None:
+                # frame IDs wrap around, its Tx Status can no longer be told apart
+                previous._complete(Exception("Tx_Future: frame ID %d reused before its Tx Status arrived" % frame_id))
+            self.tx_futures[frame_id] = future
+            return future
+        finally:
+            _global_lock.release()
 
     def process_message(self, message, message_buffer, AT_frame_id = 0, force_com=False):
         # pass data to XBS_PROT_XAPI sockets if applicable
+        if message_buffer is None and (-0xFF in self.rx_messages or -message.API_ID in self.rx_messages):
+            # only rebuild the raw frame when a socket wants it
+            message_buffer = message.frame_string()
         if -0xFF in self.rx_messages:
             # add to the generic message socket
             self.rx_messages[-0xFF].append((message_buffer, ('[0000]!', 0, 0, 0, 0, 0)))
@@ -1165,12 +3353,16 @@ class XBee:
                 self.lqi_cluster.handle_message(frame)
             
             # check if a new remote device
-            if zb_data.destination_address[0]:
-                for node in self.node_list:
-                    if zb_data.destination_address[0] == node.addr_extended:
-                        break
+            source = zb_data.source_address[0]
+            if len(source) > len("[FFFE]!"):
+                self.address_cache.learn(source, zb_data.source_short)
+                if self.node_table.get(source) is None:
+                    self._new_node(source)
                 else:
-                    self._new_node(zb_data.destination_address[0])
+                    self.discovery_last_seen[source.lower()] = self.discovery_sweep
+                    if self.node_store is not None:
+                        self.node_store.update(source, last_seen = time.time())
+                self._node_heard(source)
                         
             if local_endpoint in self.rx_messages:
                 if zb_data.source_address is None:
@@ -1179,16 +3371,17 @@ class XBee:
                 recv_tuple = (zb_data.payload, zb_data.source_address)
                 #if endpoint is broadcast endpoint (0xFF), duplicate the message for all other endpoints
                 if local_endpoint == 0xFF:
-                    for endpoint_id in self.rx_messages:
+                    for endpoint_id in self.rx_messages.keys():
                         if endpoint_id != 0:    #but don't give the message to the ZDO endpoint  #TTDO: is this correct?
-                            self.rx_messages[endpoint_id].append(recv_tuple)
+                            self._queue_message(endpoint_id, recv_tuple)
                 else:
                     # add data to the message queue
-                    self.rx_messages[local_endpoint].append(recv_tuple)
+                    self._queue_message(local_endpoint, recv_tuple)
         elif message.API_ID in (IEEE_802_15_4_16_Data.rx_id, 
                                 IEEE_802_15_4_64_Data.rx_id): # explicit 802.15.4 message
             #extract the message
             zb_data = message.api_data
+            self._node_heard(zb_data.source_address[0], zb_data.rssi)
             # make sure the address is registered, check with address = ""
             local_endpoint = zb_data.destination_address[1] #NOTE: will always be zero
             if local_endpoint in self.rx_messages:
@@ -1197,11 +3390,12 @@ class XBee:
                 # create the tuple to store the message
                 recv_tuple = (zb_data.payload, zb_data.source_address)
                 # add data to the message queue
-                self.rx_messages[local_endpoint].append(recv_tuple)
+                self._queue_message(local_endpoint, recv_tuple)
         elif message.API_ID in (IEEE_802_15_4_16_IO.rx_id,
                                 IEEE_802_15_4_64_IO.rx_id): # 802.15.4 IO message
             #extract the message
             io_data = message.api_data
+            self._node_heard(io_data.source_address[0], io_data.rssi)
             # NOTE: IO messages get passed out on endpoint 0 for 802.15.4
             if 0 in self.rx_messages:
                 # create the tuple to store the message
@@ -1211,22 +3405,52 @@ class XBee:
         elif message.API_ID == Local_AT_Data.rx_id: #cmd ID for local AT response
             #extract the at_data
             at_data = message.api_data
+            if at_data.frame_id != self.discovery_frame_id: # ND answers until the sweep ends
+                self.frame_ids.release(at_data.frame_id, Local_AT_Data.rx_id)
             # check if this is the message we are waiting for
-            if at_data.frame_id == AT_frame_id:
+            if at_data.frame_id in self.at_waiters:
+                self._complete_ddo(self.at_waiters.pop(at_data.frame_id), message)
+            elif at_data.frame_id in self.at_responses:
+                self.at_responses[at_data.frame_id].append(message)
+                if at_data.frame_id == self.discovery_frame_id:
+                    self._parse_discovery_responses()
+            elif at_data.frame_id == AT_frame_id:
                 return message
         elif message.API_ID == Remote_AT_Data.rx_id: #cmd ID for remote AT response
             #extract the at_data
             at_data = message.api_data
+            self.frame_ids.release(at_data.frame_id, Remote_AT_Data.rx_id)
+            if at_data.status != 4: # not a transmission failure, the node answered
+                self._node_heard(at_data.remote_address)
             # check if this is the message we are waiting for
-            if at_data.frame_id == AT_frame_id:
+            if at_data.frame_id in self.at_waiters:
+                self._complete_ddo(self.at_waiters.pop(at_data.frame_id), message)
+            elif at_data.frame_id in self.at_responses:
+                self.at_responses[at_data.frame_id].append(message)
+            elif at_data.frame_id == AT_frame_id:
                 return message
         elif message.API_ID == ZigBee_Tx_Status_Data.rx_id or message.API_ID == IEEE_802_15_4_Tx_Status_Data.rx_id: #cmd ID for Tx Status message
             # match to 6th address parameter if enabled
             # extract the tx_response
             status_data = message.api_data
-            if status_data.frame_id in self.tx_status:
+            self.frame_ids.release(status_data.frame_id, message.API_ID)
+            addr_extended = self.tx_destinations.pop(status_data.frame_id, None)
+            if addr_extended is not None:
+                if status_data.delivery_status != ZigBee_Tx_Status_Data.SUCCESS:
+                    # the learned address may be stale, let the XBee discover it again
+                    self.address_cache.invalidate(addr_extended)
+                elif message.API_ID == ZigBee_Tx_Status_Data.rx_id:
+                    self.address_cache.learn(addr_extended, status_data.remote_network_address)
+            tx_callback = self.tx_callbacks.pop(status_data.frame_id, None)
+            if tx_callback is not None:
+                try:
+                    tx_callback(status_data)
+                except Exception, e:
+                    logger.debug("Error: Tx Status callback: %s" % str(e))
+            tx_status = self.tx_status.pop(status_data.frame_id, None)
+            if tx_status is not None:
                 # Tx Status matches existing frame id, queue response in socket
-                transaction_id, endpoint_id = self.tx_status[status_data.frame_id]
+                transaction_id, endpoint_id = tx_status
                 delivery_status = chr(ZigBee_Tx_Status_Data.rx_id) + status_data.export()
                 tx_status_tuple = (delivery_status, ("[00:00:00:00:00:00:00:00]!", endpoint_id, 0xC105, message.API_ID, 0, transaction_id))
                 self.rx_messages[endpoint_id].append(tx_status_tuple)                                        
@@ -1237,43 +3461,164 @@ class XBee:
         return None
 
 
+    def _queue_message(self, endpoint_id, recv_tuple):
+        "Queue a received message for an endpoint, putting fragmented messages back together"
+        reassembler = self.fragment_endpoints.get(endpoint_id)
+        if reassembler is not None:
+            payload = reassembler.add(recv_tuple[0], recv_tuple[1])
+            if payload is None:
+                return # more fragments to come
+            recv_tuple = (payload, recv_tuple[1])
+        self.rx_messages[endpoint_id].append(recv_tuple)
+
+    def set_fragmentation(self, endpoint_id, enable):
+        "Put fragmented messages received on the endpoint back together (see XBS_SO_EP_FRAGMENT)"
+        _global_lock.acquire(True)
+        try:
+            if not enable:
+                self.fragment_endpoints.pop(endpoint_id, None)
+            elif endpoint_id not in self.fragment_endpoints:
+                self.fragment_endpoints[endpoint_id] = Fragment_Reassembler()
+        finally:
+            _global_lock.release()
+
+    def max_payload(self, destination_address = None):
+        """Largest payload one frame can carry: NP, less the APS encryption overhead
+        when the options of destination_address ask for it"""
+        try:
+            payload_size = struct.unpack(">H", self.ddo_get_param(None, "NP"))[0]
+        except Exception, e:
+            logger.debug("unable to read NP: %s" % str(e))
+            payload_size = FRAGMENT_DEFAULT_PAYLOAD
+        if destination_address is not None and len(destination_address) > 4 and\
+            destination_address[4] & socket.XBS_OPT_TX_APSSEC:
+            payload_size -= FRAGMENT_APS_OVERHEAD
+        return payload_size
+
+    def send_fragmented(self, source_endpoint, destination_address, payload, window = FRAGMENT_WINDOW, blocking = True):
+        """Send payload as fragments that fit in one frame each, the receiving socket
+        puts them back together when it has XBS_SO_EP_FRAGMENT set.
+        Waits while FRAGMENT_QUEUE_MAX fragments are queued (raises when not blocking).
+        Returns a Tx_Future resolved once every fragment was delivered or the message failed."""
+        if len(destination_address) >= 6 and destination_address[5] != -1:
+            raise Exception("error: Tx Status messages (transaction ID) not supported with XBS_SO_EP_FRAGMENT, use sendto_async")
+        fragment_size = self.max_payload(destination_address)
+        # the Tx Status of every fragment is tracked by the sender
+        destination_address = tuple(destination_address[:5])
+        _global_lock.acquire(True)
+        try:
+            while len(self.fragment_sender.queue) >= FRAGMENT_QUEUE_MAX:
+                if not blocking:
+                    raise Exception("error: fragment queue full")
+                if self.reader_active():
+                    self.rx_condition.wait(READER_TIMEOUT)
+                else:
+                    self.read_messages()
+                    self._housekeeping()
+                    _global_lock.release()
+                    try:
+                        time.sleep(SELECT_SLEEP_TIME)
+                    finally:
+                        _global_lock.acquire(True)
+            return self.fragment_sender.send(source_endpoint, destination_address, payload, fragment_size, window)
+        finally:
+            _global_lock.release()
+
+    def _wake_receivers(self):
+        """Wake up the receivers blocked on endpoints with queued messages, set
+        their readiness fds and wake up xbee_select"""
+        _global_lock.acquire(True)
+        try:
+            for endpoint_id, condition in self.endpoint_conditions.items():
+                if self.rx_messages.get(endpoint_id):
+                    condition.notifyAll()
+            for endpoint_id, wakeup in self.endpoint_wakeups.items():
+                if self.rx_messages.get(endpoint_id):
+                    wakeup.set()
+            _wake_select()
+        finally:
+            _global_lock.release()
+
+    def _dispatch_messages(self, drain, force_com=False):
+        """Process complete frames in the receive buffer (all of them when drain is set)
+        and wake up anybody waiting on rx_condition.  Caller must hold _global_lock.
+        Returns the number of frames processed."""
+        drained = 0
+        while drain or not drained:
+            message = self.rx_parser.next_message()
+            if message is None:
+                # not enough buffer for the next message
+                break
+            drained += 1
+            try:
+                self.process_message(message, None, 0, force_com)
+            except Exception, e:
+                logger.warning("exception during API message processing: %s" % str(e))
+        if drained:
+            self.rx_drained = drained
+            if drained > self.rx_drained_max:
+                self.rx_drained_max = drained
+            self.rx_condition.notifyAll()
+            self._wake_receivers()
+        return drained
+
     def read_messages(self, AT_frame_id = 0, force_com=False):
         """Reads messages from the serial port, return message if it matches
-        the AT_frame_id (meant to be used for AT commands)"""
+        the AT_frame_id (meant to be used for AT commands)
+        When drain_messages is set, every complete frame in the buffer is
+        processed; extra responses matching AT_frame_id are kept for the
+        following calls.  While the reader thread is running the serial port
+        is left to it and only already processed responses are returned."""
         if not force_com and not com_port_opened:
             return None
         _global_lock.acquire(True)
         try:
-            if self.serial is not None and self.serial.isOpen():
-                self.rx_buffer += self.serial.read(self.serial.inWaiting()) #read everything that is available
-            while 1:
-                # sanitize buffer up to first candidate API frame:
-                s_idx = self.rx_buffer.find('\x7e')
-                if s_idx != -1:
-                    self.rx_buffer = self.rx_buffer[s_idx:]
-                message = API_Message() #create message and try to fill it from the serial port data.
-                status = message.extract(self.rx_buffer)
-                if status < 0:
-                    # not enough buffer for the message
-                    break
-                # save off the message, may be used for XBS_PROT_XAPI
-                message_buffer = self.rx_buffer[:status]
-                # received frame, remove from buffer
-                self.rx_buffer = self.rx_buffer[status:]
-                if message.is_valid():
-                    try:
-                        return self.process_message(message, message_buffer, AT_frame_id, force_com)
-                    except Exception, e:
-                        logger.warning("exception during API message processing: %s" % str(e))
-                else:
-                    # Advance rx_buffer; useful in the case where ~~ appears in stream
-                    # unexpectedly. It's been seeon on OSX a few times; likely due to faulty
-                    # flow control. The message parser must advance in order to allow it to
-                    # continue.
-                    self.rx_buffer = self.rx_buffer[1:]
+            if AT_frame_id and AT_frame_id not in self.at_responses:
+                self.at_responses[AT_frame_id] = []
+            if not self.reader_active():
+                if self.serial is not None and self.serial.isOpen():
+                    self.rx_parser.feed(self.serial.read(self.serial.inWaiting())) #read everything that is available
+                self._dispatch_messages(self.drain_messages, force_com)
+                self._housekeeping()
+            at_response = None
+            if AT_frame_id:
+                responses = self.at_responses[AT_frame_id]
+                if responses:
+                    at_response = responses.pop(0)
+                if not responses:
+                    del self.at_responses[AT_frame_id]
         finally:
             _global_lock.release()
-        return None
+        return at_response
+
+    def _wait_for_frames(self, timeout, force_com=False):
+        """Wait up to timeout seconds for received frames to be processed.
+        Polls the serial port once when the reader thread is not running.
+        Caller must hold _global_lock."""
+        if self.reader_active():
+            # releases _global_lock so the reader thread can deliver frames
+            self.rx_condition.wait(timeout)
+        else:
+            self.read_messages(force_com = force_com)
+            self._housekeeping()
+
+    def _wait_at_response(self, AT_frame_id, timeout, force_com=False):
+        """Wait up to timeout seconds for a response to the AT frame AT_frame_id.
+        The frame ID must already be registered in at_responses and the caller
+        must hold _global_lock.  Returns None on timeout."""
+        deadline = time.time() + timeout
+        while 1:
+            responses = self.at_responses.get(AT_frame_id)
+            if responses:
+                return responses.pop(0)
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return None
+            if self.reader_active():
+                # releases _global_lock so the reader thread can deliver the response
+                self.rx_condition.wait(remaining)
+            else:
+                self.read_messages(force_com = force_com)
 
     def register_joining_device(self, addr_extended, key, timeout = 0):
         "Register a device with the local XBee using a unique link key"
@@ -1291,8 +3636,11 @@ class XBee:
         self.send(message)
         return True
     
-    def ddo_get_param(self, addr_extended, id, timeout=1, order=False, force_com=False):
-        "Get a Digi Device Objects parameter value (only local address currently supported)"
+    def ddo_get_param_async(self, addr_extended, id, timeout=1, order=False, force_com=False, callback=None, max_age=None):
+        """Start reading a Digi Device Objects parameter value, returns a DDO_Future
+        The future's value is the parameter value as a string.
+        Parameters listed in the DDO cache are answered from it when the cached
+        value is younger than max_age seconds (default: the parameter's time to live)."""
         _global_lock.acquire(True)
         try:
             if not force_com and not com_port_opened: #a global
@@ -1306,7 +3654,6 @@ class XBee:
             message = API_Message()
             if addr_extended is None:
                 message.api_data = Local_AT_Data(id)
-                self.send(message)
             else:
                 if not isinstance(addr_extended, str):
                     # TTDO: this should be type error
@@ -1314,24 +3661,24 @@ class XBee:
 #                if len(addr_extended) != 26:
 #                    #TTDO: should do better test of format...
 #                    raise Exception("ddo_get_param: addr_extended format is invalid!")
-                message.api_data = Remote_AT_Data(addr_extended, id)    
-                self.send(message)            
-            # wait to receive response
-            AT_frame_id = message.api_data.frame_id
-            at_response = None
-            start_time = time.time()
-            while start_time + timeout > time.time():
-                at_response = self.read_messages(AT_frame_id, force_com = force_com)
-                if at_response is not None:
-                    break
-            else:
-                raise Exception("ddo_get_param: timeout fetching DDO parameter (%s@%s)." % (str(id), str(addr_extended)))
-            return at_response.api_data.value
+                message.api_data = Remote_AT_Data(addr_extended, id)
+            future = DDO_Future(self, DDO_Future.GET, addr_extended, id, message, timeout, force_com)
+            if self.ddo_cache.cacheable(id):
+                value = self.ddo_cache.get(future.destination, id, max_age)
+                if value is not None:
+                    future.value = value
+                    future._complete(None, None)
+            if callback is not None:
+                future.add_done_callback(callback)
+            if not future.done():
+                self._submit_ddo(future)
+            return future
         finally:
             _global_lock.release()
 
-    def ddo_set_param(self, addr_extended, id, value, timeout=1, order=False, apply=True):
-        "Set a Digi Device Objects parameter value"
+    def ddo_set_param_async(self, addr_extended, id, value, timeout=1, order=False, apply=True, callback=None):
+        """Start setting a Digi Device Objects parameter value, returns a DDO_Future
+        The future's value is True on success."""
         _global_lock.acquire(True)
         try:
             if not com_port_opened: #a global
@@ -1357,8 +3704,10 @@ class XBee:
             # create message to send.
             message = API_Message()
             if addr_extended is None:
-                message.api_data = Local_AT_Data(id, value)    
-                self.send(message)
+                if apply:
+                    message.api_data = Local_AT_Data(id, value)
+                else:
+                    message.api_data = Local_AT_Queue_Data(id, value)
             else:
                 if not isinstance(addr_extended, str):
                     # TTDO: this should be type error
@@ -1366,31 +3715,20 @@ class XBee:
                 if len(addr_extended) != 24 and len(addr_extended) != 26: # depends on "[" and "]"
                     #TTDO: should do better test of format...
                     raise Exception("ddo_set_param: addr_extended format is invalid!")
-                message.api_data = Remote_AT_Data(addr_extended, id, value)    
-                self.send(message)
-            
-            # wait to receive response
-            AT_frame_id = message.api_data.frame_id
-            at_response = None
-            start_time = time.time()
-            while start_time + timeout > time.time():
-                at_response = self.read_messages(AT_frame_id)
-                if at_response is not None:
-                    break
-            else:
-                raise Exception("ddo_set_param: timeout setting DDO parameter (%s@%s)." % (str(id), str(addr_extended))) # on timeout or error
-            
-            if at_response.api_data.status == 0:
-                # success
-                return True
-            else:
-                raise Exception("ddo_set_param: error setting DDO parameter (%s@%s)." % (str(id), str(addr_extended)))
-            return False
+                message.api_data = Remote_AT_Data(addr_extended, id, value)
+                if not apply:
+                    message.api_data.options = 0
+            future = DDO_Future(self, DDO_Future.SET, addr_extended, id, message, timeout)
+            if callback is not None:
+                future.add_done_callback(callback)
+            self._submit_ddo(future)
+            return future
         finally:
             _global_lock.release()
-            
-    def ddo_command(self, addr_extended, id, param=None, timeout=1, order=False, apply=True):
-        "Execute a Digi Device Objects AT command (only local address currently supported)"
+
+    def ddo_command_async(self, addr_extended, id, param=None, timeout=1, order=False, apply=True, callback=None):
+        """Start executing a Digi Device Objects AT command, returns a DDO_Future
+        The future's value is the command response or None if it was empty."""
         _global_lock.acquire(True)
         try:
             if not com_port_opened: #a global
@@ -1418,8 +3756,10 @@ class XBee:
             # create message to send.
             message = API_Message()
             if addr_extended is None:
-                message.api_data = Local_AT_Data(id, param)
-                self.send(message)
+                if apply:
+                    message.api_data = Local_AT_Data(id, param)
+                else:
+                    message.api_data = Local_AT_Queue_Data(id, param)
             else:
                 if not isinstance(addr_extended, str):
                     # TTDO: this should be type error
@@ -1428,107 +3768,571 @@ class XBee:
                     #TTDO: should do better test of format...
                     raise Exception("ddo_command: addr_extended format is invalid!")
                 message.api_data = Remote_AT_Data(addr_extended, id, param)
-                self.send(message)
+                if not apply:
+                    message.api_data.options = 0
+            future = DDO_Future(self, DDO_Future.COMMAND, addr_extended, id, message, timeout)
+            if callback is not None:
+                future.add_done_callback(callback)
+            self._submit_ddo(future)
+            return future
+        finally:
+            _global_lock.release()
 
-            # wait to receive response
-            AT_frame_id = message.api_data.frame_id
-            at_response = None
-            start_time = time.time()
-            while start_time + timeout > time.time():
-                at_response = self.read_messages(AT_frame_id)
-                if at_response is not None:
-                    break
+    def ddo_get_param(self, addr_extended, id, timeout=1, order=False, force_com=False, max_age=None):
+        "Get a Digi Device Objects parameter value"
+        return self.ddo_get_param_async(addr_extended, id, timeout, order, force_com, max_age=max_age).result()
+
+    def ddo_set_param(self, addr_extended, id, value, timeout=1, order=False, apply=True):
+        "Set a Digi Device Objects parameter value"
+        return self.ddo_set_param_async(addr_extended, id, value, timeout, order, apply).result()
+
+    def ddo_command(self, addr_extended, id, param=None, timeout=1, order=False, apply=True):
+        "Execute a Digi Device Objects AT command"
+        return self.ddo_command_async(addr_extended, id, param, timeout, order, apply).result()
+
+    def ddo_set_many(self, addr_extended, params, apply=True, write=False, timeout=1):
+        """Set several Digi Device Objects parameters as one transaction.
+        params is a dictionary {id: value} or a sequence of (id, value) pairs
+        when the order matters.  The values are sent pipelined without being
+        applied, then a single AC (apply) or WR (write, applying as well when
+        apply is set) makes them effective.  If any value is rejected no AC or
+        WR is sent, but the values the XBee accepted stay queued on it and take
+        effect with the next apply (a retry, or any AC or applied AT command
+        sent to that XBee).  Old values are not restored, write-only
+        parameters such as KY cannot be read back."""
+        if hasattr(params, "items"):
+            params = params.items()
+        futures = []
+        for id, value in params:
+            futures.append((id, self.ddo_set_param_async(addr_extended, id, value, timeout, apply=False)))
+        failed = []
+        for id, future in futures:
+            try:
+                future.result()
+            except Exception, e:
+                logger.debug(str(e))
+                failed.append(id)
+        if failed:
+            raise Exception("ddo_set_many: error setting DDO parameters (%s@%s)." % (",".join(failed), str(addr_extended)))
+        if write:
+            self.ddo_command(addr_extended, "WR", timeout=timeout, apply=apply)
+        elif apply:
+            self.ddo_command(addr_extended, "AC", timeout=timeout)
+        return True
+
+    def ddo_fleet(self, nodes=None, reads=(), writes=(), window=DDO_FLEET_WINDOW, timeout=1, apply=True):
+        """Read and/or set the same parameters on many nodes.
+        nodes is a sequence of Node objects or extended addresses (default: every
+        node in the node list), reads a sequence of parameter names and writes a
+        dictionary {id: value} or a sequence of (id, value) pairs.  At most window
+        requests are kept in flight.
+        This is a generator yielding every DDO_Future as soon as it finishes;
+        failed requests carry their exception instead of a value."""
+        if nodes is None:
+            nodes = self.get_node_list(refresh=False)
+        local_address = None
+        if len(self.node_table):
+            local_address = self.node_table.snapshot()[0].addr_extended
+        addresses = []
+        for node in nodes:
+            if isinstance(node, Node):
+                node = node.addr_extended
+            if node == local_address:
+                node = None # the local XBee is reached with local AT frames
+            addresses.append(node)
+        if hasattr(writes, "items"):
+            writes = writes.items()
+        # spread consecutive requests over all nodes
+        operations = []
+        for id in reads:
+            for addr_extended in addresses:
+                operations.append((addr_extended, id, None, False))
+        for id, value in writes:
+            for addr_extended in addresses:
+                operations.append((addr_extended, id, value, True))
+
+        finished = []
+        _global_lock.acquire(True)
+        try:
+            in_flight = 0
+            next_operation = 0
+            while next_operation < len(operations) or in_flight:
+                while next_operation < len(operations) and in_flight < window:
+                    addr_extended, id, value, write = operations[next_operation]
+                    next_operation += 1
+                    in_flight += 1
+                    try:
+                        if write:
+                            self.ddo_set_param_async(addr_extended, id, value, timeout, apply=apply, callback=finished.append)
+                        else:
+                            self.ddo_get_param_async(addr_extended, id, timeout, callback=finished.append)
+                    except Exception, e:
+                        # report requests that could not be sent like failed ones
+                        if write:
+                            future = DDO_Future(self, DDO_Future.SET, None, id, None, timeout)
+                        else:
+                            future = DDO_Future(self, DDO_Future.GET, None, id, None, timeout)
+                        future.addr_extended = addr_extended
+                        future._complete(None, e)
+                        finished.append(future)
+                while not finished:
+                    self._wait_for_frames(READER_TIMEOUT)
+                results = finished[:]
+                del finished[:]
+                in_flight -= len(results)
+                _global_lock.release()
+                try:
+                    for future in results:
+                        yield future
+                finally:
+                    _global_lock.acquire(True)
+        finally:
+            _global_lock.release()
+
+    def _submit_ddo(self, future):
+        """Send a DDO request, or queue it when the destination already has
+        ddo_max_per_destination requests in flight.  Caller must hold _global_lock."""
+        destination = future.destination
+        # the timeout counts from the call, also while the request is queued
+        future.deadline = time.time() + future.timeout
+        if future.kind == DDO_Future.GET:
+            # a SET submitted while this GET is in flight keeps its answer out of the cache
+            future.cache_writes = self.ddo_cache.writes
+        elif future.kind == DDO_Future.SET:
+            self.ddo_cache.invalidate(destination, future.id)
+        elif future.kind == DDO_Future.COMMAND:
+            if future.id.upper() in DDO_CACHE_FLUSH_COMMANDS:
+                self.ddo_cache.invalidate(destination)
             else:
-                raise Exception("ddo_command: timeout performing DDO command (%s@%s)." % (str(id), str(addr_extended)))
-            if at_response.api_data.status == 0:
-                if len(at_response.api_data.value) == 0:
-                    return None
+                self.ddo_cache.invalidate(destination, future.id)
+        if self.ddo_in_flight.get(destination, 0) >= self.ddo_max_per_destination:
+            self.ddo_queued.setdefault(destination, []).append(future)
+        else:
+            self._send_ddo(future)
+
+    def _send_ddo(self, future):
+        "Send the AT frame of a DDO request and register it as waiting on its frame ID"
+        self.send(future.message)
+        # only count the request once it is actually out, a failed send must not use up a slot
+        self.ddo_in_flight[future.destination] = self.ddo_in_flight.get(future.destination, 0) + 1
+        future.frame_id = future.message.api_data.frame_id
+        self.at_waiters[future.frame_id] = future
+
+    def _complete_ddo(self, future, message = None, exception = None):
+        "Resolve a DDO request and send the next request queued for its destination"
+        destination = future.destination
+        if future.kind == DDO_Future.GET and message is not None and message.api_data.status == 0:
+            self.ddo_cache.put(destination, future.id, message.api_data.value, future.cache_writes)
+            if self.node_store is not None and destination is not None and\
+                future.id.upper() == "DD" and len(message.api_data.value) == 4:
+                # the low half of the Digi device type is the product type
+                product_type = struct.unpack(">HH", message.api_data.value)[1]
+                self.node_store.update(MAC_to_address_string(destination), product_type = product_type)
+        future._complete(message, exception)
+        self.ddo_in_flight[destination] -= 1
+        if not self.ddo_in_flight[destination]:
+            del self.ddo_in_flight[destination]
+        queued = self.ddo_queued.get(destination)
+        while queued and self.ddo_in_flight.get(destination, 0) < self.ddo_max_per_destination:
+            next_future = queued.pop(0)
+            if next_future.deadline <= time.time():
+                next_future._complete(None, Exception(next_future.timeout_message()))
+                continue
+            try:
+                self._send_ddo(next_future)
+            except Exception, e:
+                # may run on the reader thread, fail the request instead of raising
+                next_future._complete(None, e)
+        if queued is not None and not queued and self.ddo_queued.get(destination) is queued:
+            del self.ddo_queued[destination]
+
+    def _housekeeping(self):
+        """Periodic work done by the reader thread (or by pollers when it is not running):
+        expire DDO and LQI requests, Tx_Futures and frame IDs whose response never came, send paced LQI
+        requests, end discovery sweeps, report silent nodes and save node table changes."""
+        now = time.time()
+        if now < self.next_housekeeping:
+            return
+        self.next_housekeeping = now + HOUSEKEEPING_INTERVAL
+        expired = [future for future in self.at_waiters.values() if future.deadline <= now]
+        for future in expired:
+            del self.at_waiters[future.frame_id]
+            self._complete_ddo(future, exception = Exception(future.timeout_message()))
+        for destination, queued in self.ddo_queued.items():
+            for future in [future for future in queued if future.deadline <= now]:
+                queued.remove(future)
+                future._complete(None, Exception(future.timeout_message()))
+                expired.append(future)
+            if not queued and self.ddo_queued.get(destination) is queued:
+                del self.ddo_queued[destination]
+        if expired:
+            self.rx_condition.notifyAll()
+        expired = [future for future in self.tx_futures.values() if future.deadline <= now]
+        for future in expired:
+            del self.tx_futures[future.frame_id]
+            if self.tx_callbacks.get(future.frame_id) == future._tx_status:
+                del self.tx_callbacks[future.frame_id]
+            future._complete(Exception("Tx_Future: no Tx Status for frame %d within %s seconds" % (future.frame_id, str(future.timeout))))
+        if self.frame_ids.reap(now) or expired:
+            self.rx_condition.notifyAll()
+        self.lqi_cluster.tick()
+        self.lqi_crawler.pump()
+        if self.fragment_sender.in_flight:
+            self.fragment_sender.pump(now)
+        for reassembler in self.fragment_endpoints.values():
+            reassembler.expire(now)
+        if self.node_store is not None and now >= self.node_store.next_flush:
+            self.node_store.next_flush = now + NODE_STORE_FLUSH_INTERVAL
+            self.node_store.flush(self.node_table, background = True)
+        if self.discovery_deadline is not None:
+            if now >= self.discovery_deadline:
+                self._finish_discovery()
+            elif self.discovery_quiet_time is not None and\
+                now >= self.discovery_last_found + self.discovery_quiet_time:
+                self._finish_discovery(stale = False)
+        if now >= self.next_liveness_check:
+            self.next_liveness_check = now + LIVENESS_CHECK_INTERVAL
+            for node in self.get_stale_nodes(now):
+                if not node.silent:
+                    node.silent = True
+                    self._discovery_event(DISCOVERY_SILENT, node)
+
+    def get_node_list(self, refresh=True, blocking=False):
+        """Return the nodes currently known.
+        refresh starts a discovery sweep in the background (if none is running),
+        blocking waits for that sweep to finish, see wait_for_discovery."""
+        _global_lock.acquire(True)
+        try:
+            self._add_local_node()
+            if refresh:
+                if blocking:
+                    return self.wait_for_discovery()
+                self.start_discovery()
+            return self.node_table.snapshot()
+        finally:
+            _global_lock.release()
+
+    def open_node_store(self, filename = NODE_STORE_FILE):
+        """Load the nodes saved in the sqlite database filename; they are added
+        to the node table together with the local node.  Node table changes
+        are saved back every NODE_STORE_FLUSH_INTERVAL seconds.
+        Returns False if the store could not be opened."""
+        _global_lock.acquire(True)
+        try:
+            store = Node_Store(filename)
+            try:
+                if not store.open():
+                    return False
+                nodes = store.load()
+            except Exception, e:
+                logger.warning("unable to open the node store %s: %s" % (filename, e))
+                store.close()
+                return False
+            self.node_store = store
+            self.stored_nodes = nodes
+            if len(self.node_table):
+                self._add_local_node()
+            return True
+        finally:
+            _global_lock.release()
+
+    def _add_local_node(self):
+        "Add the local node to the table if not already there, followed by the stored nodes"
+        if len(self.node_table) == 0:
+            self.node_table.add(self._create_local_node())
+        for node in self.stored_nodes:
+            if self.node_table.get(node.addr_extended) is None:
+                self.node_table.add(node)
+                # kept until a discovery sweep does not see it
+                self.discovery_last_seen[node.addr_extended.lower()] = self.discovery_sweep
+                self._discovery_event(DISCOVERY_JOIN, node)
+        self.stored_nodes = []
+
+    def start_discovery(self, expected_count=None, quiet_time=None, callback=None):
+        """Start a discovery sweep in the background, returns the sweep number.
+        Nodes are added and updated as responses come in; nodes not seen for
+        discovery_stale_sweeps sweeps are removed when the sweep ends.
+        The sweep ends early once expected_count nodes were found or when
+        quiet_time seconds pass without a new node; early sweeps remove no nodes.
+        Both only apply when this call starts the sweep, joining a running sweep
+        leaves its limits alone.
+        callback is called with every node found, also when joining a running sweep."""
+        _global_lock.acquire(True)
+        try:
+            if callback is not None:
+                self.discovery_callbacks.append(callback)
+                for node in self.discovery_found.values():
+                    callback(node)
+            if self.discovery_deadline is not None:
+                return self.discovery_sweep # already running
+            self.discovery_expected = expected_count
+            self.discovery_quiet_time = quiet_time
+            self._add_local_node()
+            if self.is_802_15_4():
+                # Node discover using the ND command on the XBee
+                nt_str = self.ddo_get_param(None, "NT")
+                # support 1 or 2 byte return
+                if len(nt_str) == 1:
+                    nt, = struct.unpack(">B", nt_str)
+                elif len(nt_str) == 2:
+                    nt, = struct.unpack(">H", nt_str)
                 else:
-                    return at_response.api_data.value
+                    nt = 0xFF
+                node_discovery_timeout = nt / 10.0 # in seconds
+                message = API_Message()
+                message.api_data = Local_AT_Data("ND")
+                self.send(message)
+                # responses are collected in at_responses and parsed by process_message as they arrive
+                self.discovery_frame_id = message.api_data.frame_id
+                self.at_responses[self.discovery_frame_id] = []
             else:
-                raise Exception("ddo_command: error performing DDO command (%s@%s)." % (str(id), str(addr_extended)))
+                node_discovery_timeout = DISCOVERY_ZB_TIME
+            self.discovery_sweep += 1
+            sweep = self.discovery_sweep
+            self.discovery_deadline = time.time() + node_discovery_timeout
+            self.discovery_last_found = time.time()
+            local_node = self.node_table.snapshot()[0]
+            self.discovery_last_seen[local_node.addr_extended.lower()] = sweep
+            if self.discovery_frame_id is None:
+                self.topology.begin_crawl()
+                if local_node.type in self.device_types:
+                    self.topology.add_node(local_node.addr_extended, local_node.addr_short, self.device_types.index(local_node.type))
+                # crawl the neighbor tables, starting from every known router
+                roots = [node.addr_extended for node in self.node_table.snapshot() if node.type != "end"]
+                self.lqi_crawler.start(roots)
+            return sweep
         finally:
             _global_lock.release()
-    
-    def get_node_list(self, refresh=True, blocking=True):
-        "Perform a node discovery (blocking when refresh == True)"
+
+    def discover_nodes(self, expected_count=None, quiet_time=None, timeout=None):
+        """Run a discovery sweep (or join the running one), yielding each node
+        as it is found.  Ends with the sweep, see start_discovery for
+        expected_count and quiet_time, or after timeout seconds."""
+        found = []
         _global_lock.acquire(True)
         try:
-            # Add local node to table if not already there
-            if len(self.node_list) == 0:
-                self.node_list.append(self._create_local_node())
-            
-            if refresh:
-                if self.is_802_15_4():
-                    # Node discover using the ND command on the XBee
-                    nt_str = ddo_get_param(None, "NT")
-                    # support 1 or 2 byte return
-                    if len(nt_str) == 1:
-                        nt, = struct.unpack(">B", nt_str)
-                    elif len(nt_str) == 2:
-                        nt, = struct.unpack(">H", nt_str)
-                    else:
-                        nt = 0xFF
-                    node_discovery_timeout = nt / 10.0 # in seconds
-                    response_list = []
-                    # start Node discovery
-                    message = API_Message()
-                    message.api_data = Local_AT_Data("ND")    
-                    self.send(message)            
-                    # wait to receive responses
-                    AT_frame_id = message.api_data.frame_id
-                    at_response = None
-                    start_time = time.time()
-                    while start_time + node_discovery_timeout > time.time():
-                        at_response = self.read_messages(AT_frame_id)
-                        if at_response is not None:
-                            # store responses for parsing later.
-                            response_list.append(at_response)
-                    # parse responses
-                    self.node_list = self.node_list[1:] #remove all but the first item (local node)
-                    device_types = ["coordinator", "router", "end"]
-                    for at_response in response_list:
-                        msg = at_response.api_data.value
-                        if self.is_802_15_4():
-                            addr_short, addr_extended, rssi = struct.unpack(">HQB", msg[:11])
-                            index = 11
-                        else:
-                            addr_short, addr_extended = struct.unpack(">HQ", msg[:10])
-                            index = 10
-                        # convert 16-bit address into a formatted string
-                        addr_short = short_to_address_string(addr_short)
-                        # convert 64-bit address into a formatted string
-                        addr_extended = MAC_to_address_string(addr_extended)
-                        label = ""
-                        for character in msg[index:]:
-                            if character != chr(0):
-                                label += character
-                            else:
-                                break
-                        if self.is_802_15_4():
-                            self.node_list.append(Node(device_types[1], addr_extended, addr_short, 0xFFFE, 0xC105, 0x101E, label))
-                        else:
-                            index += len(label) + 1
-                            addr_parent, radio_type, status, profile_id, manufacturer_id = struct.unpack(">HBBHH", msg[index:index + 8])
-                            # turn type into a string
-                            radio_type = device_types[radio_type]
-                            self.node_list.append(Node(radio_type, addr_extended, addr_short, addr_parent, profile_id, manufacturer_id, label))
-                else:
-                    # send request to own neighbor table to start discovery
-                    for node in self.node_list:
-                        LQI_aggregator(self.lqi_cluster, node.addr_extended, 0, self._LQI_callback)
-                    self.node_list = self.node_list[:1] #remove all but the first item (local node)
-                    
-                    start_time = time.time()
-                    while time.time() < start_time + 3: #NOTE: used to be 6.625 (as measured on CPX2)
-                        self.read_messages()
-                        if not blocking:
+            sweep = self.start_discovery(expected_count, quiet_time, found.append)
+            deadline = None
+            if timeout is not None:
+                deadline = time.time() + timeout
+            while True:
+                while not found and self.discovery_completed < sweep:
+                    wait_time = READER_TIMEOUT
+                    if deadline is not None:
+                        wait_time = min(wait_time, deadline - time.time())
+                        if wait_time <= 0:
                             break
-                        time.sleep(.1)
-                                  
-            return self.node_list[:]
+                    self._wait_for_frames(wait_time)
+                if not found:
+                    break
+                nodes = found[:]
+                del found[:]
+                _global_lock.release()
+                try:
+                    for node in nodes:
+                        yield node
+                finally:
+                    _global_lock.acquire(True)
         finally:
+            if found.append in self.discovery_callbacks:
+                self.discovery_callbacks.remove(found.append)
             _global_lock.release()
+
+    def wait_for_discovery(self, timeout=None):
+        """Run a fresh discovery sweep (or join the running one) and wait for it
+        to finish, at most timeout seconds.  Returns the node table snapshot."""
+        _global_lock.acquire(True)
+        try:
+            sweep = self.start_discovery()
+            deadline = None
+            if timeout is not None:
+                deadline = time.time() + timeout
+            while self.discovery_completed < sweep:
+                wait_time = READER_TIMEOUT
+                if deadline is not None:
+                    wait_time = min(wait_time, deadline - time.time())
+                    if wait_time <= 0:
+                        break
+                self._wait_for_frames(wait_time)
+            return self.node_table.snapshot()
+        finally:
+            _global_lock.release()
+
+    def add_discovery_listener(self, callback):
+        """Call callback(event, node) for every DISCOVERY_JOIN, DISCOVERY_UPDATE,
+        DISCOVERY_STALE, DISCOVERY_SILENT and DISCOVERY_ALIVE event.
+        Called with _global_lock held."""
+        if callback not in self.discovery_listeners:
+            self.discovery_listeners.append(callback)
+
+    def remove_discovery_listener(self, callback):
+        if callback in self.discovery_listeners:
+            self.discovery_listeners.remove(callback)
+
+    def _discovery_event(self, event, node):
+        for callback in self.discovery_listeners[:]:
+            try:
+                callback(event, node)
+            except Exception, e:
+                logger.debug("Error: discovery listener: %s" % str(e))
+
+    def _node_heard(self, address, rssi = None):
+        """Stamp the node a frame was received from with the time, frame count
+        and RSSI.  address is an extended or short address string."""
+        if len(address) > len("[FFFE]!"):
+            node = self.node_table.get(address)
+        else:
+            node = self.node_table.get_short(address)
+        if node is None:
+            return
+        node.last_seen = time.time()
+        node.rx_count += 1
+        if rssi is not None:
+            node.rssi = rssi
+        if node.silent:
+            node.silent = False
+            self._discovery_event(DISCOVERY_ALIVE, node)
+
+    def get_stale_nodes(self, now = None):
+        """Return the nodes nothing was received from for longer than the
+        liveness threshold of their node type."""
+        if now is None:
+            now = time.time()
+        stale_nodes = []
+        for node in self.node_table.snapshot()[1:]: # skip the local node
+            threshold = self.liveness_thresholds.get(node.type, self.liveness_thresholds.get("unknown"))
+            if threshold is not None and node.last_seen is not None and now - node.last_seen > threshold:
+                stale_nodes.append(node)
+        return stale_nodes
+
+    def _parse_discovery_responses(self):
+        "Add the nodes from the ND responses received so far"
+        if self.discovery_frame_id is None:
+            return
+        response_list = self.at_responses.get(self.discovery_frame_id)
+        if not response_list:
+            return
+        self.at_responses[self.discovery_frame_id] = []
+        device_types = ["coordinator", "router", "end"]
+        end_of_discovery = False
+        for at_response in response_list:
+            msg = at_response.api_data.value
+            if not msg:
+                end_of_discovery = True # the XBee ends the ND command with an empty response
+                continue
+            try:
+                if self.is_802_15_4():
+                    addr_short, addr_extended, rssi = struct.unpack(">HQB", msg[:11])
+                    index = 11
+                else:
+                    addr_short, addr_extended = struct.unpack(">HQ", msg[:10])
+                    index = 10
+            except struct.error:
+                continue # garbled response
+            # convert 16-bit address into a formatted string
+            addr_short = short_to_address_string(addr_short)
+            # convert 64-bit address into a formatted string
+            addr_extended = MAC_to_address_string(addr_extended)
+            label = ""
+            for character in msg[index:]:
+                if character != chr(0):
+                    label += character
+                else:
+                    break
+            if self.is_802_15_4():
+                self._update_node(Node(device_types[1], addr_extended, addr_short, 0xFFFE, 0xC105, 0x101E, label))
+            else:
+                index += len(label) + 1
+                addr_parent, radio_type, status, profile_id, manufacturer_id = struct.unpack(">HBBHH", msg[index:index + 8])
+                # turn type into a string
+                radio_type = device_types[radio_type]
+                self._update_node(Node(radio_type, addr_extended, addr_short, addr_parent, profile_id, manufacturer_id, label))
+                rssi = None
+            # the node answered the discovery itself
+            self._node_heard(addr_extended, rssi)
+            self._discovery_found(addr_extended)
+        if end_of_discovery:
+            self._finish_discovery()
+
+    def _discovery_found(self, addr_extended):
+        "Report a node found by the running sweep, ends the sweep once the expected number was found"
+        key = addr_extended.lower()
+        if self.discovery_deadline is None or key in self.discovery_found:
+            return
+        node = self.node_table.get(key)
+        self.discovery_found[key] = node
+        self.discovery_last_found = time.time()
+        for callback in self.discovery_callbacks[:]:
+            try:
+                callback(node)
+            except Exception, e:
+                logger.debug("Error: discovery callback: %s" % str(e))
+        if self.discovery_expected is not None and len(self.discovery_found) >= self.discovery_expected:
+            self._finish_discovery(stale = False)
+
+    def _finish_discovery(self, stale=True):
+        "End the running discovery sweep and drop nodes that were not seen"
+        if self.discovery_deadline is None:
+            return
+        if self.discovery_frame_id is not None:
+            self.at_responses.pop(self.discovery_frame_id, None)
+            if not stale and self.serial is not None and time.time() < self.discovery_deadline:
+                # ended early: the XBee keeps answering on the ND frame ID until NT runs out
+                self.frame_ids.hold(self.discovery_frame_id, self.discovery_deadline)
+            else:
+                self.frame_ids.release(self.discovery_frame_id)
+        self.discovery_frame_id = None
+        # a sweep ending early must not keep sending neighbor table requests
+        self.lqi_crawler.stop()
+        self.discovery_deadline = None
+        self.discovery_found = {}
+        self.discovery_callbacks = []
+        self.discovery_expected = None
+        self.discovery_quiet_time = None
+        if stale:
+            oldest = self.discovery_sweep - self.discovery_stale_sweeps
+            for node in self.node_table.snapshot()[1:]:
+                key = node.addr_extended.lower()
+                if self.discovery_last_seen.get(key, 0) <= oldest:
+                    self.node_table.remove(node)
+                    self.discovery_last_seen.pop(key, None)
+                    self.topology.remove_node(key)
+                    if self.node_store is not None:
+                        self.node_store.remove(key)
+                    self._discovery_event(DISCOVERY_STALE, node)
+        self.topology.end_crawl()
+        self.discovery_completed = self.discovery_sweep
+        self.rx_condition.notifyAll()
+
+    def _update_node(self, new_node):
+        """Merge a discovered node into the node table and mark it as seen.
+        Returns True if the node was not known before."""
+        key = new_node.addr_extended.lower()
+        self.discovery_last_seen[key] = self.discovery_sweep
+        if new_node.addr_short:
+            self.address_cache.learn(key, new_node.addr_short)
+        if self.node_store is not None:
+            self.node_store.update(key, last_seen = time.time())
+        node = self.node_table.get(key)
+        if node is None:
+            if new_node.last_seen is None:
+                # liveness is counted from the time the node was added
+                new_node.last_seen = time.time()
+            self.node_table.add(new_node)
+            self._discovery_event(DISCOVERY_JOIN, new_node)
+            return True
+        changed = False
+        if new_node.addr_short not in (None, "[FFFE]!", node.addr_short):
+            self.node_table.set_short_address(node, new_node.addr_short)
+            changed = True
+        for attribute in ("type", "label"):
+            value = getattr(new_node, attribute)
+            if value not in (None, "unknown", getattr(node, attribute)):
+                setattr(node, attribute, value)
+                changed = True
+        if changed:
+            self._discovery_event(DISCOVERY_UPDATE, node)
+        return False
         
     def _create_local_node(self):
         """Create Node object based on local device"""
@@ -1570,38 +4374,43 @@ class XBee:
         return Node(dtype, addr_extended, addr_short, addr_parent, self.DIGI_PROFILE_ID, self.DIGI_MANUFACTURER_ID, label)                
 
     def _new_node(self, addr_extended, addr_short="[FFFE]!", node_type="unknown"):
-        "Create new node in list and kick off LQI request"
+        "Add or update a node in the node table, kick off an LQI request for new nodes"
         new_node = Node(type = node_type,\
                         addr_extended  = addr_extended,\
                         addr_short = addr_short)
-        self.node_list.append(new_node)
-        LQI_aggregator(self.lqi_cluster, addr_extended, 0, self._LQI_callback)
-    
-    def _LQI_callback(self, record_list):
-        """callback for LQI aggregator on a Device"""
-        #print "LQI final callback called"
+        if self._update_node(new_node) and node_type != "end":
+            self.lqi_crawler.add(addr_extended)
+
+    def _LQI_callback(self, addr_extended, record_list):
+        """callback for the LQI crawler, called with the complete neighbor table of a router"""
+        self.discovery_last_seen[addr_extended.lower()] = self.discovery_sweep
+        self.topology.update_neighbors(addr_extended, record_list)
         for record in record_list:
-            for node in self.node_list:
-                if record.addr_extended == node.addr_extended:
-                    # already have a reference to this node...
-                    node.addr_short = record.addr_short
-                    break
+            if record.device_type < len(self.device_types):
+                node_type = self.device_types[record.device_type]
             else:
-                #construct a new lqi_aggregator and add it as a node
-                self._new_node(record.addr_extended, record.addr_short, self.device_types[record.device_type])
+                node_type = "unknown"
+            self._update_node(Node(type = node_type,\
+                                   addr_extended = record.addr_extended,\
+                                   addr_short = record.addr_short))
+            if self.node_store is not None:
+                self.node_store.update(record.addr_extended, lqi = record.lqi)
+            self._discovery_found(record.addr_extended)
+            if node_type != "end":
+                # only coordinators and routers have neighbor tables
+                self.lqi_crawler.add(record.addr_extended)
+
+    def _crawl_complete(self, crawler):
+        "callback for the LQI crawler, ends a ZigBee discovery sweep"
+        if self.discovery_deadline is not None and self.discovery_frame_id is None:
+            self._finish_discovery()
     
     def device_announce_handler(self, record):
         """callback for device announce"""
         addr_short = short_to_address_string(record.nwk_addr)
         addr_extended = MAC_to_address_string(record.IEEE_addr)
-        for node in self.node_list:
-            if addr_extended == node.addr_extended:
-                # already have a reference to this node...
-                node.addr_short = addr_short
-                break
-        else:
-            #construct a new lqi_aggregator and add it as a node
-            self._new_node(addr_extended, addr_short)
+        self.topology.announce(addr_extended, addr_short)
+        self._new_node(addr_extended, addr_short)
         
 # Create local XBee to refer to by default
 default_xbee = XBee()
@@ -1631,6 +4440,26 @@ def ddo_set_param(*params, **keywords):
     finally:
         _global_lock.release()
         
+def ddo_set_many(*params, **keywords):
+    "Set several Digi Device Objects parameters and apply them at once"
+    return default_xbee.ddo_set_many(*params, **keywords)
+
+def ddo_fleet(*params, **keywords):
+    "Read and/or set parameters on many nodes, yields each DDO_Future as it finishes"
+    return default_xbee.ddo_fleet(*params, **keywords)
+
+def ddo_get_param_async(*params, **keywords):
+    "Start reading a Digi Device Objects parameter value, returns a DDO_Future"
+    return default_xbee.ddo_get_param_async(*params, **keywords)
+
+def ddo_set_param_async(*params, **keywords):
+    "Start setting a Digi Device Objects parameter value, returns a DDO_Future"
+    return default_xbee.ddo_set_param_async(*params, **keywords)
+
+def ddo_command_async(*params, **keywords):
+    "Start executing a Digi Device Objects AT command, returns a DDO_Future"
+    return default_xbee.ddo_command_async(*params, **keywords)
+
 def ddo_command(*params, **keywords):
     "Execute a Digi Device Objects AT command (only local address currently supported)"
     _global_lock.acquire(True)
@@ -1639,22 +4468,115 @@ def ddo_command(*params, **keywords):
     finally:
         _global_lock.release()
 
+def ddo_cache_statistics():
+    "Returns the hit/miss counters of the DDO parameter cache"
+    return default_xbee.ddo_cache.statistics()
+
+def conversation_statistics():
+    "Returns the outstanding/matched/expired counters of the LQI conversations"
+    return default_xbee.lqi_cluster.conversations.statistics()
+
+def load_stored_nodes(filename = None):
+    """load_stored_nodes([filename]) -> (node, node, ..., node)
+    Return the nodes saved in the node store, without a network discovery.
+    Defaults to the store of the XBee (NODE_STORE_FILE if none is open)."""
+    _global_lock.acquire(True)
+    try:
+        if filename is None and default_xbee.node_store is not None:
+            default_xbee.node_store.flush(default_xbee.node_table)
+            filename = default_xbee.node_store.filename
+    finally:
+        _global_lock.release()
+    store = Node_Store(filename or NODE_STORE_FILE)
+    try:
+        if not store.open():
+            return ()
+        return tuple(store.load())
+    finally:
+        store.close()
+
+def get_stale_nodes():
+    """get_stale_nodes() -> [node, node, ..., node]
+    Return the nodes nothing was received from for longer than the liveness
+    threshold of their node type (see LIVENESS_THRESHOLD)."""
+    _global_lock.acquire(True)
+    try:
+        return default_xbee.get_stale_nodes()
+    finally:
+        _global_lock.release()
 
-def getnodelist(refresh = True):
-    """get_node_list([refresh=True]) -> (node, node, ..., node)
-    Perform a node discovery and return a tuple of nodes.
-    If the refresh parameter is set to True this function will
-    block and a fresh network discovery will be performed.
-    If the refresh parameter is set to False this function will
-    return a cached copy of the discovery list.  This cached
-    version may include devices which were unable to respond
-    within the discovery timeout imposed during a blocking call."""
+def fragment_statistics():
+    "Returns the counters of the fragmentation layer (see XBS_SO_EP_FRAGMENT)"
     _global_lock.acquire(True)
     try:
-        return default_xbee.get_node_list(refresh)
+        statistics = default_xbee.fragment_sender.statistics()
+        for counter in ("completed", "expired", "dropped"):
+            statistics[counter] = sum([getattr(reassembler, counter) for reassembler in default_xbee.fragment_endpoints.values()])
+        return statistics
     finally:
         _global_lock.release()
 
+def address_cache_statistics():
+    "Returns the hit/miss counters of the learned 16-bit address cache"
+    return default_xbee.address_cache.statistics()
+
+def frame_id_statistics():
+    "Returns the in-flight and collision counters of the XBee frame ID allocator"
+    return default_xbee.frame_ids.statistics()
+
+def writer_statistics():
+    "Returns the queue depth and write latency counters of the XBee writer thread"
+    return default_xbee.writer.statistics()
+
+def get_topology():
+    "Returns the Topology_Graph of the mesh, filled in by discovery"
+    return default_xbee.topology
+
+def lqi_crawl_statistics():
+    "Returns the progress of the current (or last) neighbor table crawl"
+    return default_xbee.lqi_crawler.statistics()
+
+
+def getnodelist(refresh = True, blocking = False):
+    """get_node_list([refresh=True[, blocking=False]]) -> (node, node, ..., node)
+    Return a tuple of the nodes currently known.
+    If the refresh parameter is set to True a network discovery is
+    started in the background (unless one is already running); the
+    node list is updated as the responses come in.
+    If the blocking parameter is set to True this function waits for
+    that discovery to finish, see wait_for_discovery."""
+    _global_lock.acquire(True)
+    try:
+        return default_xbee.get_node_list(refresh, blocking)
+    finally:
+        _global_lock.release()
+
+def discover_nodes(expected_count = None, quiet_time = None, timeout = None):
+    """discover_nodes([expected_count=None[, quiet_time=None[, timeout=None]]]) -> generator
+    Perform a network discovery, yielding each node as it is found.
+    The discovery ends early once expected_count nodes were found
+    or when no new node was found for quiet_time seconds."""
+    return default_xbee.discover_nodes(expected_count, quiet_time, timeout)
+
+def wait_for_discovery(timeout = None):
+    """wait_for_discovery([timeout=None]) -> (node, node, ..., node)
+    Perform a fresh network discovery (or wait for the one already
+    running) and return a tuple of nodes.  Returns what is known
+    so far if the discovery did not finish within timeout seconds."""
+    return default_xbee.wait_for_discovery(timeout)
+
+def add_discovery_listener(callback):
+    """add_discovery_listener(callback) -> None
+    Call callback(event, node) whenever a node joins (DISCOVERY_JOIN),
+    changes (DISCOVERY_UPDATE), goes stale (DISCOVERY_STALE), stays silent
+    for longer than its liveness threshold (DISCOVERY_SILENT) or is heard
+    from again (DISCOVERY_ALIVE)."""
+    default_xbee.add_discovery_listener(callback)
+
+def remove_discovery_listener(callback):
+    "remove_discovery_listener(callback) -> None"
+    default_xbee.remove_discovery_listener(callback)
+
 # second name for getting a node list
 get_node_list = getnodelist        
 """getnodelist([refresh=True]) -> (node, node, ..., node)
@@ -1716,8 +4638,15 @@ socket.XBS_SO_EP_FRAMES_TX = 16385
 __register_with_socket_module("XBS_SO_EP_FRAMES_TX")
 socket.XBS_SO_EP_FRAMES_RX = 16386
 __register_with_socket_module("XBS_SO_EP_FRAMES_RX")
+socket.XBS_SO_EP_SYNC_TX = 20481
+__register_with_socket_module("XBS_SO_EP_SYNC_TX")
 socket.XBS_SO_EP_TX_STATUS = 20482
 __register_with_socket_module("XBS_SO_EP_TX_STATUS")    
+# simulator only: split messages into fragments that fit in one frame, put them back together on receive
+socket.XBS_SO_EP_FRAGMENT = 28673
+__register_with_socket_module("XBS_SO_EP_FRAGMENT")
+socket.XBS_SO_EP_FRAGMENT_WINDOW = 28674
+__register_with_socket_module("XBS_SO_EP_FRAGMENT_WINDOW")
 # XBS_SOL_APS parameters
 
 class Node:
@@ -1740,6 +4669,14 @@ class Node:
         "node manufacturer ID"
         self.label = label
         "the nodes string label"
+        self.last_seen = None
+        "time.time() a frame was last received from the node (or it was added to the node table)"
+        self.rx_count = 0
+        "Number of frames received from the node"
+        self.rssi = None
+        "Received signal strength of the last frame in -dBm (802.15.4 only)"
+        self.silent = False
+        "Set while the node is silent for longer than its liveness threshold"
 
     def to_socket_addr(self, endpoint, profile_id, cluster_id, use_short):
         "Transform a node into a socket address tuple"
@@ -1762,10 +4699,86 @@ class Node:
 original_select = select.select
 "Storage for the non-XBee type of Python select"
 SELECT_SLEEP_TIME = 0.05
-"Time to sleep in seconds between polls of the sockets"
+"Time to sleep in seconds between polls of the sockets when the XBee reader thread is not running"
+
+class Select_Wakeup:
+    """Socket pair whose read end becomes readable when a message is queued for
+    an XBee socket, so xbee_select can block in the real select together with
+    the other sockets.  A socket pair rather than a pipe: Windows can only
+    select on sockets.  Every xbee_select call uses a wakeup of its own, so one
+    caller clearing it cannot swallow the wakeup meant for another.
+    set and clear are called with _global_lock held."""
+    
+    def __init__(self):
+        self.reader, self.writer = socket.socketpair()
+        self.reader.setblocking(0)
+        self.writer.setblocking(0)
+        self.signalled = False
+        "Set while a wakeup byte is waiting in the socket pair"
+
+    def fileno(self):
+        return self.reader.fileno()
+
+    def set(self):
+        if not self.signalled:
+            self.signalled = True
+            try:
+                self.writer.send("x")
+            except socket.error:
+                pass # socket buffer full, the reader is readable anyway
+
+    def clear(self):
+        if self.signalled:
+            self.signalled = False
+            try:
+                self.reader.recv(512)
+            except socket.error:
+                pass
+
+    def close(self):
+        self.reader.close()
+        self.writer.close()
+
+_select_wakeups = []
+"Select_Wakeups of the running xbee_select calls"
+_free_select_wakeups = []
+"Select_Wakeups kept for the next xbee_select calls"
+_select_wakeup_failed = False
+"Set when no Select_Wakeup could be created, xbee_select polls instead"
+
+def _wake_select():
+    "Wake up xbee_select calls blocked in the real select"
+    for wakeup in _select_wakeups:
+        wakeup.set()
+
+def _get_select_wakeup():
+    """Return a Select_Wakeup for one xbee_select call (None when not available).
+    Caller must hold _global_lock and give it back with _release_select_wakeup."""
+    global _select_wakeup_failed
+    if _free_select_wakeups:
+        wakeup = _free_select_wakeups.pop()
+    elif _select_wakeup_failed:
+        return None
+    else:
+        try:
+            wakeup = Select_Wakeup()
+        except Exception, e:
+            logger.warning("xbee_select falls back to polling: %s" % str(e))
+            _select_wakeup_failed = True
+            return None
+    _select_wakeups.append(wakeup)
+    return wakeup
+
+def _release_select_wakeup(wakeup):
+    "Stop waking up a Select_Wakeup and keep it for the next call.  Caller must hold _global_lock."
+    _select_wakeups.remove(wakeup)
+    wakeup.clear()
+    _free_select_wakeups.append(wakeup)
 
 def xbee_select(rlist, wlist, xlist, timeout = None):
-    "Select which sockets are ready to read, write, and have exceptions"
+    """Select which sockets are ready to read, write, and have exceptions.
+    Blocks in the real select on the non-XBee sockets and the Select_Wakeup,
+    which is set as soon as a message is queued for an XBee socket."""
 
     start_time = None
     if timeout is not None:
@@ -1777,9 +4790,6 @@ def xbee_select(rlist, wlist, xlist, timeout = None):
     xlist_nonxbee = []
     rlist_xbee = []
     wlist_xbee = []
-    rlist_out = []
-    wlist_out = []
-    xlist_out = []
   
     # split xbee and non-xbee sockets
     for sock in rlist:
@@ -1810,48 +4820,113 @@ def xbee_select(rlist, wlist, xlist, timeout = None):
     if not len(rlist_xbee) and not len(wlist_xbee): 
         return original_select(rlist_nonxbee, wlist_nonxbee, xlist_nonxbee, timeout)
     
-    # flag if there are any non_xbee sockets
-    nonxbee_socket = len(rlist_nonxbee) or len(wlist_nonxbee) or len(xlist_nonxbee)
-    
-    # loop over xbee and non-xbee sockets
-    first_loop = True
-    while first_loop or timeout is None or start_time + timeout >= time.time():
-        if first_loop:
-            # immediately check for matches on the first loop
-            first_loop = False
-        else:
-            # on subsequent loops, sleep between polls.
-            if timeout is not None:
-                time.sleep(min(SELECT_SLEEP_TIME,
-                               abs(start_time + timeout - time.time())))
-            else:
-                time.sleep(SELECT_SLEEP_TIME)
-            
-        # check original sockets
-        if nonxbee_socket:
-            rlist_out, wlist_out, xlist_out = original_select(rlist_nonxbee, wlist_nonxbee, xlist_nonxbee, 0)
-        
-        # check XBee sockets
+    _global_lock.acquire(True)
+    try:
+        wakeup = _get_select_wakeup()
+        # without the reader thread nobody sets the wakeup, the serial port has to be polled
+        poll = wakeup is None
         for sock in rlist_xbee:
+            if not sock.xbee.reader_active():
+                poll = True
+    finally:
+        _global_lock.release()
+    if wakeup is not None:
+        rlist_nonxbee.append(wakeup)
+    try:
+        return _xbee_select_loop(rlist_xbee, wlist_xbee, rlist_nonxbee, wlist_nonxbee, xlist_nonxbee,
+                                 timeout, start_time, wakeup, poll)
+    finally:
+        if wakeup is not None:
             _global_lock.acquire(True)
             try:
-                if sock._pending_message():
-                    rlist_out.append(sock)
+                _release_select_wakeup(wakeup)
             finally:
-                _global_lock.release()  
+                _global_lock.release()
+
+def _xbee_select_loop(rlist_xbee, wlist_xbee, rlist_nonxbee, wlist_nonxbee, xlist_nonxbee,
+                      timeout, start_time, wakeup, poll):
+    "Body of xbee_select, waits until a socket is ready or the timeout passed"
+    rlist_out = []
+    wlist_out = []
+    xlist_out = []
+    # flag if there are any sockets for the real select
+    nonxbee_socket = len(rlist_nonxbee) or len(wlist_nonxbee) or len(xlist_nonxbee)
+    
+    while 1:
+        # check XBee sockets; the wakeup is cleared first, so a message queued
+        # after the check interrupts the select below
+        rlist_ready = []
+        _global_lock.acquire(True)
+        try:
+            if wakeup is not None:
+                wakeup.clear()
+            for sock in rlist_xbee:
+                if sock._pending_message():
+                    rlist_ready.append(sock)
+        finally:
+            _global_lock.release()
+        
+        # block until a socket is ready, unless an XBee socket already is
         # xbee sockets are always ready for write
         #TODO: check to make sure serial port is open and ready to go.
+        if len(rlist_ready) or len(wlist_xbee):
+            wait = 0
+        elif timeout is None:
+            wait = None
+        else:
+            wait = max(0, start_time + timeout - time.time())
+        if poll and (wait is None or wait > SELECT_SLEEP_TIME):
+            wait = SELECT_SLEEP_TIME
+        
+        # check original sockets
+        if nonxbee_socket:
+            rlist_out, wlist_out, xlist_out = original_select(rlist_nonxbee, wlist_nonxbee, xlist_nonxbee, wait)
+            if wakeup in rlist_out:
+                rlist_out.remove(wakeup)
+        elif wait:
+            time.sleep(wait)
+        rlist_out.extend(rlist_ready)
         wlist_out.extend(wlist_xbee)
     
         # check for any matches
         if len(rlist_out) or len(wlist_out) or len(xlist_out):
             break
+        if timeout is not None and start_time + timeout <= time.time():
+            break
     
     return  rlist_out, wlist_out, xlist_out
 
 # replace the original select with the xbee select
 select.select = xbee_select
 
+if selectors is not None:
+    class XBeeSelector(selectors.DefaultSelector):
+        """The platform's best selector (epoll, kqueue, ...) that also accepts XBee
+        sockets.  They are watched through their readiness fd, see XBeeSocket.fileno;
+        a wakeup whose message was taken meanwhile by another thread is filtered out.
+        Needs the XBee reader thread to set the readiness fds."""
+
+        def select(self, timeout = None):
+            deadline = None
+            if timeout is not None:
+                deadline = time.time() + timeout
+            while 1:
+                ready = []
+                for key, events in selectors.DefaultSelector.select(self, timeout):
+                    if events & selectors.EVENT_READ and getattr(key.fileobj, "_family", None) == socket.AF_XBEE:
+                        _global_lock.acquire(True)
+                        try:
+                            if not key.fileobj._pending_message():
+                                events &= ~selectors.EVENT_READ
+                        finally:
+                            _global_lock.release()
+                    if events:
+                        ready.append((key, events))
+                if ready or (deadline is not None and time.time() >= deadline):
+                    return ready
+                if deadline is not None:
+                    timeout = deadline - time.time()
+
 # Save the original socket.socket definition:
 original_socket = socket.socket
 
@@ -1880,22 +4955,35 @@ class XBeeSocket(original_socket):
                                             }
         # XBS_SOL_ENDPOINT
         self.options[socket.XBS_SOL_ENDPOINT] = {
-                                                 socket.XBS_SO_EP_TX_STATUS: 0
+                                                 socket.XBS_SO_EP_SYNC_TX: 0,
+                                                 socket.XBS_SO_EP_TX_STATUS: 0,
+                                                 socket.XBS_SO_EP_FRAGMENT: 0,
+                                                 socket.XBS_SO_EP_FRAGMENT_WINDOW: FRAGMENT_WINDOW
                                                  }
         # XBS_SOL_APS
         self.options[socket.XBS_SOL_APS] = {}
         self.closed = True
+        self.wakeup = None
+        "Select_Wakeup readable while messages are queued, created by fileno"
+        self.timeout = None
+        "Receive timeout in seconds, None: block (non-blocking mode is kept in SO_NONBLOCK)"
         
         # rebind external methods:
         self.__del__ = self._xb___del__
         self.close = self._xb_close
         self.getsockopt = self._xb_getsockopt
         self._pending_message = self._xb__pending_message
+        self.fileno = self._xb_fileno
         self.recvfrom = self._xb_recvfrom
+        self.recvfrom_into = self._xb_recvfrom_into
         self.sendto = self._xb_sendto
+        self.sendto_async = self._xb_sendto_async
+        self.sendmsg = self._xb_sendmsg
         self.setsockopt = self._xb_setsockopt
         self.bind = self._xb_bind
         self.setblocking = self._xb_setblocking
+        self.settimeout = self._xb_settimeout
+        self.gettimeout = self._xb_gettimeout
         self.debug_add_message = self._xb_debug_add_message
 
         
@@ -1906,9 +4994,39 @@ class XBeeSocket(original_socket):
     def _xb_close(self):
         "Close the socket"
         if not self.closed:
+            # flag first, so receivers woken by unregister_endpoint see it
+            self.closed = True
             # remove self from xbee
             self.xbee.unregister_endpoint(self.endpoint_id)
+        if self.wakeup is not None:
+            _global_lock.acquire(True)
+            try:
+                if self.xbee.endpoint_wakeups.get(self.endpoint_id) is self.wakeup:
+                    del self.xbee.endpoint_wakeups[self.endpoint_id]
+                self.wakeup.close()
+                self.wakeup = None
+            finally:
+                _global_lock.release()
         self.closed = True
+
+    def _xb_fileno(self):
+        """Return a file descriptor that is readable while messages are queued
+        for the socket, for select.poll, select.epoll and XBeeSelector.
+        It is set by the XBee reader thread."""
+        if self.endpoint_id is None:
+            raise Exception("Socket is not yet bound to endpoint")
+        if self.closed:
+            raise Exception("Socket is closed")
+        _global_lock.acquire(True)
+        try:
+            if self.wakeup is None:
+                self.wakeup = Select_Wakeup()
+                self.xbee.endpoint_wakeups[self.endpoint_id] = self.wakeup
+                if self.xbee.rx_messages.get(self.endpoint_id):
+                    self.wakeup.set()
+            return self.wakeup.fileno()
+        finally:
+            _global_lock.release()
         
     def _xb_getsockopt(self, level, optname):
         "Get socket options"
@@ -1932,19 +5050,59 @@ class XBeeSocket(original_socket):
             return len(self.xbee.rx_messages[self.endpoint_id])
             
     def _xb_recvfrom(self, buflen, flags = 0):
-        "Receive a message from the socket."
-        nonblocking = False
+        """Receive a message from the socket.
+        Non-blocking sockets return (None, None) when no message is waiting,
+        blocking sockets with a timeout raise socket.timeout.
+        Bytes beyond buflen stay queued for the next receive."""
+        return self._xb_receive(buflen, flags)
+
+    def _xb_receive(self, buflen, flags = 0, into = None):
+        "Body of recvfrom and recvfrom_into, see XBee.recv for into"
+        timeout = self.timeout
         if flags == socket.MSG_DONTWAIT or self.getsockopt(socket.SOL_SOCKET, socket.SO_NONBLOCK):
-            nonblocking = True
+            timeout = 0
         if self.endpoint_id is None:
             raise Exception("error: socket not bound yet") #Note: this is a different error
         while (1):
-            payload, address = self.xbee.recv(self.endpoint_id)
+            payload, address = self.xbee.recv(self.endpoint_id, timeout, buflen, into)
             if payload is not None:
-                return payload[:buflen], address
-            elif nonblocking:
+                return payload, address
+            elif timeout == 0:
                 return None, None
+            elif timeout is not None:
+                raise socket.timeout("timed out")
+            elif self.closed:
+                raise Exception("Socket is closed")
+            else:
+                # try to re-register endpoint with XBee
+                self.xbee.register_endpoint(self.endpoint_id)
         
+    def _xb_recvfrom_into(self, buffer, nbytes = 0, flags = 0):
+        """Receive a message into a bytearray (or other writable buffer), returns (nbytes, address).
+        Bytes beyond nbytes (default: the buffer size) stay queued for the next receive."""
+        if not nbytes:
+            nbytes = len(buffer)
+        length, address = self._xb_receive(nbytes, flags, buffer)
+        if length is None:
+            return 0, None
+        return length, address
+
+    def _xb_sendmsg(self, buffers, ancdata = (), flags = 0, address = None):
+        """Send the buffers (strings, bytearrays or memoryviews) as one message to address.
+        The buffers are copied straight into the API frame; ancdata is not supported.
+        Returns the number of bytes sent."""
+        if address is None:
+            raise Exception("error: destination address required")
+        buffers = tuple(buffers)
+        if self.getsockopt(socket.XBS_SOL_ENDPOINT, socket.XBS_SO_EP_FRAGMENT):
+            return self._xb_sendto(_payload_string(buffers), flags, address)
+        if self.endpoint_id is not None and self.endpoint_id >= 0:
+            if self.getsockopt(socket.XBS_SOL_ENDPOINT, socket.XBS_SO_EP_SYNC_TX):
+                self._xb_wait_tx(self.xbee.send_zb_async(self.endpoint_id, address, buffers, self._xb_tx_timeout()))
+            else:
+                self.xbee.send_zb(self.endpoint_id, address, buffers)
+        return _payload_length(buffers)
+
     def _xb_sendto(self, data, flags, addr = None):
         "Send a message from a socket"
         if addr is None:
@@ -1952,13 +5110,52 @@ class XBeeSocket(original_socket):
             flags = 0
         #TTDO: Should support the MSG_DONTWAIT flag and do a blocking call.
         if self.endpoint_id is not None and self.endpoint_id >= 0:
-            self.xbee.send_zb(self.endpoint_id, addr, data)
+            if self.getsockopt(socket.XBS_SOL_ENDPOINT, socket.XBS_SO_EP_FRAGMENT):
+                sync = self.getsockopt(socket.XBS_SOL_ENDPOINT, socket.XBS_SO_EP_SYNC_TX)
+                blocking = sync or (flags != socket.MSG_DONTWAIT and not self.getsockopt(socket.SOL_SOCKET, socket.SO_NONBLOCK))
+                future = self.xbee.send_fragmented(self.endpoint_id, addr, _payload_string(data),
+                                                   self.getsockopt(socket.XBS_SOL_ENDPOINT, socket.XBS_SO_EP_FRAGMENT_WINDOW), blocking)
+                if sync:
+                    self._xb_wait_tx(future)
+            elif self.getsockopt(socket.XBS_SOL_ENDPOINT, socket.XBS_SO_EP_SYNC_TX):
+                self._xb_wait_tx(self.xbee.send_zb_async(self.endpoint_id, addr, data, self._xb_tx_timeout()))
+            else:
+                self.xbee.send_zb(self.endpoint_id, addr, data)
         return len(data)
+
+    def _xb_sendto_async(self, data, flags, addr = None):
+        """Send a message from a socket, returns a Tx_Future resolved by its Tx Status
+        (with XBS_SO_EP_FRAGMENT set: once every fragment was delivered)."""
+        if addr is None:
+            addr = flags
+            flags = 0
+        if self.endpoint_id is None or self.endpoint_id < 0:
+            raise Exception("error: socket not bound yet")
+        blocking = flags != socket.MSG_DONTWAIT and not self.getsockopt(socket.SOL_SOCKET, socket.SO_NONBLOCK)
+        if self.getsockopt(socket.XBS_SOL_ENDPOINT, socket.XBS_SO_EP_FRAGMENT):
+            return self.xbee.send_fragmented(self.endpoint_id, addr, _payload_string(data),
+                                             self.getsockopt(socket.XBS_SOL_ENDPOINT, socket.XBS_SO_EP_FRAGMENT_WINDOW), blocking)
+        return self.xbee.send_zb_async(self.endpoint_id, addr, data, self._xb_tx_timeout(), blocking)
+
+    def _xb_tx_timeout(self):
+        "Seconds to wait for a Tx Status, the socket timeout if one is set"
+        if self.timeout:
+            return self.timeout
+        return TX_STATUS_TIMEOUT
+
+    def _xb_wait_tx(self, future):
+        "Block until the Tx Status of a message sent with XBS_SO_EP_SYNC_TX arrives, raise if it was not delivered"
+        delivery_status = future.result()
+        if delivery_status != ZigBee_Tx_Status_Data.SUCCESS:
+            raise Exception("error: message not delivered, delivery status 0x%02X" % delivery_status)
     
     def _xb_setsockopt(self, level, optname, value):
         "Set socket options"
         if level in self.options and optname in self.options[level]:
                 self.options[level][optname] = value 
+        if level == socket.XBS_SOL_ENDPOINT and optname == socket.XBS_SO_EP_FRAGMENT and\
+            self.endpoint_id is not None and not self.closed:
+            self.xbee.set_fragmentation(self.endpoint_id, value)
         #TTDO: figure out the return value
     
     def _xb_bind(self, address):
@@ -1980,18 +5177,41 @@ class XBeeSocket(original_socket):
         # set the endpoint locally
         self.endpoint_id = endpoint_id
         self.closed = False            
+        if self.getsockopt(socket.XBS_SOL_ENDPOINT, socket.XBS_SO_EP_FRAGMENT):
+            self.xbee.set_fragmentation(endpoint_id, True)
         return 0
         
     def _xb_setblocking(self, value):
         "Set the socket to be blocking or non-blocking"
+        if value:
+            self.timeout = None
         return self.setsockopt(socket.SOL_SOCKET, socket.SO_NONBLOCK, not value)
 
+    def _xb_settimeout(self, value):
+        "Set the receive timeout in seconds, 0 makes the socket non-blocking and None blocking"
+        if value is not None:
+            value = float(value)
+            if value < 0:
+                raise ValueError("Timeout value out of range")
+        if value == 0:
+            self.setsockopt(socket.SOL_SOCKET, socket.SO_NONBLOCK, 1)
+        else:
+            self.timeout = value
+            self.setsockopt(socket.SOL_SOCKET, socket.SO_NONBLOCK, 0)
+
+    def _xb_gettimeout(self):
+        "Return the receive timeout in seconds, 0.0 for non-blocking and None for blocking sockets"
+        if self.getsockopt(socket.SOL_SOCKET, socket.SO_NONBLOCK):
+            return 0.0
+        return self.timeout
+
     def _xb_debug_add_message(self, payload, source_address):
         "Debugging function to artificially add an incoming message to a socket"
         # create the tuple to store the message
         recv_tuple = (payload, source_address)
         # add data to the message queue
         self.xbee.rx_messages[self.endpoint_id].append(recv_tuple)
+        self.xbee._wake_receivers()
         
 # replace the original socket with the xbee_socket
 socket.socket = XBeeSocket
@@ -2070,9 +5290,11 @@ def open_com_thread():
                 continue # will hit "finally" below
             try:
                 xbee_serial_port = serial.Serial(simulator_settings.settings["com_port"], simulator_settings.settings["baud"], rtscts = 1)
-                xbee_serial_port.writeTimeout = 1 # 1 second timeout for writes
+                xbee_serial_port.writeTimeout = 1 # 1 second timeout for writes (only stalls the writer thread)
                 xbee_serial_port.flushInput() #get rid of anything the XBee had stored up
                 default_xbee.serial = xbee_serial_port
+                default_xbee.start_reader()
+                default_xbee.start_writer()
                 #make sure the serial port connects to an XBee (ddo will throw exception on error)
                 default_xbee.set_version()
                 # COM port successfully opened, finish initialization
@@ -2091,6 +5313,9 @@ def open_com_thread():
                             default_xbee.ddo_set_param(None, "AO", 3)
                     except Exception, e:
                         logger.warning("unable to initialize XBee DDO params: %s" % repr(e))
+                node_store = simulator_settings.settings.get("node_store", NODE_STORE_FILE)
+                if node_store:
+                    default_xbee.open_node_store(node_store) # known nodes are available at once
                 try:
                     default_xbee.get_node_list(refresh=True, blocking=False) #kick off discovery of nodes on network
                 except Exception, e:
@@ -2103,7 +5328,10 @@ def open_com_thread():
                     logger.error("Exception while creating serial port (%s, %s): %s" % (simulator_settings.settings.get('com_port', 'No COM'), simulator_settings.settings.get('baud', 'no baud'), e))
                     ran_first_time = True
                 if xbee_serial_port:
-                    xbee_serial_port.close()
+                    if default_xbee.serial is xbee_serial_port:
+                        default_xbee.close_serial() # also stops the reader and writer threads
+                    else:
+                        xbee_serial_port.close()
         finally:
             if not com_port_opened:
                 _com_mgmt_lock.release()